@@ -0,0 +1,387 @@
+"""
+Shop Inventory Application - benchmarks
+Description: Seeds a separate benchmark database with a synthetic catalog and changes_log
+history, then times the application's data paths headlessly (no Tk window, matplotlib on Agg):
+startup inventory load, search filtering, add/remove logging, save_changes and the graph queries.
+Results are written to a JSON file that can be compared with an earlier run.
+
+Usage:
+    python bench_inventory.py --skus 10000 --changes 1000000 --output bench.json
+    python bench_inventory.py --skus 10000 --changes 1000000 --compare bench.json
+"""
+
+import os
+# No display needed; must be set before matplotlib is imported
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+import mysql.connector
+
+import inven_control as app
+
+
+# Database the benchmark seeds and measures; never the production database
+BENCH_DB_NAME = os.environ.get("INVENTORY_BENCH_DB_NAME", "shop_inventory_bench")
+# Rows per INSERT transaction while seeding
+SEED_CHUNK = 10000
+# Items whose graphs are timed
+GRAPH_SAMPLE_ITEMS = 20
+# Median slowdown (fraction) reported as a regression by --compare
+REGRESSION_THRESHOLD = 0.2
+
+BASE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS shop_inventory_count ("
+    "ItemName VARCHAR(255) NOT NULL, "
+    "random_id VARCHAR(32) NOT NULL, "
+    "Quantity DOUBLE NOT NULL DEFAULT 0, "
+    "category VARCHAR(64) NULL)",
+    "CREATE TABLE IF NOT EXISTS changes_log ("
+    "id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY, "
+    "item_name VARCHAR(255) NOT NULL, "
+    "original_quantity DOUBLE NOT NULL, "
+    "new_quantity DOUBLE NOT NULL, "
+    "quantity_change DOUBLE NOT NULL, "
+    "change_date DATE NOT NULL, "
+    "change_time DATETIME(6) NOT NULL, "
+    "emp_id INT NULL, "
+    "random_id VARCHAR(32) NULL)",
+    "CREATE TABLE IF NOT EXISTS bench_seed ("
+    "skus INT NOT NULL, changes BIGINT NOT NULL, days INT NOT NULL, seed INT NOT NULL)",
+]
+
+
+#### Seeding. ####
+def item_name(index):
+    return f"Item {index:07d}"
+
+
+def item_random_id(index):
+    return f"R{index:08d}"
+
+
+def use_bench_database(name):
+    # Point the application's pool at the benchmark database, creating it if needed
+    if name == app.DB_CONFIG["database"]:
+        raise SystemExit(f"Refusing to seed {name}, it is the application database")
+    server = {key: value for key, value in app.DB_CONFIG.items() if key != "database"}
+    db = mysql.connector.connect(**server)
+    cursor = db.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{name}`")
+    cursor.close()
+    db.close()
+    app.close_db_pool()
+    app.DB_CONFIG["database"] = name
+
+
+def current_seed():
+    with app.db_connection("bench_seed") as db:
+        cursor = db.cursor()
+        try:
+            cursor.execute("SELECT skus, changes, days, seed FROM bench_seed")
+            row = cursor.fetchone()
+        except mysql.connector.Error:
+            row = None
+        cursor.close()
+    return row
+
+
+def seed_database(skus, changes, days, seed):
+    # Drop and rebuild the benchmark tables: skus items in 50 categories and `changes`
+    # changes_log rows spread over the last `days` days, with consistent running quantities
+    rng = random.Random(seed)
+    with app.db_connection("bench_seed") as db:
+        cursor = db.cursor()
+        for table in ("changes_log", "changes_log_archive", "changes_daily_rollup", "applied_deltas", "shop_inventory_count", "schema_migrations", "bench_seed"):
+            cursor.execute(f"DROP TABLE IF EXISTS {table}")
+        for statement in BASE_SCHEMA:
+            cursor.execute(statement)
+        db.commit()
+        cursor.close()
+    app.run_migrations()
+    # The migration partitions the empty changes_log from this month on; give the seeded
+    # history its own monthly partitions so rollups and date filters prune like production
+    first_day = datetime.now().replace(hour = 0, minute = 0, second = 0, microsecond = 0) - timedelta(days = days)
+    created, _ = app.maintain_partitions(archive = False, first = first_day.date())
+    print(f"Created {len(created)} changes_log partitions from {first_day.date()}")
+
+    quantities = [float(rng.randint(20, 500)) for _ in range(skus)]
+    started = time.perf_counter()
+    step = timedelta(days = days) / max(changes, 1)
+    with app.db_connection("bench_seed") as db:
+        cursor = db.cursor()
+        written = 0
+        while written < changes:
+            rows = []
+            for offset in range(written, min(written + SEED_CHUNK, changes)):
+                index = rng.randrange(skus)
+                original = quantities[index]
+                change = float(rng.choice((-3, -2, -1, -1, -1, 1, 2, 5, 10)))
+                new = original + change
+                quantities[index] = new
+                change_time = first_day + step * offset
+                rows.append((item_name(index), original, new, change, change_time.date(), change_time,
+                             rng.randint(1, 20), item_random_id(index), None))
+            db.start_transaction()
+            app._write_change_rows(cursor, rows)
+            db.commit()
+            written += len(rows)
+            if written % (SEED_CHUNK * 50) == 0 or written == changes:
+                print(f"Seeded {written}/{changes} changes_log rows ({time.perf_counter() - started:.0f} s)")
+
+        for start in range(0, skus, SEED_CHUNK):
+            rows = [(item_name(index), item_random_id(index), quantities[index], f"Category {index % 50:02d}")
+                    for index in range(start, min(start + SEED_CHUNK, skus))]
+            db.start_transaction()
+            cursor.executemany("INSERT INTO shop_inventory_count (ItemName, random_id, Quantity, category) VALUES (%s, %s, %s, %s)", rows)
+            db.commit()
+        cursor.execute("INSERT INTO bench_seed (skus, changes, days, seed) VALUES (%s, %s, %s, %s)", (skus, changes, days, seed))
+        db.commit()
+        cursor.close()
+    print(f"Seeded {skus} items and {changes} changes in {time.perf_counter() - started:.0f} s")
+
+
+#### Measurements. ####
+def summarize(samples_ms):
+    ordered = sorted(samples_ms)
+    return {
+        "runs": len(ordered),
+        "min_ms": ordered[0],
+        "median_ms": statistics.median(ordered),
+        "p95_ms": app.percentile(ordered, 0.95),
+        "max_ms": ordered[-1],
+    }
+
+
+def measure(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - started) * 1000)
+    return summarize(samples)
+
+
+def bench_inventory_load(repeat):
+    def load():
+        store = app.InventoryStore()
+        app.load_inventory(store, app.SearchIndex(store))
+    return measure(load, repeat)
+
+
+def bench_search(store, index, repeat, rng):
+    # Short prefixes, long substrings and misses, as typed into the dropdown
+    queries = ["", "i", "it", "item 0", "m 00", "0042", "category", "zzz"]
+    queries += [item_name(rng.randrange(len(store.ids)))[2:9] for _ in range(5)]
+    results = {}
+    samples = []
+    for typed in queries:
+        for _ in range(repeat):
+            index.last_query = index.last_matches = None
+            started = time.perf_counter()
+            index.search(typed)
+            samples.append((time.perf_counter() - started) * 1000)
+    results["search"] = summarize(samples)
+
+    # Typing one character at a time reuses the previous matches
+    target = item_name(rng.randrange(len(store.ids))).casefold()
+    samples = []
+    for _ in range(repeat):
+        index.last_query = index.last_matches = None
+        started = time.perf_counter()
+        for end in range(1, len(target) + 1):
+            index.search(target[:end])
+        samples.append((time.perf_counter() - started) * 1000)
+    results["search_incremental_typing"] = summarize(samples)
+    return results
+
+
+def bench_change_logging(store, changes, rng):
+    # Queue `changes` add/remove rows through a fresh write-behind logger and time until flushed
+    writer = app.ChangeLogWriter()
+    writer.start()
+    rows = []
+    now = datetime.now()
+    for _ in range(changes):
+        row = rng.randrange(len(store.ids))
+        original = store.quantity(row)
+        change = float(rng.choice((-1, 1)))
+        rows.append((store.name(row), original, original + change, change, now.date(), now, 0, store.ids[row], app.uuid.uuid4().hex))
+
+    started = time.perf_counter()
+    for change_row in rows:
+        writer.submit(change_row)
+    submitted = time.perf_counter()
+    writer.flush()
+    flushed = time.perf_counter()
+    writer.stop()
+    return {
+        "changes": changes,
+        "submit_ms": (submitted - started) * 1000,
+        "flush_ms": (flushed - submitted) * 1000,
+        "changes_per_second": changes / max(flushed - started, 1e-9),
+    }
+
+
+def bench_save_changes(store, items, repeat, rng):
+    # The save path applies summed deltas per ItemName; alternate +1/-1 so quantities stay put
+    names = [store.name(rng.randrange(len(store.ids))) for _ in range(items)]
+    samples = []
+    for run in range(repeat):
+        sign = 1 if run % 2 == 0 else -1
+        deltas = {name: sign for name in names}
+        started = time.perf_counter()
+        app.apply_inventory_deltas(deltas, app.uuid.uuid4().hex)
+        samples.append((time.perf_counter() - started) * 1000)
+    if repeat % 2:
+        app.apply_inventory_deltas({name: -1 for name in names})
+    return summarize(samples)
+
+
+def bench_graphs(store, repeat, rng):
+    # Cold fetch (cache cleared), warm resample per tab and off-screen rendering with Agg
+    app.load_graph_modules()
+    items = [store.name(rng.randrange(len(store.ids))) for _ in range(GRAPH_SAMPLE_ITEMS)]
+    graph = app.UsageGraph(None)
+    cold, warm, render = [], [], []
+    for _ in range(repeat):
+        for name in items:
+            app.graph_cache.clear()
+            started = time.perf_counter()
+            app.fetch_daily_series(name)
+            cold.append((time.perf_counter() - started) * 1000)
+            for time_period in app.TAB_GRANULARITY:
+                started = time.perf_counter()
+                dates, quantities, stock = app.prepare_graph_data(name, time_period, current_quantity = store.quantity(store.row_for_name(name)))
+                warm.append((time.perf_counter() - started) * 1000)
+                started = time.perf_counter()
+                graph.show(time_period, dates, quantities, stock)
+                graph.canvas.draw()
+                render.append((time.perf_counter() - started) * 1000)
+
+    categories = sorted(store.by_category, key = str)[:5]
+    compare = []
+    for _ in range(repeat):
+        for category in categories:
+            names = [store.name(row) for row in store.rows_in_category(category)[:app.COMPARE_MAX_ITEMS]]
+            started = time.perf_counter()
+            app.fetch_comparison_series(names, "W")
+            compare.append((time.perf_counter() - started) * 1000)
+    return {
+        "graph_fetch_cold": summarize(cold),
+        "graph_resample_warm": summarize(warm),
+        "graph_render_agg": summarize(render),
+        "compare_category_weekly": summarize(compare),
+    }
+
+
+def run_benchmarks(args):
+    rng = random.Random(args.seed)
+    results = {}
+
+    print("Timing startup inventory load")
+    results["inventory_load"] = bench_inventory_load(args.repeat)
+
+    store = app.InventoryStore()
+    index = app.SearchIndex(store)
+    app.load_inventory(store, index)
+
+    print("Timing search")
+    results.update(bench_search(store, index, args.repeat, rng))
+    print("Timing graph queries")
+    results.update(bench_graphs(store, args.repeat, rng))
+    print("Timing save_changes")
+    results["save_changes_100_items"] = bench_save_changes(store, 100, args.repeat, rng)
+    print("Timing add/remove logging")
+    results["change_logging"] = bench_change_logging(store, args.log_changes, rng)
+    return results
+
+
+#### Comparing runs. ####
+def compare_results(previous, current, threshold = REGRESSION_THRESHOLD):
+    # Median (or throughput) ratio per benchmark; returns the names that got slower than threshold
+    regressions = []
+    for name, result in sorted(current["results"].items()):
+        before = previous["results"].get(name)
+        if before is None:
+            continue
+        if "median_ms" in result:
+            old, new = before["median_ms"], result["median_ms"]
+            slower = new / old - 1 if old else 0
+            print(f"{name:<28} {old:10.2f} ms -> {new:10.2f} ms  {slower:+.0%}")
+        else:
+            old, new = before["changes_per_second"], result["changes_per_second"]
+            slower = old / new - 1 if new else 0
+            print(f"{name:<28} {old:10.0f} /s -> {new:10.0f} /s  {new / old - 1 if old else 0:+.0%}")
+        if slower > threshold:
+            regressions.append(name)
+    if previous.get("meta", {}).get("dataset") != current["meta"]["dataset"]:
+        print("Warning: the runs used different dataset sizes")
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the inventory application on synthetic data")
+    parser.add_argument("--skus", type = int, default = 10000, help = "items in shop_inventory_count (1k to 1M)")
+    parser.add_argument("--changes", type = int, default = 100000, help = "rows in changes_log (up to 10M)")
+    parser.add_argument("--days", type = int, default = 730, help = "days of history the changes are spread over")
+    parser.add_argument("--seed", type = int, default = 1, help = "random seed for the data and the samples")
+    parser.add_argument("--reseed", action = "store_true", help = "rebuild the data even if it matches the requested sizes")
+    parser.add_argument("--repeat", type = int, default = 5, help = "runs per timed operation")
+    parser.add_argument("--log-changes", type = int, default = 5000, help = "changes written by the logging benchmark")
+    parser.add_argument("--database", default = BENCH_DB_NAME, help = "benchmark database name")
+    parser.add_argument("--output", default = "bench_results.json", help = "where to write the results")
+    parser.add_argument("--compare", help = "earlier results file to compare with")
+    parser.add_argument("--threshold", type = float, default = REGRESSION_THRESHOLD,
+                        help = "slowdown (0.2 = 20%%) that counts as a regression")
+    args = parser.parse_args(argv)
+
+    # Read the baseline first, --output may point at the same file
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+
+    use_bench_database(args.database)
+    dataset = (args.skus, args.changes, args.days, args.seed)
+    if args.reseed or current_seed() != dataset:
+        seed_database(*dataset)
+    else:
+        print("Reusing the seeded benchmark database")
+
+    results = run_benchmarks(args)
+    report = {
+        "meta": {
+            "started_at": datetime.now().isoformat(timespec = "seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": args.database,
+            "dataset": {"skus": args.skus, "changes": args.changes, "days": args.days, "seed": args.seed},
+            "repeat": args.repeat,
+        },
+        "results": results,
+        # Per-operation breakdown from the application's own timers (db.*, ui.*, scanner.*)
+        "operations": app.latency_stats.summary(),
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent = 2)
+    print(f"Results written to {args.output}")
+    app.close_db_pool()
+
+    if previous is not None:
+        regressions = compare_results(previous, report, args.threshold)
+        if regressions:
+            print("Regressions:", ", ".join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,34 +10,2748 @@ https://github.com/jcast6/Inventory-Control
 
 """
 
+import time
+# Reference point for the startup timing mode
+startup_started = time.perf_counter()
+
 import threading
 import tkinter as tk
 import tkinter.messagebox
 import mysql.connector
 from tkinter import ttk
-from PIL import Image, ImageTk
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import calendar
 from datetime import datetime, timedelta
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import cv2
-from pyzbar.pyzbar import decode
-import time
 import json
-
- # Tkinter backend is used for rendering
-matplotlib.use('TkAgg') 
+import os
+import queue
+import uuid
+import bisect
+import heapq
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from itertools import islice
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor, Future
+import concurrent.futures
+import mysql.connector.pooling
+import sys
+import socket
+import csv
+import math
+import functools
+
+# Heavy modules are imported on first use (see load_graph_modules / load_scanner_modules)
+# so the login window does not wait for them
+np = None
+mdates = None
+Figure = None
+FigureCanvasTkAgg = None
+cv2 = None
+decode = None
+heavy_import_lock = threading.RLock()
+
+# Print how long startup takes (INVENTORY_STARTUP_TIMING=1 or --startup-timing)
+STARTUP_TIMING = os.environ.get("INVENTORY_STARTUP_TIMING") == "1"
+startup_marks = []
+
+# Import matplotlib and OpenCV in the background after login (set to 0 to turn off)
+WARM_IMPORTS = os.environ.get("INVENTORY_WARM_IMPORTS", "1") != "0"
 
 # Global variable to store the current user's ID
 current_user_id = None
-graph_canvas = None
 
 # Global variables for images to prevent garbage collection
 global_button_images = {}
 
+#### Startup timing and lazy imports. ####
+def startup_mark(label):
+    # Record the time since the module started loading
+    elapsed_ms = (time.perf_counter() - startup_started) * 1000
+    startup_marks.append((label, elapsed_ms))
+    if STARTUP_TIMING:
+        print(f"startup: {label} after {elapsed_ms:.1f} ms")
+
+
+def load_numpy():
+    # NumPy is only needed for the graph resampling
+    global np
+    with heavy_import_lock:
+        if np is None:
+            import numpy as np
+
+
+def load_graph_modules():
+    # matplotlib is only needed once the first graph is drawn
+    global mdates, Figure, FigureCanvasTkAgg
+    with heavy_import_lock:
+        load_numpy()
+        if FigureCanvasTkAgg is None:
+            import matplotlib.dates as mdates
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            startup_mark("matplotlib loaded")
+
+
+def load_scanner_modules():
+    # OpenCV and pyzbar are only needed once the scanner is opened
+    global cv2, decode
+    with heavy_import_lock:
+        if decode is None:
+            import cv2
+            from pyzbar.pyzbar import decode
+            startup_mark("scanner modules loaded")
+
+
+def warm_heavy_modules():
+    # Runs on a background thread after login so the first graph / scan does not wait on imports
+    for loader in (load_graph_modules, load_scanner_modules):
+        try:
+            loader()
+        except Exception as e:
+            print("Could not preload modules:", e)
+
+
+#### Latency instrumentation. ####
+# Most recent samples kept per operation for the rolling percentiles
+LATENCY_WINDOW = int(os.environ.get("INVENTORY_LATENCY_WINDOW", "1000"))
+# Write the latency summary to this JSON file when the main window closes
+LATENCY_EXPORT = os.environ.get("INVENTORY_LATENCY_EXPORT")
+# Profile every Nth Tk handler call with cProfile (0 = off, 1 = every call)
+PROFILE_HANDLERS = int(os.environ.get("INVENTORY_PROFILE_HANDLERS", "0") or 0)
+# Where the collected profile is written when the main window closes
+PROFILE_OUTPUT = os.environ.get("INVENTORY_PROFILE_OUTPUT", "inventory_handlers.prof")
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an already sorted list
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+class LatencyStats:
+    # Rolling window of durations (ms) per operation name. Recording is a deque append
+    # under a lock, so it is cheap enough to leave on; percentiles are computed on demand.
+    def __init__(self, window = LATENCY_WINDOW):
+        self.window = window
+        self.samples = {}  # operation -> deque of the latest durations
+        self.calls = {}    # operation -> calls since start
+        self.lock = threading.Lock()
+
+    def record(self, operation, elapsed_ms):
+        with self.lock:
+            samples = self.samples.get(operation)
+            if samples is None:
+                samples = self.samples[operation] = deque(maxlen = self.window)
+                self.calls[operation] = 0
+            samples.append(elapsed_ms)
+            self.calls[operation] += 1
+
+    @contextmanager
+    def timer(self, operation):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(operation, (time.perf_counter() - started) * 1000)
+
+    def timed(self, operation):
+        # Decorator form of timer()
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(operation):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.calls.clear()
+
+    def summary(self):
+        # One dict per operation with the call count and the window's p50/p95/p99/max in ms
+        with self.lock:
+            snapshot = {operation: (self.calls[operation], sorted(samples)) for operation, samples in self.samples.items()}
+        rows = []
+        for operation, (calls, values) in sorted(snapshot.items()):
+            rows.append({
+                "operation": operation,
+                "calls": calls,
+                "samples": len(values),
+                "p50_ms": percentile(values, 0.50),
+                "p95_ms": percentile(values, 0.95),
+                "p99_ms": percentile(values, 0.99),
+                "max_ms": values[-1] if values else None,
+            })
+        return rows
+
+    def export_json(self, path):
+        with open(path, "w") as f:
+            json.dump({"exported_at": datetime.now().isoformat(timespec = "seconds"), "operations": self.summary()}, f, indent = 2)
+
+    def export_csv(self, path):
+        rows = self.summary()
+        with open(path, "w", newline = "") as f:
+            writer = csv.DictWriter(f, fieldnames = ["operation", "calls", "samples", "p50_ms", "p95_ms", "p99_ms", "max_ms"])
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+class HandlerProfiler:
+    # Samples Tk event handlers with cProfile: every Nth call of a wrapped handler runs
+    # under one shared profiler. Nested handlers (item_selected -> draw_graph) are only
+    # profiled at the outermost call.
+    def __init__(self, every = PROFILE_HANDLERS):
+        self.every = every
+        self.profile = None
+        self.call_count = 0
+        self.active = False
+
+    def call(self, func, *args, **kwargs):
+        if self.every <= 0 or self.active:
+            return func(*args, **kwargs)
+        self.call_count += 1
+        if self.call_count % self.every:
+            return func(*args, **kwargs)
+        if self.profile is None:
+            import cProfile
+            self.profile = cProfile.Profile()
+        self.active = True
+        self.profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.profile.disable()
+            self.active = False
+
+    def dump(self, path = PROFILE_OUTPUT):
+        if self.profile is not None:
+            self.profile.dump_stats(path)
+            print(f"Handler profile written to {path} (python -m pstats {path})")
+
+
+latency_stats = LatencyStats()
+handler_profiler = HandlerProfiler()
+
+
+def tk_handler(name):
+    # Time a Tk event handler as "ui.<name>" and let the profiler sample it
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with latency_stats.timer("ui." + name):
+                return handler_profiler.call(func, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Database connection settings shared by every query in the application
+DB_CONFIG = {
+    "host": os.environ.get("INVENTORY_DB_HOST", "localhost"),
+    "user": os.environ.get("INVENTORY_DB_USER", "root"),
+    "password": os.environ.get("INVENTORY_DB_PASSWORD", "peter"),
+    "database": os.environ.get("INVENTORY_DB_NAME", "shop_inventory"),
+}
+
+# Number of connections kept open in the pool (scanner, UI and logging share them)
+DB_POOL_SIZE = int(os.environ.get("INVENTORY_DB_POOL_SIZE", "5"))
+# How long to wait for a free pooled connection before giving up (seconds)
+DB_POOL_TIMEOUT = float(os.environ.get("INVENTORY_DB_POOL_TIMEOUT", "10"))
+
+# Shared connection pool, created on first use
+db_pool = None
+# One slot per pooled connection; borrowers wait on it for a free connection
+db_pool_slots = None
+db_pool_lock = threading.Lock()
+
+
+#### Pooled data access. ####
+def get_db_pool():
+    # Returns (pool, slots)
+    global db_pool, db_pool_slots
+    with db_pool_lock:
+        if db_pool is None:
+            db_pool = mysql.connector.pooling.MySQLConnectionPool(
+                pool_name = "inventory_pool",
+                pool_size = DB_POOL_SIZE,
+                pool_reset_session = True,
+                **DB_CONFIG
+            )
+            db_pool_slots = threading.BoundedSemaphore(DB_POOL_SIZE)
+        return db_pool, db_pool_slots
+
+
+@contextmanager
+def db_connection(operation = "other"):
+    # Borrow a connection from the pool, waiting briefly if every connection is in use.
+    # The wait and the time the connection is held are recorded as db.pool_wait / db.<operation>.
+    started = time.perf_counter()
+    pool, slots = get_db_pool()
+    # Holding a slot means the pool has a connection for us
+    if not slots.acquire(timeout = DB_POOL_TIMEOUT):
+        raise mysql.connector.errors.PoolError(f"no free database connection within {DB_POOL_TIMEOUT:g} s")
+    try:
+        db = pool.get_connection()
+    except Exception:
+        slots.release()
+        raise
+
+    acquired = time.perf_counter()
+    latency_stats.record("db.pool_wait", (acquired - started) * 1000)
+    try:
+        # Health check: reconnect if the server dropped the idle connection
+        db.ping(reconnect = True, attempts = 2, delay = 0)
+        yield db
+    finally:
+        # Closing a pooled connection hands it back to the pool
+        try:
+            db.close()
+        finally:
+            slots.release()
+            latency_stats.record("db." + operation, (time.perf_counter() - acquired) * 1000)
+
+
+@contextmanager
+def unpooled_db_connection(operation = "other"):
+    # A connection of its own for long streaming reads that may be abandoned part way.
+    # Closing it drops the socket, so the server stops sending and rows left unread are
+    # never drained or handed back to the pool with the next borrower.
+    started = time.perf_counter()
+    db = mysql.connector.connect(**DB_CONFIG)
+    try:
+        yield db
+    finally:
+        try:
+            db.close()
+        except mysql.connector.Error:
+            pass
+        latency_stats.record("db." + operation, (time.perf_counter() - started) * 1000)
+
+
+def _close_pool_connections(pool, slots):
+    # Take every idle connection out of the pool and disconnect it. Connections still
+    # borrowed by another thread, or left after the server went away, close at process exit.
+    for _ in range(DB_POOL_SIZE):
+        if not slots.acquire(blocking = False):
+            break
+        try:
+            db = pool.get_connection()
+        except mysql.connector.Error:
+            break
+        try:
+            db.disconnect()
+        except mysql.connector.Error:
+            pass
+
+
+def close_db_pool():
+    global db_pool, db_pool_slots
+    with db_pool_lock:
+        if db_pool is not None:
+            _close_pool_connections(db_pool, db_pool_slots)
+            db_pool = None
+            db_pool_slots = None
+
+
+#### Inventory service client. ####
+# host:port of a shared inventory_service.py; when set the station talks to it instead of MySQL
+SERVICE_ADDRESS = os.environ.get("INVENTORY_SERVICE")
+# Shared secret checked by the service on every request (optional)
+SERVICE_TOKEN = os.environ.get("INVENTORY_SERVICE_TOKEN")
+# Seconds to wait for a reply from the service
+SERVICE_TIMEOUT = float(os.environ.get("INVENTORY_SERVICE_TIMEOUT", "30"))
+
+
+class ServiceUnavailable(ConnectionError):
+    # The service, or the database behind it, could not be reached; writes can wait in the outbox
+    pass
+
+
+class ServiceError(Exception):
+    # The service ran the request and it failed
+    pass
+
+
+def encode_json_value(value):
+    # Dates and datetimes travel as ISO strings
+    return value.isoformat()
+
+
+def decode_change_row(payload):
+    # A changes_log row read back from JSON (outbox or service request)
+    payload = list(payload)
+    payload[4] = datetime.strptime(payload[4], "%Y-%m-%d").date()
+    payload[5] = datetime.fromisoformat(payload[5])
+    return tuple(payload)
+
+
+class InventoryServiceClient:
+    # One TCP connection to the inventory service speaking JSON lines. Calls can come from
+    # any thread: each request carries an id and a reader thread hands every reply to the
+    # caller waiting for it, so a slow graph query does not hold up a scan lookup.
+    # A dropped connection fails the waiting calls and is reopened by the next call.
+    def __init__(self, address, token = SERVICE_TOKEN, timeout = SERVICE_TIMEOUT):
+        host, _, port = address.rpartition(":")
+        self.address = (host or "localhost", int(port))
+        self.token = token
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.sock = None
+        self.waiting = {}  # request id -> Future
+        self.next_id = 0
+
+    def _connect(self):
+        # Called with self.lock held
+        try:
+            sock = socket.create_connection(self.address, timeout = self.timeout)
+        except OSError as e:
+            raise ServiceUnavailable(f"inventory service at {self.address[0]}:{self.address[1]} is unreachable: {e}")
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        threading.Thread(target = self._read_replies, args = (sock,), name = "service-reader", daemon = True).start()
+
+    def _read_replies(self, sock):
+        try:
+            with sock.makefile("rb") as replies:
+                for line in replies:
+                    reply = json.loads(line)
+                    with self.lock:
+                        future = self.waiting.pop(reply.get("id"), None)
+                    if future is not None:
+                        future.set_result(reply)
+        except (OSError, ValueError) as e:
+            print("Inventory service connection lost:", e)
+        finally:
+            self._drop(sock)
+
+    def _drop(self, sock):
+        # Fail every call still waiting on this connection
+        with self.lock:
+            if self.sock is not sock:
+                return
+            self.sock = None
+            waiting, self.waiting = self.waiting, {}
+        try:
+            sock.close()
+        except OSError:
+            pass
+        for future in waiting.values():
+            future.set_exception(ServiceUnavailable("the connection to the inventory service was lost"))
+
+    def call(self, op, **args):
+        request = {"op": op, "args": args}
+        if self.token:
+            request["token"] = self.token
+        future = Future()
+        with latency_stats.timer("service." + op):
+            with self.lock:
+                if self.sock is None:
+                    self._connect()
+                sock = self.sock
+                self.next_id += 1
+                request["id"] = self.next_id
+                self.waiting[request["id"]] = future
+                try:
+                    sock.sendall((json.dumps(request, default = encode_json_value) + "\n").encode())
+                except OSError as e:
+                    self.waiting.pop(request["id"], None)
+                    send_error = e
+                else:
+                    send_error = None
+            if send_error is not None:
+                self._drop(sock)
+                raise ServiceUnavailable(f"could not send to the inventory service: {send_error}")
+            try:
+                reply = future.result(self.timeout)
+            except concurrent.futures.TimeoutError:
+                with self.lock:
+                    self.waiting.pop(request["id"], None)
+                raise ServiceUnavailable(f"the inventory service did not answer {op} within {self.timeout:g} s")
+        if "error" in reply:
+            if reply.get("unavailable"):
+                raise ServiceUnavailable(reply["error"])
+            raise ServiceError(reply["error"])
+        return reply["result"]
+
+    def close(self):
+        with self.lock:
+            sock = self.sock
+        if sock is not None:
+            self._drop(sock)
+
+
+# Set by main() in remote mode; the data functions below use it instead of db_connection
+inventory_service = None
+
+
+#### Schema migrations. ####
+def create_index(table, index_name, columns, unique = False):
+    # Migration step that creates an index unless it already exists (e.g. added by hand)
+    def step(db, cursor):
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s",
+            (table, index_name)
+        )
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX {index_name} ON {table} ({columns})")
+    return step
+
+
+def add_column(table, column, definition):
+    # Migration step that adds a column unless it already exists
+    def step(db, cursor):
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.COLUMNS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s",
+            (table, column)
+        )
+        if cursor.fetchone()[0] == 0:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+
+#### changes_log partitions. ####
+# Monthly partitions created ahead of the current month
+PARTITION_AHEAD_MONTHS = 3
+# Months of raw changes kept in changes_log; older partitions move to changes_log_archive (0 keeps everything)
+CHANGES_LOG_RETENTION_MONTHS = int(os.environ.get("INVENTORY_CHANGES_RETENTION_MONTHS", "24"))
+
+
+def month_start(day, months = 0):
+    # First day of the month `months` away from day's month
+    index = day.year * 12 + day.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1).date()
+
+
+def partition_name(start):
+    return f"p{start.year}{start.month:02d}"
+
+
+def monthly_partitions(first, last):
+    # "PARTITION pYYYYMM VALUES LESS THAN ('next month')" for every month from first to last
+    definitions = []
+    start = month_start(first)
+    while start <= last:
+        definitions.append(f"PARTITION {partition_name(start)} VALUES LESS THAN ('{month_start(start, 1)}')")
+        start = month_start(start, 1)
+    return definitions
+
+
+def changes_log_partitions(cursor):
+    # [(name, upper bound date or None for MAXVALUE)] in order; empty if not partitioned
+    cursor.execute(
+        "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'changes_log' AND PARTITION_NAME IS NOT NULL "
+        "ORDER BY PARTITION_ORDINAL_POSITION"
+    )
+    partitions = []
+    for name, description in cursor.fetchall():
+        bound = None if description == "MAXVALUE" else datetime.strptime(description.strip("'"), "%Y-%m-%d").date()
+        partitions.append((name, bound))
+    return partitions
+
+
+def partition_changes_log(db, cursor):
+    # Migration step: RANGE COLUMNS(change_date) with one partition per month so inserts
+    # land in a small current partition, date-filtered reads prune old months and old
+    # months can be archived by dropping whole partitions. Rebuilds the table once.
+    if changes_log_partitions(cursor):
+        return
+
+    # Every unique key of a partitioned table has to contain the partitioning column
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'changes_log' AND INDEX_NAME = 'PRIMARY' "
+        "ORDER BY SEQ_IN_INDEX"
+    )
+    primary_key = [column for (column,) in cursor.fetchall()]
+    if primary_key and "change_date" not in primary_key:
+        columns = ", ".join(primary_key + ["change_date"])
+        cursor.execute(f"ALTER TABLE changes_log DROP PRIMARY KEY, ADD PRIMARY KEY ({columns})")
+
+    today = datetime.now().date()
+    cursor.execute("SELECT MIN(change_date) FROM changes_log")
+    first_day = cursor.fetchone()[0] or today
+    definitions = monthly_partitions(first_day, month_start(today, PARTITION_AHEAD_MONTHS))
+    definitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+    cursor.execute(f"ALTER TABLE changes_log PARTITION BY RANGE COLUMNS(change_date) ({', '.join(definitions)})")
+
+
+def create_changes_archive(db, cursor):
+    # Migration step: compressed, unpartitioned copy of changes_log's layout for archived months
+    cursor.execute("CREATE TABLE IF NOT EXISTS changes_log_archive LIKE changes_log")
+    cursor.execute("ALTER TABLE changes_log_archive REMOVE PARTITIONING")
+    cursor.execute("ALTER TABLE changes_log_archive ROW_FORMAT = COMPRESSED")
+
+
+def maintain_partitions(ahead = PARTITION_AHEAD_MONTHS, retention_months = CHANGES_LOG_RETENTION_MONTHS, archive = True, today = None, first = None):
+    # Pre-create the monthly partitions up to `ahead` months out by splitting pmax, and with
+    # archive move every month older than the retention window into changes_log_archive
+    # and drop its partition. With first, also split the lowest partition into monthly ones
+    # back to first's month (for loading history older than the table's partitions).
+    # Safe to re-run. Returns (created, archived) partition names.
+    today = today or datetime.now().date()
+    created, archived = [], []
+    with db_connection("partition_maintenance") as db:
+        cursor = db.cursor()
+        try:
+            partitions = changes_log_partitions(cursor)
+            if not partitions:
+                print("changes_log is not partitioned, run 'python inven_control.py migrate'")
+                return created, archived
+
+            # Older months come out of the lowest partition, which holds everything below its bound
+            lowest_name, lowest_bound = partitions[0]
+            if first is not None and lowest_bound is not None:
+                definitions = monthly_partitions(first, month_start(lowest_bound, -1))
+                if len(definitions) > 1:
+                    cursor.execute(f"ALTER TABLE changes_log REORGANIZE PARTITION {lowest_name} INTO ({', '.join(definitions)})")
+                    created.extend(definition.split()[1] for definition in definitions[:-1])
+                    partitions = changes_log_partitions(cursor)
+
+            # New months come out of the catch-all pmax partition (empty in normal use)
+            bounds = [bound for _, bound in partitions if bound is not None]
+            next_month = max(bounds) if bounds else month_start(today)
+            definitions = monthly_partitions(next_month, month_start(today, ahead))
+            if definitions:
+                definitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+                cursor.execute(f"ALTER TABLE changes_log REORGANIZE PARTITION pmax INTO ({', '.join(definitions)})")
+                created.extend(definition.split()[1] for definition in definitions[:-1])
+
+            if archive and retention_months > 0:
+                cutoff = month_start(today, -retention_months)
+                cursor.execute(
+                    "SELECT COLUMN_NAME FROM information_schema.COLUMNS "
+                    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'changes_log_archive' ORDER BY ORDINAL_POSITION"
+                )
+                columns = ", ".join(column for (column,) in cursor.fetchall())
+                # End the implicit transaction the reads above opened so start_transaction() can begin a fresh one
+                db.commit()
+                for name, bound in partitions:
+                    if bound is None or bound > cutoff:
+                        continue
+                    # Copy first, then drop; IGNORE makes a re-run after a failed drop harmless
+                    db.start_transaction()
+                    cursor.execute(f"INSERT IGNORE INTO changes_log_archive ({columns}) SELECT {columns} FROM changes_log PARTITION ({name})")
+                    db.commit()
+                    cursor.execute(f"ALTER TABLE changes_log DROP PARTITION {name}")
+                    archived.append(name)
+        finally:
+            cursor.close()
+    return created, archived
+
+
+# (version, description, steps); a step is an SQL string or a callable taking (db, cursor).
+# Append new migrations at the end and never change one that has shipped.
+SCHEMA_MIGRATIONS = [
+    (1, "Index changes_log by item and date, shop_inventory_count by random_id and ItemName", [
+        create_index("changes_log", "idx_changes_log_item_date", "item_name, change_date"),
+        create_index("shop_inventory_count", "idx_inventory_random_id", "random_id"),
+        create_index("shop_inventory_count", "idx_inventory_item_name", "ItemName"),
+    ]),
+    (2, "Daily usage rollup table for the graphs", [
+        "CREATE TABLE IF NOT EXISTS changes_daily_rollup ("
+        "item_name VARCHAR(255) NOT NULL, "
+        "day DATE NOT NULL, "
+        "total_change DOUBLE NOT NULL DEFAULT 0, "
+        "change_count INT NOT NULL DEFAULT 0, "
+        "min_quantity DOUBLE NULL, "
+        "max_quantity DOUBLE NULL, "
+        "PRIMARY KEY (item_name, day), "
+        "KEY idx_rollup_day (day))",
+        create_index("changes_log", "idx_changes_log_date", "change_date"),
+        lambda db, cursor: backfill_daily_rollup(db = db, cursor = cursor),
+    ]),
+    (3, "Track when inventory rows change so stations can sync deltas", [
+        add_column("shop_inventory_count", "last_modified",
+                   "TIMESTAMP(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)"),
+        create_index("shop_inventory_count", "idx_inventory_last_modified", "last_modified"),
+    ]),
+    (4, "Partition changes_log by month and add the compressed changes_log_archive table", [
+        partition_changes_log,
+        create_changes_archive,
+    ]),
+    (5, "Idempotency keys so changes and deltas replayed from a station's outbox apply once", [
+        add_column("changes_log", "idempotency_key", "CHAR(32) NULL"),
+        add_column("changes_log_archive", "idempotency_key", "CHAR(32) NULL"),
+        # Unique keys of a partitioned table must contain change_date
+        create_index("changes_log", "uq_changes_log_idempotency", "idempotency_key, change_date", unique = True),
+        "CREATE TABLE IF NOT EXISTS applied_deltas ("
+        "idempotency_key CHAR(32) NOT NULL PRIMARY KEY, "
+        "applied_at DATETIME NOT NULL, "
+        "KEY idx_applied_deltas_applied_at (applied_at))",
+    ]),
+    (6, "Index the (last_modified, random_id) cursor of the inventory delta sync", [
+        create_index("shop_inventory_count", "idx_inventory_sync_cursor", "last_modified, random_id"),
+    ]),
+]
+
+
+def pending_migrations():
+    # Versions in SCHEMA_MIGRATIONS that have not been applied to this database
+    with db_connection("migrations_check") as db:
+        cursor = db.cursor()
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.TABLES "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'schema_migrations'"
+        )
+        applied = set()
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied = {version for (version,) in cursor.fetchall()}
+        cursor.close()
+    return [version for version, _, _ in SCHEMA_MIGRATIONS if version not in applied]
+
+
+# Seconds run_migrations waits for another process migrating the same database
+MIGRATION_LOCK_TIMEOUT = 600
+
+
+def run_migrations():
+    # Apply every migration that is not recorded in schema_migrations yet, oldest first.
+    # A named server lock keeps two processes from running the same DDL at once; the
+    # applied versions are read only once it is held, so the second one skips their work.
+    applied_now = []
+    with db_connection("migrations") as db:
+        cursor = db.cursor()
+        cursor.execute("SELECT GET_LOCK('inventory_migrations', %s)", (MIGRATION_LOCK_TIMEOUT,))
+        if cursor.fetchone()[0] != 1:
+            cursor.close()
+            raise RuntimeError("another process is applying schema migrations, try again once it has finished")
+        try:
+            cursor.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version INT NOT NULL PRIMARY KEY, "
+                "description VARCHAR(255) NOT NULL, "
+                "applied_at DATETIME NOT NULL)"
+            )
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied = {version for (version,) in cursor.fetchall()}
+
+            for version, description, steps in SCHEMA_MIGRATIONS:
+                if version in applied:
+                    continue
+                print(f"Applying migration {version}: {description}")
+                for step in steps:
+                    if callable(step):
+                        step(db, cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, description, applied_at) VALUES (%s, %s, %s)",
+                    (version, description, datetime.now())
+                )
+                db.commit()
+                applied_now.append(version)
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK('inventory_migrations')")
+            cursor.fetchone()
+            db.commit()
+            cursor.close()
+    return applied_now
+
+
+#### Write-behind change logging. ####
+# Flush the pending change rows once this many are waiting...
+CHANGE_LOG_BATCH_SIZE = int(os.environ.get("INVENTORY_CHANGE_LOG_BATCH_SIZE", "50"))
+# ...or once the oldest pending row has waited this long (seconds)
+CHANGE_LOG_FLUSH_INTERVAL = float(os.environ.get("INVENTORY_CHANGE_LOG_FLUSH_INTERVAL", "2.0"))
+
+CHANGES_LOG_INSERT = "INSERT INTO changes_log(item_name, original_quantity, new_quantity, quantity_change, change_date, change_time, emp_id, random_id, idempotency_key) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"
+
+# Idempotency keys checked per SELECT before inserting a batch
+IDEMPOTENCY_LOOKUP_CHUNK = 1000
+
+ROLLUP_UPSERT = (
+    "INSERT INTO changes_daily_rollup (item_name, day, total_change, change_count, min_quantity, max_quantity) "
+    "VALUES (%s, %s, %s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE "
+    "total_change = total_change + VALUES(total_change), "
+    "change_count = change_count + VALUES(change_count), "
+    "min_quantity = LEAST(COALESCE(min_quantity, VALUES(min_quantity)), VALUES(min_quantity)), "
+    "max_quantity = GREATEST(COALESCE(max_quantity, VALUES(max_quantity)), VALUES(max_quantity))"
+)
+
+
+def _write_change_rows(cursor, rows):
+    # Insert change rows into changes_log and fold them into changes_daily_rollup.
+    # Runs on the caller's cursor so both land in the caller's transaction.
+    # The last column is the idempotency key (None skips the check): rows whose key is
+    # already logged, e.g. a retry after the commit went through but the reply was lost,
+    # are dropped so neither changes_log nor the rollup counts them twice.
+    # Returns the number of rows written.
+    keyed = [row for row in rows if row[-1] is not None]
+    if keyed:
+        first_day = min(row[4] for row in keyed)
+        keys = [row[-1] for row in keyed]
+        existing = set()
+        for start in range(0, len(keys), IDEMPOTENCY_LOOKUP_CHUNK):
+            chunk = keys[start:start + IDEMPOTENCY_LOOKUP_CHUNK]
+            cursor.execute(
+                f"SELECT idempotency_key FROM changes_log WHERE idempotency_key IN ({', '.join(['%s'] * len(chunk))}) "
+                "AND change_date >= %s",
+                (*chunk, first_day)
+            )
+            existing.update(key for (key,) in cursor.fetchall())
+        if existing:
+            rows = [row for row in rows if row[-1] not in existing]
+    if not rows:
+        return 0
+
+    cursor.executemany(CHANGES_LOG_INSERT, rows)
+
+    # Pre-aggregate the batch per (item, day) so the rollup gets one upsert per pair
+    daily = {}
+    for item_name, original_quantity, new_quantity, quantity_change, change_date, *_ in rows:
+        low, high = min(original_quantity, new_quantity), max(original_quantity, new_quantity)
+        entry = daily.get((item_name, change_date))
+        if entry is None:
+            daily[(item_name, change_date)] = [quantity_change, 1, low, high]
+        else:
+            entry[0] += quantity_change
+            entry[1] += 1
+            entry[2] = min(entry[2], low)
+            entry[3] = max(entry[3], high)
+    cursor.executemany(ROLLUP_UPSERT, [(item_name, day, *entry) for (item_name, day), entry in daily.items()])
+    return len(rows)
+
+
+# Days of changes_log rebuilt per transaction by backfill_daily_rollup
+ROLLUP_BACKFILL_CHUNK_DAYS = 31
+
+
+def backfill_daily_rollup(chunk_days = ROLLUP_BACKFILL_CHUNK_DAYS, db = None, cursor = None):
+    # Rebuild changes_daily_rollup from changes_log, one date range per transaction so
+    # years of history never sit in one huge transaction
+    if db is None:
+        with db_connection("rollup_backfill") as db:
+            cursor = db.cursor()
+            try:
+                return backfill_daily_rollup(chunk_days, db, cursor)
+            finally:
+                cursor.close()
+
+    cursor.execute("SELECT MIN(change_date), MAX(change_date) FROM changes_log")
+    first_day, last_day = cursor.fetchone()
+    # Autocommit is off, so the read left a transaction open; end it so each chunk can start its own
+    db.commit()
+    if first_day is None:
+        return 0
+
+    chunks = 0
+    chunk_start = first_day
+    while chunk_start <= last_day:
+        chunk_end = chunk_start + timedelta(days = chunk_days)
+        try:
+            db.start_transaction()
+            cursor.execute("DELETE FROM changes_daily_rollup WHERE day >= %s AND day < %s", (chunk_start, chunk_end))
+            cursor.execute(
+                "INSERT INTO changes_daily_rollup (item_name, day, total_change, change_count, min_quantity, max_quantity) "
+                "SELECT item_name, change_date, SUM(quantity_change), COUNT(*), "
+                "MIN(LEAST(original_quantity, new_quantity)), MAX(GREATEST(original_quantity, new_quantity)) "
+                "FROM changes_log WHERE change_date >= %s AND change_date < %s "
+                "GROUP BY item_name, change_date",
+                (chunk_start, chunk_end)
+            )
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        chunks += 1
+        print(f"Rolled up changes from {chunk_start} to {chunk_end - timedelta(days = 1)}")
+        chunk_start = chunk_end
+    return chunks
+
+
+class ChangeLogWriter:
+    # The UI thread only puts change rows on a queue. A background thread collects them
+    # and writes each batch to changes_log with executemany inside a single transaction.
+    # Pending rows are keyed on their idempotency key (the last column), so a row that is
+    # submitted again, or resent from the outbox while still pending, is only written once.
+    # With an outbox (LocalMirror) every row is also kept on disk until the server has it,
+    # and rows left over from an earlier session are sent again on start.
+    def __init__(self, batch_size = CHANGE_LOG_BATCH_SIZE, flush_interval = CHANGE_LOG_FLUSH_INTERVAL, outbox = None):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.outbox = outbox
+        self.events = queue.Queue()
+        self.pending = {}  # idempotency key -> row, keeps insertion order
+        self.pending_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        # Callables run with the list of rows after each successful batch
+        self.listeners = []
+        # Why the last batch could not be written (None after a success or while the server is unreachable)
+        self.error = None
+
+    def start(self):
+        if self.thread is None:
+            if self.outbox is not None:
+                leftover = self.outbox.pending("change")
+                if leftover:
+                    print(f"Resending {len(leftover)} change log rows from the local outbox")
+                with self.pending_lock:
+                    for idempotency_key, row in leftover:
+                        self.pending.setdefault(idempotency_key, row)
+            self.stop_event.clear()
+            self.thread = threading.Thread(target = self._run, name = "change-log-writer", daemon = True)
+            self.thread.start()
+
+    def submit(self, row):
+        # Never blocks, safe to call from the Tk mainloop. The row's last column is its
+        # idempotency key and must be set.
+        if row[-1] is None:
+            raise ValueError("change log rows need an idempotency key")
+        self.events.put(row)
+
+    def _drain(self, timeout = None):
+        # Move queued events into the pending batch, waiting up to timeout for the first one
+        try:
+            events = [self.events.get(timeout = timeout) if timeout else self.events.get_nowait()]
+        except queue.Empty:
+            return
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except queue.Empty:
+                break
+        if self.outbox is not None:
+            try:
+                self.outbox.enqueue("change", [(row[-1], row) for row in events])
+            except Exception as e:
+                print("Could not save change log rows to the local outbox:", e)
+        with self.pending_lock:
+            for row in events:
+                self.pending.setdefault(row[-1], row)
+
+    def _run(self):
+        oldest = None
+        while not self.stop_event.is_set():
+            wait = self.flush_interval if oldest is None else max(0.01, self.flush_interval - (time.monotonic() - oldest))
+            self._drain(timeout = min(wait, 0.5))
+
+            with self.pending_lock:
+                pending_count = len(self.pending)
+            if not pending_count:
+                oldest = None
+                continue
+            if oldest is None:
+                oldest = time.monotonic()
+
+            if pending_count >= self.batch_size or time.monotonic() - oldest >= self.flush_interval:
+                if self.flush():
+                    oldest = None
+                else:
+                    # Back off before retrying a failed batch
+                    oldest = time.monotonic()
+
+    def flush(self):
+        # Write everything that is pending; returns the number of rows written
+        with self.flush_lock:
+            self._drain()
+            with self.pending_lock:
+                batch = list(self.pending.items())
+            if not batch:
+                return 0
+
+            try:
+                if inventory_service is not None:
+                    inventory_service.call("log_changes", rows = [row for _, row in batch])
+                else:
+                    with db_connection("changes_log_flush") as db:
+                        cursor = db.cursor()
+                        try:
+                            db.start_transaction()
+                            _write_change_rows(cursor, [row for _, row in batch])
+                            db.commit()
+                        except Exception:
+                            db.rollback()
+                            raise
+                        finally:
+                            cursor.close()
+            except Exception as e:
+                # Keep the rows pending so the next flush retries them
+                print("Failed to write change log batch, will retry:", e)
+                self.error = None if is_connection_error(e) else str(e)
+                return 0
+
+            self.error = None
+            with self.pending_lock:
+                for idempotency_key, _ in batch:
+                    self.pending.pop(idempotency_key, None)
+            if self.outbox is not None:
+                self.outbox.remove([idempotency_key for idempotency_key, _ in batch])
+
+            rows = [row for _, row in batch]
+            for listener in self.listeners:
+                try:
+                    listener(rows)
+                except Exception as e:
+                    print("Change log listener failed:", e)
+            return len(batch)
+
+    def stop(self, timeout = 10):
+        # Stop the background thread and write out whatever is still pending
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+        self.flush()
+        with self.pending_lock:
+            if self.pending:
+                if self.outbox is not None:
+                    print(f"{len(self.pending)} change log rows are kept in the local outbox and will be sent next time")
+                else:
+                    print(f"{len(self.pending)} change log rows could not be written")
+
+
+# Shared write-behind logger for changes_log
+change_log_writer = ChangeLogWriter()
+
+
+#### Graph query cache. ####
+# Most graph query results kept in memory
+GRAPH_CACHE_SIZE = int(os.environ.get("INVENTORY_GRAPH_CACHE_SIZE", "128"))
+# Seconds before a cached graph result is fetched again
+GRAPH_CACHE_TTL = float(os.environ.get("INVENTORY_GRAPH_CACHE_TTL", "300"))
+
+
+class GraphCache:
+    # LRU cache with a time-to-live for graph query results. Keys are tuples
+    # starting with the item name so every entry of an item can be dropped at once.
+    def __init__(self, maxsize = GRAPH_CACHE_SIZE, ttl = GRAPH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (stored_at, value)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.monotonic() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+
+    def invalidate_items(self, item_names):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] in item_names]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Shared cache for draw_graph; a logged change drops that item's entries, both when
+# it is queued and again once it is written so no stale result can be cached in between
+graph_cache = GraphCache()
+change_log_writer.listeners.append(lambda rows: graph_cache.invalidate_items({row[0] for row in rows}))
+
+
+def month_date_range(selected_month, today = None):
+    # Half-open [start, end) range for the most recent occurrence of a month name
+    today = today or datetime.now().date()
+    month_number = datetime.strptime(selected_month, '%B').month
+    year = today.year if month_number <= today.month else today.year - 1
+    start = datetime(year, month_number, 1).date()
+    end = datetime(year + 1, 1, 1).date() if month_number == 12 else datetime(year, month_number + 1, 1).date()
+    return start, end
+
+
+def build_daily_series_query(item_name, start = None, end = None):
+    # Graphs read the pre-aggregated daily rollup, so the cost depends on the days shown,
+    # not on the number of raw changes. Filters use the (item_name, day) primary key.
+    base_query = "SELECT day, total_change FROM changes_daily_rollup WHERE item_name = %s"
+    params = [item_name]
+    if start is not None:
+        # Half-open date range, no function on the column
+        base_query += " AND day >= %s AND day < %s"
+        params.extend([start, end])
+    base_query += " ORDER BY day"
+    return base_query, tuple(params)
+
+
+def fetch_daily_series(item_name):
+    # The item's whole daily history as (days, totals) NumPy arrays, fetched once and kept
+    # in graph_cache. Tabs and months are cut from it in memory by resample_usage.
+    cache_key = (item_name, "daily series")
+    series = graph_cache.get(cache_key)
+    if series is not None:
+        return series
+
+    if inventory_service is not None:
+        # [(ISO day, total)] from the service's shared cache
+        data = inventory_service.call("daily_series", item_name = item_name)
+    else:
+        base_query, params = build_daily_series_query(item_name)
+
+        # Execute the query on a pooled connection and fetch the data
+        with db_connection("daily_series") as db:
+            cursor = db.cursor()
+            cursor.execute(base_query, params)
+            data = cursor.fetchall()
+            cursor.close()
+
+    load_numpy()
+    days = np.array([day for day, _ in data if day is not None], dtype = 'datetime64[D]')
+    totals = np.array([total for day, total in data if day is not None], dtype = float)
+    series = (days, totals)
+    graph_cache.put(cache_key, series)
+    return series
+
+
+def explain_graph_queries(item_name = None):
+    # EXPLAIN each graph query and report which index MySQL picks for it
+    range_start, range_end = month_date_range(datetime.now().strftime('%B'))
+    checks = [
+        ("daily, all history", None, None),
+        ("daily, one month", range_start, range_end),
+    ]
+    report = []
+    with db_connection("explain") as db:
+        cursor = db.cursor(dictionary = True)
+        if item_name is None:
+            cursor.execute("SELECT item_name FROM changes_daily_rollup LIMIT 1")
+            row = cursor.fetchone()
+            item_name = row["item_name"] if row else ""
+        for label, start, end in checks:
+            query, params = build_daily_series_query(item_name, start, end)
+            cursor.execute("EXPLAIN " + query, params)
+            plan = cursor.fetchall()
+            key = plan[0].get("key") if plan else None
+            report.append((label, key, plan[0].get("rows") if plan else None, key == "PRIMARY"))
+        cursor.close()
+    return report
+
+
+# Notebook tab -> resampling granularity
+TAB_GRANULARITY = {
+    "Daily Usage": "D",
+    "Weekly Usage": "W",
+    "Monthly Usage": "M",
+}
+
+
+def period_starts(days, granularity):
+    # First day of the day / ISO week / month each datetime64[D] value falls in
+    if granularity == "W":
+        # 1970-01-01 was a Thursday, so (day + 3) % 7 is the ISO weekday counted from Monday
+        return days - ((days.astype('int64') + 3) % 7).astype('timedelta64[D]')
+    if granularity == "M":
+        return days.astype('datetime64[M]').astype('datetime64[D]')
+    return days
+
+
+def resample_usage(days, totals, current_quantity, granularity, start = None, end = None):
+    # Vectorized resampling of one item's daily totals. The series is zero-filled over
+    # every calendar day, running stock levels are worked back from the current quantity,
+    # then the [start, end) window is cut out and summed per day, ISO week or month.
+    # Returns (period starts, totals per period, stock level at the end of each period).
+    if not len(days):
+        return np.array([], dtype = 'datetime64[D]'), np.array([]), np.array([])
+
+    calendar = np.arange(days[0], days[-1] + np.timedelta64(1, 'D'), dtype = 'datetime64[D]')
+    filled = np.zeros(len(calendar))
+    np.add.at(filled, (days - days[0]).astype(int), totals)
+
+    # Stock after each day = current quantity minus everything that changed afterwards
+    running = np.cumsum(filled)
+    stock = np.nan if current_quantity is None else current_quantity - (running[-1] - running)
+    stock = np.broadcast_to(stock, filled.shape)
+
+    if start is not None:
+        window = (calendar >= np.datetime64(start, 'D')) & (calendar < np.datetime64(end, 'D'))
+        calendar, filled, stock = calendar[window], filled[window], stock[window]
+        if not len(calendar):
+            return calendar, filled, stock
+
+    periods, inverse = np.unique(period_starts(calendar, granularity), return_inverse = True)
+    period_totals = np.bincount(inverse, weights = filled, minlength = len(periods))
+    # calendar is sorted, so the last day of each period is where inverse steps up
+    last_days = np.append(np.flatnonzero(np.diff(inverse)), len(inverse) - 1)
+    return periods, period_totals, stock[last_days]
+
+
+def prepare_graph_data(item_name, time_period, selected_month = None, current_quantity = None):
+    # Query (or cache hit) plus resampling; no Tk or matplotlib calls so it can run on a worker thread
+    days, totals = fetch_daily_series(item_name)
+
+    start = end = None
+    if selected_month and selected_month != 'All Months':
+        start, end = month_date_range(selected_month)
+
+    periods, period_totals, stock = resample_usage(days, totals, current_quantity, TAB_GRANULARITY.get(time_period, "D"), start, end)
+    # matplotlib and the tick logic work with datetime.date objects
+    return periods.astype(object).tolist(), period_totals, stock
+
+
+#### Multi-item comparison. ####
+# Most items drawn in one comparison graph
+COMPARE_MAX_ITEMS = 50
+
+
+def fetch_comparison_rows(item_names, start = None, end = None):
+    # (item_name, day, total_change) rollup rows of every item in one round trip
+    if inventory_service is not None:
+        return inventory_service.call("comparison_rows", item_names = item_names, start = start, end = end)
+
+    placeholders = ", ".join(["%s"] * len(item_names))
+    query = f"SELECT item_name, day, total_change FROM changes_daily_rollup WHERE item_name IN ({placeholders})"
+    params = list(item_names)
+    if start is not None:
+        query += " AND day >= %s AND day < %s"
+        params.extend([start, end])
+
+    with db_connection("comparison_series") as db:
+        cursor = db.cursor()
+        cursor.execute(query, params)
+        data = cursor.fetchall()
+        cursor.close()
+    return data
+
+
+def fetch_comparison_series(item_names, granularity, start = None, end = None):
+    # Daily totals of every item in one round trip, pivoted into an items x periods matrix.
+    # The rollup already holds one row per (item, day), so the IN list needs no GROUP BY.
+    load_numpy()
+    item_names = list(dict.fromkeys(item_names))[:COMPARE_MAX_ITEMS]
+    if not item_names:
+        return item_names, np.array([], dtype = 'datetime64[D]'), np.zeros((0, 0))
+
+    data = fetch_comparison_rows(item_names, start, end)
+    if not data:
+        return item_names, np.array([], dtype = 'datetime64[D]'), np.zeros((len(item_names), 0))
+
+    row_of = {item_name: row for row, item_name in enumerate(item_names)}
+    rows = np.fromiter((row_of[item_name] for item_name, _, _ in data), dtype = np.int64, count = len(data))
+    days = np.array([day for _, day, _ in data], dtype = 'datetime64[D]')
+    totals = np.array([total for _, _, total in data], dtype = float)
+
+    # Zero-filled periods covering every day between the first and the last change
+    calendar = np.arange(days.min(), days.max() + np.timedelta64(1, 'D'), dtype = 'datetime64[D]')
+    periods = np.unique(period_starts(calendar, granularity))
+    columns = np.searchsorted(periods, period_starts(days, granularity))
+
+    matrix = np.zeros((len(item_names), len(periods)))
+    np.add.at(matrix, (rows, columns), totals)
+    return item_names, periods, matrix
+
+
+class ComparisonGraph:
+    # Persistent figure for the Compare tab; overlay lines are reused between draws
+    def __init__(self, master):
+        load_graph_modules()
+        self.figure = Figure(figsize = (8, 4))
+        self.figure.subplots_adjust(bottom = 0.2, right = 0.78)
+        self.ax = self.figure.add_subplot()
+        self.lines = []
+        self.stacks = []
+        self.message = self.ax.text(0.5, 0.5, "", transform = self.ax.transAxes, ha = 'center', va = 'center')
+        self.ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+        self.ax.tick_params(axis = 'x', labelrotation = 90, labelsize = 6)
+        self.canvas = FigureCanvasTkAgg(self.figure, master = master)
+        self.canvas.get_tk_widget().pack(side = tk.TOP, fill = tk.BOTH, expand = True)
+
+    def _clear(self):
+        for line in self.lines:
+            line.set_visible(False)
+            line.set_label("_hidden")
+        for collection in self.stacks:
+            collection.remove()
+        self.stacks = []
+        legend = self.ax.get_legend()
+        if legend is not None:
+            legend.remove()
+
+    def show_message(self, text):
+        self._clear()
+        self.message.set_text(text)
+        self.canvas.draw_idle()
+
+    def show(self, item_names, periods, matrix, stacked = False):
+        self._clear()
+        self.message.set_text("")
+        x = mdates.date2num(periods.astype(object))
+        if stacked:
+            self.stacks = self.ax.stackplot(x, matrix, labels = item_names)
+        else:
+            while len(self.lines) < len(item_names):
+                self.lines.append(self.ax.plot([], [], marker = 'o', markersize = 3)[0])
+            for line, item_name, values in zip(self.lines, item_names, matrix):
+                line.set_data(x, values)
+                line.set_label(item_name)
+                line.set_visible(True)
+        self.ax.legend(loc = 'upper left', bbox_to_anchor = (1.01, 1), fontsize = 6)
+        self.ax.relim(visible_only = True)
+        self.ax.autoscale_view()
+        self.canvas.draw_idle()
+
+
+#### Low stock forecast. ####
+# Days of removals averaged into the burn rate
+FORECAST_WINDOW_DAYS = int(os.environ.get("INVENTORY_FORECAST_WINDOW_DAYS", "28"))
+# Shorter window shown next to it to spot a change in usage
+FORECAST_RECENT_DAYS = 7
+# Days between ordering and receiving stock
+REORDER_LEAD_DAYS = float(os.environ.get("INVENTORY_REORDER_LEAD_DAYS", "7"))
+# Safety stock in standard deviations of daily usage over the lead time (1.65 ~ 95% service level)
+REORDER_SERVICE_Z = float(os.environ.get("INVENTORY_REORDER_SERVICE_Z", "1.65"))
+# Rows put in the Low Stock table; sorting happens on the arrays, not the widget
+LOW_STOCK_DISPLAY_LIMIT = 500
+
+
+def fetch_daily_consumption(window_days = FORECAST_WINDOW_DAYS, today = None):
+    # Units removed per item and day over the window, for the whole catalog in one grouped
+    # query. The change_date range uses idx_changes_log_date and prunes to recent partitions.
+    today = today or datetime.now().date()
+    if inventory_service is not None:
+        rows = inventory_service.call("daily_consumption", window_days = window_days, today = today)
+        return [(item_name, datetime.strptime(day, "%Y-%m-%d").date(), used) for item_name, day, used in rows]
+
+    start = today - timedelta(days = window_days - 1)
+    with db_connection("forecast_usage") as db:
+        cursor = db.cursor()
+        cursor.execute(
+            "SELECT item_name, change_date, SUM(-quantity_change) FROM changes_log "
+            "WHERE change_date >= %s AND change_date < %s AND quantity_change < 0 "
+            "GROUP BY item_name, change_date",
+            (start, today + timedelta(days = 1))
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
+
+
+def forecast_low_stock(quantities, row_for_name, usage_rows, today = None, window_days = FORECAST_WINDOW_DAYS,
+                       recent_days = FORECAST_RECENT_DAYS, lead_days = REORDER_LEAD_DAYS, service_z = REORDER_SERVICE_Z):
+    # Burn rate, days of stock left and reorder point for every store row at once.
+    # quantities is a snapshot of InventoryStore.quantities, row_for_name maps ItemName to a
+    # row and usage_rows come from fetch_daily_consumption. Days without removals count as 0.
+    load_numpy()
+    today = today or datetime.now().date()
+    count = len(quantities)
+    stock = np.frombuffer(quantities, dtype = float).copy()
+
+    rows = np.fromiter((row_for_name.get(item_name, -1) for item_name, _, _ in usage_rows), dtype = np.int64, count = len(usage_rows))
+    ages = np.fromiter(((today - day).days for _, day, _ in usage_rows), dtype = np.int64, count = len(usage_rows))
+    used = np.fromiter((float(units) for _, _, units in usage_rows), dtype = float, count = len(usage_rows))
+    # Items removed since the snapshot or renamed are left out
+    known = (rows >= 0) & (rows < count) & (ages >= 0) & (ages < window_days)
+    rows, ages, used = rows[known], ages[known], used[known]
+
+    total = np.bincount(rows, weights = used, minlength = count)
+    squares = np.bincount(rows, weights = used * used, minlength = count)
+    recent = ages < recent_days
+    recent_total = np.bincount(rows[recent], weights = used[recent], minlength = count)
+
+    burn_rate = total / window_days
+    daily_variance = np.maximum(squares / window_days - burn_rate * burn_rate, 0)
+    safety_stock = service_z * np.sqrt(daily_variance * lead_days)
+    reorder_point = burn_rate * lead_days + safety_stock
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        days_left = np.where(burn_rate > 0, np.maximum(stock, 0) / burn_rate, np.inf)
+
+    return {
+        "quantity": stock,
+        "burn_rate": burn_rate,
+        "recent_rate": recent_total / recent_days,
+        "days_left": days_left,
+        "reorder_point": reorder_point,
+        "below_reorder": (burn_rate > 0) & (stock <= reorder_point),
+    }
+
+
+class UsageGraph:
+    # One persistent Figure/Axes/Line2D per notebook tab. Figures are built with
+    # matplotlib.figure.Figure so pyplot never holds on to them, and a redraw only
+    # swaps the line data, reuses the tick locators and schedules draw_idle.
+    # master None renders off-screen with the Agg canvas (benchmarks, no display needed).
+    def __init__(self, master):
+        load_graph_modules()
+        self.figure = Figure(figsize = (8, 4))  # Adjust the size of plots
+        self.figure.subplots_adjust(bottom = 0.2)
+        self.ax = self.figure.add_subplot()
+        self.line, = self.ax.plot([], [], marker = 'o', label = "Change")  # Add markers for each data point
+        # Running stock level on its own y axis
+        self.stock_ax = self.ax.twinx()
+        self.stock_line, = self.stock_ax.plot([], [], drawstyle = 'steps-post', linestyle = '--', color = 'grey', label = "Stock")
+        self.stock_ax.set_ylabel("Stock", fontsize = 8)
+        self.message = self.ax.text(0.5, 0.5, "", transform = self.ax.transAxes, ha = 'center', va = 'center')
+
+        # Locators and formatter are created once and swapped in as needed
+        self.daily_locator = mdates.DayLocator()
+        self.five_day_locator = mdates.DayLocator(interval = 5)  # Show every 5 days
+        self.weekly_locator = mdates.WeekdayLocator(byweekday = mdates.MO)
+        self.monthly_locator = mdates.MonthLocator()
+        self.auto_locator = mdates.AutoDateLocator()
+        self.ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+        self.ax.xaxis_date()
+        self.ax.tick_params(axis = 'x', labelrotation = 90, labelsize = 6)
+
+        if master is None:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.canvas = FigureCanvasAgg(self.figure)
+            return
+
+        # Embedding the figure in the Tkinter window
+        self.canvas = FigureCanvasTkAgg(self.figure, master = master)
+        self.canvas.get_tk_widget().pack(side = tk.TOP, fill = tk.BOTH, expand = True)
+
+    def show_message(self, text):
+        # Hide the data and show a note (loading, no data, errors) in the middle of the axes
+        self.line.set_visible(False)
+        self.stock_line.set_visible(False)
+        self.message.set_text(text)
+        self.canvas.draw_idle()
+
+    def show(self, time_period, dates, quantities, stock = None):
+        self.message.set_text("")
+        x = mdates.date2num(dates)
+        self.line.set_data(x, quantities)
+        self.line.set_visible(True)
+        if stock is not None and not np.isnan(stock).all():
+            self.stock_line.set_data(x, stock)
+            self.stock_line.set_visible(True)
+        else:
+            self.stock_line.set_visible(False)
+
+        if len(dates) == 1:
+            # If there's only one point, set a reasonable range around the single date for x-axis
+            self.ax.set_xlim(mdates.date2num(dates[0] - timedelta(days = 10)), mdates.date2num(dates[0] + timedelta(days = 15)))
+            self.ax.xaxis.set_major_locator(self.five_day_locator)
+        else:
+            self.ax.autoscale(enable = True, axis = 'x')
+            span = (dates[-1] - dates[0]).days
+            if time_period == "Monthly Usage" and span <= 3 * 366:
+                self.ax.xaxis.set_major_locator(self.monthly_locator)
+            elif time_period == "Weekly Usage" and span <= 366:
+                self.ax.xaxis.set_major_locator(self.weekly_locator)
+            elif time_period == "Daily Usage" and span <= 45:
+                # A tick for every day when the data fits in about a month
+                self.ax.xaxis.set_major_locator(self.daily_locator)
+            else:
+                self.ax.xaxis.set_major_locator(self.auto_locator)
+
+        for axes in (self.ax, self.stock_ax):
+            axes.relim(visible_only = True)
+            axes.autoscale_view()
+        self.canvas.draw_idle()
+
+
+#### Recent changes list. ####
+# Changes kept in memory for the Recent Changes list; older ones are paged from changes_log
+RECENT_CHANGES_LIMIT = int(os.environ.get("INVENTORY_RECENT_CHANGES_LIMIT", "500"))
+# Rows shown per page
+RECENT_CHANGES_PAGE_SIZE = 12
+
+# change_id is changes_log.id; None for rows logged this session (not read back from the table)
+ChangeRecord = namedtuple("ChangeRecord", "item_label original_quantity quantity_change new_quantity change_time change_id",
+                          defaults = (None,))
+
+
+def format_change_record(record):
+    # Determine the operation symbol and format the change appropriately
+    operation = "+" if record.quantity_change >= 0 else "-"
+    return f"{record.item_label}: {record.original_quantity} {operation} {abs(record.quantity_change)} = {record.new_quantity}"
+
+
+def fetch_change_rows(emp_id, before, limit, before_id = None):
+    # (random_id, item_name, original, change, new, change_time, id) rows for fetch_change_records.
+    # The keyset is (change_time, id) so changes logged in the same second are not skipped
+    # between pages; without before_id every row at `before` counts as already shown.
+    if inventory_service is not None:
+        return [(*row[:5], datetime.fromisoformat(row[5]), row[6])
+                for row in inventory_service.call("change_rows", emp_id = emp_id, before = before, limit = limit, before_id = before_id)]
+
+    if before_id is None:
+        keyset, params = "change_time < %s", (before,)
+    else:
+        keyset, params = "(change_time < %s OR (change_time = %s AND id < %s))", (before, before, before_id)
+    with db_connection("recent_changes_page") as db:
+        cursor = db.cursor()
+        cursor.execute(
+            "SELECT random_id, item_name, original_quantity, quantity_change, new_quantity, change_time, id "
+            f"FROM changes_log WHERE emp_id = %s AND {keyset} AND change_date <= %s "
+            "ORDER BY change_time DESC, id DESC LIMIT %s",
+            (emp_id, *params, before.date(), limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    return rows
+
+
+def fetch_change_records(emp_id, before, limit, before_id = None):
+    # One page of an employee's logged changes older than (before, before_id), newest first
+    rows = fetch_change_rows(emp_id, before, limit, before_id)
+    return [ChangeRecord(f"{random_id} - {item_name}", original, change, new, change_time, change_id)
+            for random_id, item_name, original, change, new, change_time, change_id in rows]
+
+
+class RecentChangesView:
+    # Ring buffer of structured change records behind a Listbox that only ever holds
+    # one page of rows. Pages past the buffer are read from changes_log on a worker
+    # thread with a (change_time, id) keyset, so memory and insert cost stay constant.
+    def __init__(self, master, emp_id, limit = RECENT_CHANGES_LIMIT, page_size = RECENT_CHANGES_PAGE_SIZE):
+        self.emp_id = emp_id
+        self.page_size = page_size
+        self.records = deque(maxlen = limit)  # newest first
+        self.page = 0
+        self.db_before = []    # keyset (change_time, id) upper bound of each database page visited
+        self.db_results = queue.Queue()
+        self.loading = False
+        self.oldest_page = None  # page found to have nothing older, None until known
+
+        self.frame = tk.Frame(master, background = 'light grey')
+        self.listbox = tk.Listbox(self.frame, width = 40, height = page_size, borderwidth = 0, highlightthickness = 0,)
+        self.listbox.pack(side = tk.TOP, fill = tk.BOTH, expand = True)
+        buttons = tk.Frame(self.frame, background = 'light grey')
+        buttons.pack(side = tk.TOP, fill = tk.X)
+        self.newer_button = tk.Button(buttons, text = "\u25c0 Newer", command = self.newer, font = ("Calibri", 9))
+        self.page_label = tk.Label(buttons, text = "", background = 'light grey', font = ("Calibri", 9))
+        self.older_button = tk.Button(buttons, text = "Older \u25b6", command = self.older, font = ("Calibri", 9))
+        self.newer_button.pack(side = tk.LEFT)
+        self.page_label.pack(side = tk.LEFT, expand = True)
+        self.older_button.pack(side = tk.RIGHT)
+        self._update_buttons()
+
+    def add(self, record):
+        self.records.appendleft(record)
+        # Pages shift by one record, the end found earlier may have moved
+        self.oldest_page = None
+        if self.page == 0:
+            # Only the visible window is touched: new row on top, drop the row that scrolled off
+            self.listbox.insert(0, format_change_record(record))
+            if self.listbox.size() > self.page_size:
+                self.listbox.delete(self.page_size, tk.END)
+        self._update_buttons()
+
+    def _local_pages(self):
+        # Page 0 is always the live page, even before anything was logged this session
+        return max(1, -(-len(self.records) // self.page_size))
+
+    def _show(self, records):
+        self.listbox.delete(0, tk.END)
+        for record in records:
+            self.listbox.insert(tk.END, format_change_record(record))
+        self._update_buttons()
+
+    def _update_buttons(self):
+        can_newer = self.page > 0 and not self.loading
+        can_older = not self.loading and self.page != self.oldest_page
+        self.newer_button.config(state = tk.NORMAL if can_newer else tk.DISABLED)
+        self.older_button.config(state = tk.NORMAL if can_older else tk.DISABLED)
+        self.page_label.config(text = f"Page {self.page + 1}")
+
+    def _show_page(self):
+        local_pages = self._local_pages()
+        if self.page < local_pages:
+            start = self.page * self.page_size
+            self._show(islice(self.records, start, start + self.page_size))
+            return
+
+        # Past the ring buffer: read the page from changes_log. Only pages whose keyset is
+        # known can be read; if the buffer grew since, start again right after it.
+        db_page = self.page - local_pages
+        if db_page == 0 or db_page >= len(self.db_before):
+            db_page = 0
+            self.page = local_pages
+            # Rows logged this session have no id yet; the table is read from before the oldest one
+            before = self.records[-1].change_time if self.records else datetime.now()
+            self.db_before = [(before, None)]
+        before, before_id = self.db_before[db_page]
+        self.loading = True
+        self._update_buttons()
+        page = self.page
+
+        def load():
+            try:
+                self.db_results.put((page, fetch_change_records(self.emp_id, before, self.page_size, before_id)))
+            except Exception as e:
+                self.db_results.put((page, e))
+
+        threading.Thread(target = load, name = "recent-changes-page", daemon = True).start()
+        self.frame.after(50, self._poll_db_page)
+
+    def _poll_db_page(self):
+        try:
+            page, records = self.db_results.get_nowait()
+        except queue.Empty:
+            self.frame.after(50, self._poll_db_page)
+            return
+        self.loading = False
+        if page != self.page:
+            self._update_buttons()
+            return
+        if isinstance(records, Exception):
+            # Stay where we were, Older can be tried again
+            print("Could not load older changes:", records)
+            self.page = max(0, self.page - 1)
+            self._update_buttons()
+            return
+        if not records:
+            # Nothing older, stay on the last page that had rows and stop offering Older
+            self.page = max(0, self.page - 1)
+            self.oldest_page = self.page
+            self._update_buttons()
+            return
+        db_page = self.page - self._local_pages()
+        del self.db_before[db_page + 1:]
+        self.db_before.append((records[-1].change_time, records[-1].change_id))
+        self._show(records)
+
+    def older(self):
+        if self.loading or self.page == self.oldest_page:
+            return
+        self.page += 1
+        self._show_page()
+
+    def newer(self):
+        if self.page == 0 or self.loading:
+            return
+        self.page -= 1
+        self._show_page()
+
+
+#### Columnar inventory store. ####
+# Rows fetched per round trip while loading shop_inventory_count
+INVENTORY_LOAD_CHUNK = 5000
+
+
+class InventoryStore:
+    # Array-backed inventory: every SKU is a row number, with parallel columns for
+    # random_id, ItemName, category and Quantity. Categories are interned so repeated
+    # ones share one object, and quantities live in one flat array of doubles.
+    # Lookups by id, name and case-folded name bisect arrays of row numbers sorted by
+    # that column (4 bytes per row each) instead of keeping a dict per column. The orders
+    # are built on the first lookup after a bulk load; later adds insert into them.
+    # Lookups can come from the scanner's decoder threads while the Tk thread adds synced
+    # rows, so adds, the build and lookups hold the store's lock.
+    # Row numbers are the item handles used by the rest of the app.
+    __slots__ = ("ids", "names", "categories", "quantities", "by_category", "orders", "lock")
+
+    def __init__(self):
+        self.ids = []
+        self.names = []
+        self.categories = []
+        self.quantities = array('d')
+        self.by_category = {}  # category -> array of rows
+        self.orders = None  # (rows sorted by id, by name, by folded name), None until first used
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, random_id, item_name, quantity, category = None):
+        if isinstance(category, str):
+            category = sys.intern(category)
+        with self.lock:
+            row = len(self.ids)
+            self.ids.append(str(random_id))
+            self.names.append(item_name)
+            self.categories.append(category)
+            self.quantities.append(float(quantity or 0))
+            if category is not None:
+                self.by_category.setdefault(category, array('i')).append(row)
+            if self.orders is not None:
+                # insort_right keeps the earlier row first among equal keys
+                id_order, name_order, folded_order = self.orders
+                bisect.insort(id_order, row, key = self.ids.__getitem__)
+                bisect.insort(name_order, row, key = self.names.__getitem__)
+                bisect.insort(folded_order, row, key = self._folded_name)
+        return row
+
+    def _folded_name(self, row):
+        return self.names[row].casefold()
+
+    def _build_orders(self):
+        # Called with the lock held. Stable sorts, so the first row wins when two items share a key
+        rows = range(len(self.ids))
+        self.orders = (array('i', sorted(rows, key = self.ids.__getitem__)),
+                       array('i', sorted(rows, key = self.names.__getitem__)),
+                       array('i', sorted(rows, key = self._folded_name)))
+
+    def _find(self, order_index, column, value):
+        # First row in orders[order_index] whose column(row) == value, or None
+        with self.lock:
+            if self.orders is None:
+                self._build_orders()
+            order = self.orders[order_index]
+            start = bisect.bisect_left(order, value, key = column)
+            if start < len(order) and column(order[start]) == value:
+                return order[start]
+        return None
+
+    def load(self, cursor, on_row = None, chunk_size = INVENTORY_LOAD_CHUNK):
+        # Stream (ItemName, random_id, Quantity, category) rows with fetchmany
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for item_name, random_id, quantity, category in rows:
+                row = self.add(random_id, item_name, quantity, category)
+                if on_row is not None:
+                    on_row(row)
+        return len(self)
+
+    def label(self, row):
+        # Text shown in the item combobox
+        return f"{self.ids[row]} - {self.names[row]}"
+
+    def labels(self, rows):
+        return [f"{self.ids[row]} - {self.names[row]}" for row in rows]
+
+    def item(self, row):
+        # (random_id, item_name) for a row
+        return self.ids[row], self.names[row]
+
+    def name(self, row):
+        return self.names[row]
+
+    def category(self, row):
+        return self.categories[row]
+
+    def quantity(self, row):
+        return self.quantities[row]
+
+    def set_quantity(self, row, quantity):
+        self.quantities[row] = quantity
+
+    def upsert(self, random_id, item_name, quantity, category = None):
+        # Update the quantity of a known random_id or append a new row; returns (row, is_new)
+        row = self.row_for_id(random_id)
+        if row is None:
+            return self.add(random_id, item_name, quantity, category), True
+        self.quantities[row] = float(quantity or 0)
+        return row, False
+
+    def row_for_id(self, random_id):
+        return self._find(0, self.ids.__getitem__, str(random_id).strip())
+
+    def row_for_name(self, item_name):
+        # Exact ItemName; the first row if two items share it
+        return self._find(1, self.names.__getitem__, item_name)
+
+    def rows_for_folded_name(self, item_name):
+        # Every row whose ItemName matches ignoring case, as the server's name joins do
+        folded = item_name.casefold()
+        with self.lock:
+            if self.orders is None:
+                self._build_orders()
+            order = self.orders[2]
+            start = bisect.bisect_left(order, folded, key = self._folded_name)
+            rows = []
+            for row in islice(order, start, None):
+                if self._folded_name(row) != folded:
+                    break
+                rows.append(row)
+        return rows
+
+    def rows_in_category(self, category):
+        return self.by_category.get(category, ())
+
+    def resolve(self, selection):
+        # Accepts a combobox entry "random_id - ItemName", a bare random_id or an ItemName
+        selection = selection.strip()
+        if " - " in selection:
+            random_id, item_name = selection.split(" - ", 1)
+            row = self.row_for_id(random_id)
+            if row is not None:
+                return row
+            selection = item_name
+        row = self.row_for_id(selection)
+        if row is None:
+            row = self.row_for_name(selection)
+        if row is None:
+            # First item wins if two names only differ by case
+            row = self._find(2, self._folded_name, selection.casefold())
+        return row
+
+
+#### Item search. ####
+# Most entries shown in the item dropdown at once
+SEARCH_RESULT_LIMIT = int(os.environ.get("INVENTORY_SEARCH_RESULT_LIMIT", "200"))
+# Wait this long after the last keystroke before filtering (milliseconds)
+SEARCH_DEBOUNCE_MS = int(os.environ.get("INVENTORY_SEARCH_DEBOUNCE_MS", "150"))
+
+
+class SearchIndex:
+    # Trigram index over the combobox labels ("random_id - ItemName", lower-cased) of an
+    # InventoryStore. Queries of 3+ characters only check the rows in their rarest
+    # trigram's posting array, shorter ones use row orders sorted by id and by name.
+    # When a query extends the previous one, only the previous matches are re-checked.
+    # Results are ranked: exact id, then id/name prefix, then substring.
+    def __init__(self, store):
+        self.store = store
+        self.folded = []    # lower-cased label per store row
+        self.trigrams = {}  # trigram -> array of rows
+        self.id_order = None    # rows sorted by id / by name, built lazily
+        self.name_order = None
+        self.last_query = None
+        self.last_matches = None
+
+    def add(self, row):
+        folded = self.store.label(row).lower()
+        self.folded.append(folded)
+        for trigram in {folded[i:i + 3] for i in range(len(folded) - 2)}:
+            posting = self.trigrams.get(trigram)
+            if posting is None:
+                posting = self.trigrams[trigram] = array('i')
+            posting.append(row)
+        self.id_order = self.name_order = None
+        self.last_query = self.last_matches = None
+        return row
+
+    def _id_part(self, row):
+        return self.folded[row][:len(self.store.ids[row])]
+
+    def _name_part(self, row):
+        return self.folded[row][len(self.store.ids[row]) + 3:]
+
+    def _rank(self, typed, row):
+        name = self._name_part(row)
+        random_id = self._id_part(row)
+        if random_id == typed:
+            return (0, name)
+        if random_id.startswith(typed) or name.startswith(typed):
+            return (1, name)
+        return (2, name)
+
+    def _prefix_rows(self, typed, order, part):
+        start = bisect.bisect_left(order, typed, key = part)
+        for row in order[start:]:
+            if not part(row).startswith(typed):
+                break
+            yield row
+
+    def _short_query(self, typed, limit):
+        # One or two characters: exact id and prefix hits come from the sorted orders,
+        # the rest is filled with substring hits until the cap is reached
+        if self.id_order is None:
+            rows = range(len(self.folded))
+            self.id_order = array('i', sorted(rows, key = self._id_part))
+            self.name_order = array('i', sorted(rows, key = self._name_part))
+
+        ranked = []
+        seen = set()
+        # Exact id, compared folded like the rest of the index
+        start = bisect.bisect_left(self.id_order, typed, key = self._id_part)
+        if start < len(self.id_order) and self._id_part(self.id_order[start]) == typed:
+            exact = self.id_order[start]
+            seen.add(exact)
+            ranked.append(exact)
+        prefixed = (set(self._prefix_rows(typed, self.id_order, self._id_part))
+                    | set(self._prefix_rows(typed, self.name_order, self._name_part))) - seen
+        for row in sorted(prefixed, key = self._name_part)[:limit - len(ranked)]:
+            seen.add(row)
+            ranked.append(row)
+        for row, folded in enumerate(self.folded):
+            if len(ranked) >= limit:
+                break
+            if row not in seen and typed in folded:
+                ranked.append(row)
+        return ranked
+
+    def search_rows(self, typed, limit = SEARCH_RESULT_LIMIT):
+        typed = typed.strip().lower()
+        if not typed:
+            self.last_query = self.last_matches = None
+            return list(range(min(limit, len(self.folded))))
+
+        if len(typed) < 3:
+            self.last_query = self.last_matches = None
+            return self._short_query(typed, limit)
+
+        if self.last_query is not None and self.last_query in typed:
+            # The new query can only match a subset of what the previous one matched
+            candidates = self.last_matches
+        else:
+            postings = [self.trigrams.get(typed[i:i + 3], ()) for i in range(len(typed) - 2)]
+            candidates = min(postings, key = len)
+
+        folded = self.folded
+        matches = [row for row in candidates if typed in folded[row]]
+        self.last_query, self.last_matches = typed, matches
+        return heapq.nsmallest(limit, matches, key = lambda row: self._rank(typed, row))
+
+    def search(self, typed, limit = SEARCH_RESULT_LIMIT):
+        # Combobox labels for the best matches
+        return self.store.labels(self.search_rows(typed, limit))
+
+
+#### QR scanning pipeline. ####
+# Frames waiting for a decoder; when full the oldest frame is dropped
+SCANNER_FRAME_QUEUE_SIZE = 2
+# Decoder threads (pyzbar and OpenCV release the GIL while they work)
+SCANNER_DECODE_WORKERS = int(os.environ.get("INVENTORY_SCANNER_WORKERS", "2"))
+# Frames wider than this are downscaled before decoding
+SCANNER_DECODE_WIDTH = 640
+# Fraction of the frame (centered) that is tried before the whole frame
+SCANNER_ROI_FRACTION = 0.6
+# The same code is ignored for this many seconds after it was read
+SCANNER_REPEAT_WINDOW = float(os.environ.get("INVENTORY_SCANNER_REPEAT_WINDOW", "3.0"))
+# Cycle counting: a code counts again once it has been out of view this long
+SCANNER_COUNT_REPEAT_WINDOW = float(os.environ.get("INVENTORY_COUNT_REPEAT_WINDOW", "0.75"))
+
+
+def scanned_random_id(qr_data):
+    # Item labels carry JSON like {"random_id": "..."}; None for anything else
+    try:
+        qr_data_json = json.loads(qr_data)
+    except json.JSONDecodeError:
+        print("Invalid QR code format")
+        return None
+    random_id = qr_data_json.get("random_id") if isinstance(qr_data_json, dict) else None
+    if not random_id:
+        print("Random ID not found in QR data")
+        return None
+    return str(random_id).strip()
+
+
+class ScannerPipeline:
+    # Capture thread -> bounded frame queue -> pool of decoder threads. The thread that
+    # calls run() only shows the camera preview. on_code(qr_data, captured_at) is called
+    # from a decoder thread for every code not seen within the repeat window. With
+    # rearm_on_sight every sighting restarts the window, so a code held in view is read
+    # once and counts again only after it has left the view (used for cycle counts).
+    def __init__(self, on_code, camera_index = 0, workers = SCANNER_DECODE_WORKERS, repeat_window = SCANNER_REPEAT_WINDOW, rearm_on_sight = False):
+        self.on_code = on_code
+        self.camera_index = camera_index
+        self.workers = workers
+        self.repeat_window = repeat_window
+        self.rearm_on_sight = rearm_on_sight
+        self.frames = queue.Queue(maxsize = SCANNER_FRAME_QUEUE_SIZE)
+        self.latest_frame = None
+        self.recent_codes = {}  # qr data -> time it was last accepted
+        self.recent_lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def is_new_code(self, qr_data):
+        # Recently-seen cache instead of sleeping after every read
+        now = time.monotonic()
+        with self.recent_lock:
+            last_seen = self.recent_codes.get(qr_data)
+            if last_seen is not None and now - last_seen < self.repeat_window:
+                if self.rearm_on_sight:
+                    self.recent_codes[qr_data] = now
+                return False
+            self.recent_codes[qr_data] = now
+            if len(self.recent_codes) > 64:
+                self.recent_codes = {code: seen for code, seen in self.recent_codes.items() if now - seen < self.repeat_window}
+            return True
+
+    @latency_stats.timed("scanner.decode")
+    def decode_frame(self, frame):
+        # Decode on a grayscale, downscaled frame, trying the center of the view first
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        height, width = gray.shape
+        if width > SCANNER_DECODE_WIDTH:
+            scale = SCANNER_DECODE_WIDTH / width
+            gray = cv2.resize(gray, (SCANNER_DECODE_WIDTH, int(height * scale)), interpolation = cv2.INTER_AREA)
+            height, width = gray.shape
+
+        margin_x = int(width * (1 - SCANNER_ROI_FRACTION) / 2)
+        margin_y = int(height * (1 - SCANNER_ROI_FRACTION) / 2)
+        decoded_objects = decode(gray[margin_y:height - margin_y, margin_x:width - margin_x]) or decode(gray)
+        return [code.data.decode('utf-8') for code in decoded_objects]
+
+    def _capture(self, cap):
+        while not self.stop_event.is_set():
+            with latency_stats.timer("scanner.capture"):
+                success, frame = cap.read()
+            if not success:
+                print("Failed to grab frame") # camera did not open
+                self.stop_event.set()
+                break
+            self.latest_frame = frame
+
+            # Keep only the freshest frames for the decoders
+            if self.frames.full():
+                try:
+                    self.frames.get_nowait()
+                except queue.Empty:
+                    pass
+            try:
+                self.frames.put_nowait((time.monotonic(), frame))
+            except queue.Full:
+                pass
+
+    def _decode(self):
+        while not self.stop_event.is_set():
+            try:
+                captured_at, frame = self.frames.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+            latency_stats.record("scanner.queue_wait", (time.monotonic() - captured_at) * 1000)
+            try:
+                for qr_data in self.decode_frame(frame):
+                    if self.is_new_code(qr_data):
+                        self.on_code(qr_data, captured_at)
+            except Exception as e:
+                print("An error occurred while decoding a frame:", e)
+
+    def run(self):
+        load_scanner_modules()
+
+        # start camera
+        cap = cv2.VideoCapture(self.camera_index)
+        if not cap.isOpened():
+            print("Unable to access the camera")
+            return
+
+        cap.set(3, 640)  # Set width
+        cap.set(4, 480)  # Set height
+
+        capture_thread = threading.Thread(target = self._capture, args = (cap,), name = "scanner-capture", daemon = True)
+        decoders = ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "scanner-decode")
+        try:
+            capture_thread.start()
+            for _ in range(self.workers):
+                decoders.submit(self._decode)
+
+            # Preview loop, press q to stop
+            while not self.stop_event.is_set():
+                if self.latest_frame is not None:
+                    cv2.imshow("Scanner Window", self.latest_frame)
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+        finally:
+            self.stop_event.set()
+            capture_thread.join(timeout = 1)
+            decoders.shutdown(wait = True)
+            cap.release()
+            cv2.destroyAllWindows()
+
+
+def load_inventory(store, search_index = None, mirror = None):
+    # Stream shop_inventory_count into the store (and search index) in fetchmany chunks.
+    # Returns the (last_modified, random_id) watermark to start delta syncing from (None without migration 3).
+    # With a mirror, the loaded rows are copied to it on a background thread.
+    # In remote mode the rows come from the service and the watermark is its change version.
+    on_row = search_index.add if search_index is not None else None
+    if inventory_service is not None:
+        return load_service_inventory(store, on_row, mirror)
+
+    with db_connection("inventory_load") as db:
+        cursor = db.cursor()
+        watermark = None
+        try:
+            # Read before the rows so anything changed during the load is synced again
+            cursor.execute(
+                "SELECT last_modified, random_id FROM shop_inventory_count "
+                "ORDER BY last_modified DESC, random_id DESC LIMIT 1"
+            )
+            newest = cursor.fetchone()
+            watermark = (newest[0], str(newest[1])) if newest else INVENTORY_SYNC_START
+        except mysql.connector.Error as e:
+            print("Inventory delta sync unavailable:", e)
+        cursor.execute("SELECT ItemName, random_id, Quantity, category FROM shop_inventory_count")
+        store.load(cursor, on_row)
+        cursor.close()
+
+    if mirror is not None:
+        rows = list(zip(store.ids, store.names, store.quantities, store.categories))
+        threading.Thread(target = mirror.replace_inventory, args = (rows, watermark), name = "mirror-snapshot", daemon = True).start()
+    return watermark
+
+
+def load_service_inventory(store, on_row = None, mirror = None):
+    result = inventory_service.call("inventory")
+    for item_name, random_id, quantity, category in result["rows"]:
+        row = store.add(random_id, item_name, quantity, category)
+        if on_row is not None:
+            on_row(row)
+
+    if mirror is not None:
+        # The mirror's watermark is a MySQL sync cursor, the service version does not go there
+        rows = list(zip(store.ids, store.names, store.quantities, store.categories))
+        threading.Thread(target = mirror.replace_inventory, args = (rows, None), name = "mirror-snapshot", daemon = True).start()
+    return result["version"]
+
+
+#### Inventory delta sync. ####
+# Seconds between polls for inventory rows changed on other stations
+INVENTORY_SYNC_INTERVAL = float(os.environ.get("INVENTORY_SYNC_INTERVAL", "5"))
+# Most changed rows fetched per poll
+INVENTORY_SYNC_BATCH = 10000
+# Watermark before every row; syncing from it reads the whole table in batches
+INVENTORY_SYNC_START = (datetime(1970, 1, 1), "")
+
+
+class InventorySync:
+    # Polls shop_inventory_count for rows changed since the watermark and queues them for
+    # the Tk thread, which patches the store in place. Only changed rows cross the network,
+    # never the whole table. The watermark is a keyset cursor on (last_modified, random_id),
+    # so it moves forward even when more than a batch of rows share one last_modified (a
+    # bulk UPDATE or the migration 3 backfill). In remote mode the watermark is the
+    # service's change version and the service is asked for the rows changed since.
+    def __init__(self, watermark, interval = INVENTORY_SYNC_INTERVAL, mirror = None):
+        self.watermark = watermark
+        self.mirror = mirror
+        self.interval = interval
+        self.updates = queue.Queue()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target = self._run, name = "inventory-sync", daemon = True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                # A full batch means more rows are waiting, fetch them without waiting
+                while self.poll_once() >= INVENTORY_SYNC_BATCH and not self.stop_event.is_set():
+                    pass
+            except Exception as e:
+                print("Inventory sync failed, will retry:", e)
+
+    def poll_once(self):
+        # Saves still waiting in the outbox are not in the server quantities yet, so their
+        # deltas are laid over the rows delivered. The mirror's replay lock keeps a replay
+        # from landing between reading the rows and reading the outbox (counted twice).
+        with self.mirror.replay_lock if self.mirror is not None else nullcontext():
+            if inventory_service is not None:
+                fresh, mirror_watermark = self._poll_service()
+            else:
+                fresh, mirror_watermark = self._poll_database()
+            unsent = self._unsent_deltas() if fresh else {}
+        if unsent:
+            fresh = [(item_name, random_id, float(quantity or 0) + unsent.get(item_name.casefold(), 0), category, version)
+                     for item_name, random_id, quantity, category, version in fresh]
+        return self._deliver(fresh, mirror_watermark)
+
+    def _unsent_deltas(self):
+        # Folded ItemName -> summed delta of the queued saves; the server matches names case-insensitively
+        totals = {}
+        if self.mirror is not None:
+            for _, deltas in self.mirror.pending("delta"):
+                for item_name, delta in deltas.items():
+                    totals[item_name.casefold()] = totals.get(item_name.casefold(), 0) + delta
+        return totals
+
+    def _poll_database(self):
+        last_modified, random_id = self.watermark
+        with db_connection("inventory_sync") as db:
+            cursor = db.cursor()
+            # (last_modified, random_id) > (watermark) written out, which MySQL can range-scan
+            # on idx_inventory_sync_cursor (it does not for a row constructor comparison)
+            cursor.execute(
+                "SELECT ItemName, random_id, Quantity, category, last_modified FROM shop_inventory_count "
+                "WHERE last_modified > %s OR (last_modified = %s AND random_id > %s) "
+                "ORDER BY last_modified, random_id LIMIT %s",
+                (last_modified, last_modified, random_id, INVENTORY_SYNC_BATCH)
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+
+        if rows:
+            self.watermark = (rows[-1][4], str(rows[-1][1]))
+        return rows, self.watermark
+
+    def _poll_service(self):
+        result = inventory_service.call("changes_since", version = self.watermark)
+        if result.get("reload"):
+            # Further behind than the service's change history reaches, take every row again
+            result = inventory_service.call("inventory")
+            fresh = [(*row, result["version"]) for row in result["rows"]]
+        else:
+            fresh = [tuple(row) for row in result["rows"]]
+        self.watermark = result["version"]
+        return fresh, None
+
+    def _deliver(self, fresh, mirror_watermark):
+        if fresh:
+            if self.mirror is not None:
+                try:
+                    self.mirror.upsert_inventory([(random_id, item_name, quantity, category) for item_name, random_id, quantity, category, _ in fresh], mirror_watermark)
+                except Exception as e:
+                    print("Could not update the local inventory mirror:", e)
+            self.updates.put(fresh)
+        return len(fresh)
+
+
+#### Bulk inventory updates. ####
+def _apply_inventory_deltas(cursor, deltas):
+    # Push every pending delta with a fixed number of statements, no matter how many items:
+    # one multi-row INSERT into a temporary table, one UPDATE ... JOIN and one SELECT for the results.
+    # Runs on the caller's cursor, committing or rolling back is left to the caller.
+    # The temporary key has the default case-insensitive collation, like the JOIN against
+    # shop_inventory_count, so names that only differ by case would collide on it. They
+    # match the same rows anyway and are summed first.
+    merged = {}  # folded name -> [name sent to the server, delta]
+    for item_name, delta in deltas.items():
+        entry = merged.get(item_name.casefold())
+        if entry is None:
+            merged[item_name.casefold()] = [item_name, delta]
+        else:
+            entry[1] += delta
+
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS pending_deltas")
+    cursor.execute("CREATE TEMPORARY TABLE pending_deltas (ItemName VARCHAR(255) NOT NULL PRIMARY KEY, delta DOUBLE NOT NULL)")
+    cursor.executemany("INSERT INTO pending_deltas (ItemName, delta) VALUES (%s, %s)", [tuple(entry) for entry in merged.values()])
+    cursor.execute(
+        "UPDATE shop_inventory_count s JOIN pending_deltas d ON s.ItemName = d.ItemName "
+        "SET s.Quantity = s.Quantity + d.delta"
+    )
+    cursor.execute(
+        "SELECT d.ItemName, d.delta, s.Quantity FROM pending_deltas d "
+        "LEFT JOIN shop_inventory_count s ON s.ItemName = d.ItemName"
+    )
+    new_quantities = {item_name.casefold(): new_quantity for item_name, _, new_quantity in cursor.fetchall()}
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS pending_deltas")
+    # (item_name, delta, new_quantity) for every name passed in; new_quantity is None when the item does not exist
+    return [(item_name, delta, new_quantities.get(item_name.casefold())) for item_name, delta in deltas.items()]
+
+
+def _apply_delta_batches(cursor, batches, applied = None):
+    # batches is [(idempotency_key, {ItemName: delta})]. Each key is claimed in applied_deltas
+    # first; batches whose key is already there were applied before and are skipped, the
+    # rest are summed and pushed with one _apply_inventory_deltas call.
+    # applied, when given, is a set that collects the keys claimed here.
+    merged = {}
+    claimed_at = datetime.now()
+    for idempotency_key, deltas in batches:
+        cursor.execute("INSERT IGNORE INTO applied_deltas (idempotency_key, applied_at) VALUES (%s, %s)", (idempotency_key, claimed_at))
+        if cursor.rowcount != 1:
+            continue
+        if applied is not None:
+            applied.add(idempotency_key)
+        for item_name, delta in deltas.items():
+            merged[item_name] = merged.get(item_name, 0) + delta
+    return _apply_inventory_deltas(cursor, merged) if merged else []
+
+
+def apply_inventory_deltas(deltas, idempotency_key = None):
+    # deltas maps ItemName -> quantity change. All of them are applied in one transaction,
+    # nothing is applied if any statement fails. With an idempotency key a retry of the
+    # same save is a no-op (and returns no results).
+    if not deltas:
+        return []
+    if inventory_service is not None:
+        # The service batches saves from every station, each one needs its own key
+        return apply_delta_batches([(idempotency_key or uuid.uuid4().hex, deltas)])
+    if idempotency_key is not None:
+        return apply_delta_batches([(idempotency_key, deltas)])
+
+    with db_connection("save_deltas") as db:
+        cursor = db.cursor()
+        try:
+            db.start_transaction()
+            results = _apply_inventory_deltas(cursor, deltas)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            cursor.close()
+    return results
+
+
+def apply_delta_batches(batches):
+    # Several keyed delta batches (e.g. replayed from the outbox) in one transaction
+    if inventory_service is not None:
+        return [tuple(result) for result in inventory_service.call("save", batches = batches)]
+
+    with db_connection("save_deltas") as db:
+        cursor = db.cursor()
+        try:
+            db.start_transaction()
+            results = _apply_delta_batches(cursor, batches)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            cursor.close()
+    return results
+
+
+#### Offline mirror and outbox. ####
+# SQLite file with the inventory mirror and the writes still owed to the server ("off" disables it)
+LOCAL_DB_PATH = os.environ.get("INVENTORY_LOCAL_DB", "inventory_local.db")
+# Seconds between attempts to send queued quantity deltas
+OUTBOX_REPLAY_INTERVAL = float(os.environ.get("INVENTORY_OUTBOX_REPLAY_INTERVAL", "5"))
+# Outbox entries sent per server transaction
+OUTBOX_REPLAY_BATCH = 200
+# Schema version that added changes_log.idempotency_key and applied_deltas, which replays need
+OUTBOX_SCHEMA_VERSION = 5
+# Days applied_deltas remembers a key; must be longer than a station can stay offline
+APPLIED_DELTAS_RETENTION_DAYS = 90
+
+
+def is_connection_error(error):
+    # The server could not be reached (as opposed to a failing statement), the write can wait
+    return isinstance(error, (mysql.connector.errors.InterfaceError,
+                              mysql.connector.errors.OperationalError,
+                              mysql.connector.errors.PoolError,
+                              ServiceUnavailable))
+
+
+class LocalMirror:
+    # SQLite copy of shop_inventory_count plus a durable outbox of writes for the server.
+    # One connection shared by the Tk, writer, sync and replay threads behind a lock.
+    # Outbox entries are (idempotency key, kind, JSON payload): "change" holds a changes_log
+    # row, "delta" a {ItemName: delta} save. Entries are removed once the server has them.
+    def __init__(self, path = LOCAL_DB_PATH):
+        import sqlite3
+        self.lock = threading.Lock()
+        # Held while a delta batch is applied on the server and removed from the outbox, and
+        # while a sync poll reads server rows plus the outbox, so each delta is counted once
+        self.replay_lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        # Outbox writes are the only copy of a change while the server is down
+        self.db.execute("PRAGMA synchronous = FULL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS inventory ("
+            "random_id TEXT PRIMARY KEY, item_name TEXT NOT NULL, quantity REAL NOT NULL, category TEXT);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);"
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, idempotency_key TEXT NOT NULL UNIQUE, "
+            "kind TEXT NOT NULL, payload TEXT NOT NULL, created_at TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_outbox_kind ON outbox (kind, id);"
+        )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def _write(self, statements):
+        # Run (sql, params or list of params) pairs in one transaction
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for sql, params in statements:
+                    if isinstance(params, list):
+                        self.db.executemany(sql, params)
+                    else:
+                        self.db.execute(sql, params)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    # Inventory mirror
+    def _watermark_statement(self, watermark):
+        # The (last_modified, random_id) sync cursor, as a JSON pair
+        value = json.dumps([watermark[0].isoformat(), watermark[1]]) if watermark else None
+        return ("INSERT OR REPLACE INTO meta (key, value) VALUES ('watermark', ?)", (value,))
+
+    def replace_inventory(self, rows, watermark):
+        # rows are (random_id, item_name, quantity, category) for the whole table
+        try:
+            self._write([
+                ("DELETE FROM inventory", ()),
+                ("INSERT OR REPLACE INTO inventory (random_id, item_name, quantity, category) VALUES (?, ?, ?, ?)", rows),
+                self._watermark_statement(watermark),
+            ])
+        except Exception as e:
+            print("Could not save the local inventory mirror:", e)
+
+    def upsert_inventory(self, rows, watermark):
+        self._write([
+            ("INSERT INTO inventory (random_id, item_name, quantity, category) VALUES (?, ?, ?, ?) "
+             "ON CONFLICT(random_id) DO UPDATE SET item_name = excluded.item_name, quantity = excluded.quantity, category = excluded.category",
+             [(str(random_id), item_name, float(quantity or 0), category) for random_id, item_name, quantity, category in rows]),
+            self._watermark_statement(watermark),
+        ])
+
+    def add_quantities(self, deltas):
+        self._write([("UPDATE inventory SET quantity = quantity + ? WHERE item_name = ?",
+                      [(delta, item_name) for item_name, delta in deltas.items()])])
+
+    def load_inventory(self, store, on_row = None):
+        with self.lock:
+            cursor = self.db.execute("SELECT item_name, random_id, quantity, category FROM inventory")
+            store.load(cursor, on_row)
+            cursor.close()
+
+    def watermark(self):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        if not row or not row[0]:
+            return None
+        if not row[0].startswith("["):
+            # Mirrors saved before the keyset cursor only hold the timestamp
+            return datetime.fromisoformat(row[0]), ""
+        last_modified, random_id = json.loads(row[0])
+        return datetime.fromisoformat(last_modified), random_id
+
+    # Outbox
+    def enqueue(self, kind, entries):
+        # entries are (idempotency key, payload); a key already queued is ignored
+        created_at = datetime.now().isoformat()
+        self._write([("INSERT OR IGNORE INTO outbox (idempotency_key, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+                      [(key, kind, json.dumps(payload, default = encode_json_value), created_at) for key, payload in entries])])
+
+    def pending(self, kind, limit = None):
+        # Oldest first, payloads decoded back to what was queued
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT idempotency_key, payload FROM outbox WHERE kind = ? ORDER BY id" + (" LIMIT ?" if limit else ""),
+                (kind, limit) if limit else (kind,)
+            ).fetchall()
+        entries = []
+        for key, payload in rows:
+            payload = json.loads(payload)
+            if kind == "change":
+                payload = decode_change_row(payload)
+            entries.append((key, payload))
+        return entries
+
+    def remove(self, keys):
+        if keys:
+            self._write([("DELETE FROM outbox WHERE idempotency_key = ?", [(key,) for key in keys])])
+
+    def pending_count(self, kind = None):
+        with self.lock:
+            if kind is None:
+                return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            return self.db.execute("SELECT COUNT(*) FROM outbox WHERE kind = ?", (kind,)).fetchone()[0]
+
+
+def open_local_mirror(path = LOCAL_DB_PATH):
+    # None when turned off or when the file cannot be opened; the app then works online only
+    if not path or path.lower() == "off":
+        return None
+    try:
+        return LocalMirror(path)
+    except Exception as e:
+        print("Local inventory mirror unavailable:", e)
+        return None
+
+
+class OutboxReplayer:
+    # Sends quantity deltas saved while the server was unreachable, oldest first, in
+    # batches of OUTBOX_REPLAY_BATCH per transaction. applied_deltas makes a resend of a
+    # batch whose commit reply was lost a no-op. Changes_log rows are resent by ChangeLogWriter.
+    def __init__(self, mirror, interval = OUTBOX_REPLAY_INTERVAL):
+        self.mirror = mirror
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.schema_ready = False
+        # Why queued saves are not going out, for the status line (None while all is well or offline)
+        self.error = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target = self._run, name = "outbox-replay", daemon = True)
+            self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _run(self):
+        while True:
+            try:
+                if self.check_schema():
+                    self.replay_once()
+                    self.error = None
+            except Exception as e:
+                if is_connection_error(e):
+                    self.error = None
+                else:
+                    print("Replaying the outbox failed, will retry:", e)
+                    self.error = f"Queued saves could not be sent: {e}"
+            if self.stop_event.wait(self.interval):
+                break
+
+    def check_schema(self):
+        # A server without applied_deltas would reject every replay; wait until it is migrated.
+        # The service checks its own database before it accepts stations.
+        if not self.schema_ready:
+            if inventory_service is not None:
+                self.schema_ready = True
+            else:
+                missing = [version for version in pending_migrations() if version <= OUTBOX_SCHEMA_VERSION]
+                self.schema_ready = not missing
+                if missing:
+                    self.error = (f"Queued saves are held: the server needs schema migrations {missing}, "
+                                  "run 'python inven_control.py migrate'")
+        return self.schema_ready
+
+    def replay_once(self):
+        replayed = 0
+        while not self.stop_event.is_set():
+            entries = self.mirror.pending("delta", OUTBOX_REPLAY_BATCH)
+            if not entries:
+                break
+            with self.mirror.replay_lock:
+                apply_delta_batches(entries)
+                self.mirror.remove([key for key, _ in entries])
+            replayed += len(entries)
+        if replayed:
+            print(f"Sent {replayed} queued saves to the server")
+        return replayed
+
+
+def prune_applied_deltas(days = APPLIED_DELTAS_RETENTION_DAYS):
+    # Forget idempotency keys of deltas applied long ago
+    with db_connection("applied_deltas_prune") as db:
+        cursor = db.cursor()
+        cursor.execute("DELETE FROM applied_deltas WHERE applied_at < %s", (datetime.now() - timedelta(days = days),))
+        removed = cursor.rowcount
+        db.commit()
+        cursor.close()
+    return removed
+
+
+#### Cycle counting. ####
+# random_ids per SELECT ... IN (...) when locking counted rows
+CYCLE_COUNT_LOOKUP_CHUNK = 1000
+
+
+def reconcile_cycle_count(counts, emp_id):
+    # counts maps random_id -> units counted on the shelf. In one transaction: lock the
+    # counted rows, set each one's quantity to its count by random_id (items sharing a
+    # name, or differing only by case, are separate SKUs) and log the differences to
+    # changes_log (and the daily rollup). Nothing is written if any step fails.
+    # Returns (differences, missing): (random_id, item_name, system_quantity, counted) for
+    # every counted item that was off, and the random_ids with no inventory row.
+    if not counts:
+        return [], []
+    if inventory_service is not None:
+        result = inventory_service.call("cycle_count", counts = counts, emp_id = emp_id)
+        return [tuple(difference) for difference in result["differences"]], result["missing"]
+
+    ids = list(counts)
+    with db_connection("cycle_count_reconcile") as db:
+        cursor = db.cursor()
+        try:
+            db.start_transaction()
+            found = {}
+            for start in range(0, len(ids), CYCLE_COUNT_LOOKUP_CHUNK):
+                chunk = ids[start:start + CYCLE_COUNT_LOOKUP_CHUNK]
+                cursor.execute(
+                    "SELECT random_id, ItemName, Quantity FROM shop_inventory_count "
+                    f"WHERE random_id IN ({', '.join(['%s'] * len(chunk))}) FOR UPDATE",
+                    chunk
+                )
+                for random_id, item_name, quantity in cursor.fetchall():
+                    found[str(random_id)] = (item_name, float(quantity or 0))
+
+            differences = []
+            change_rows = []
+            change_time = datetime.now()
+            for random_id in ids:
+                if random_id not in found:
+                    continue
+                item_name, system_quantity = found[random_id]
+                counted = counts[random_id]
+                if counted == system_quantity:
+                    continue
+                differences.append((random_id, item_name, system_quantity, counted))
+                change_rows.append((item_name, system_quantity, counted, counted - system_quantity,
+                                    change_time.date(), change_time, emp_id, random_id, uuid.uuid4().hex))
+
+            if differences:
+                cursor.executemany(
+                    "UPDATE shop_inventory_count SET Quantity = %s WHERE random_id = %s",
+                    [(counted, random_id) for random_id, _, _, counted in differences]
+                )
+                _write_change_rows(cursor, change_rows)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    missing = [random_id for random_id in ids if random_id not in found]
+    return differences, missing
+
+#### Streaming export. ####
+# Rows per fetchmany() call and per write to the output file
+EXPORT_FETCH_SIZE = 5000
+
+# Exportable data: (columns, column kinds used for typed Parquet output)
+EXPORT_KINDS = {
+    "changes": (
+        ["item_name", "original_quantity", "new_quantity", "quantity_change", "change_date", "change_time", "emp_id", "random_id"],
+        ["str", "float", "float", "float", "date", "datetime", "int", "str"],
+    ),
+    "inventory": (
+        ["random_id", "ItemName", "category", "Quantity"],
+        ["str", "str", "str", "float"],
+    ),
+}
+
+
+def export_date(value):
+    # YYYY-MM-DD from the command line or the export dialog
+    return datetime.strptime(value.strip(), "%Y-%m-%d").date()
+
+
+def build_export_query(kind, start = None, end = None, item_name = None, emp_id = None, include_archive = False):
+    # SELECTs for one export kind with its filters; end is inclusive. Returns
+    # ([(query, params)] run one after the other, count query, count params).
+    columns, _ = EXPORT_KINDS[kind]
+    if kind == "inventory":
+        where, params = "", ()
+        if item_name:
+            where, params = " WHERE ItemName = %s", (item_name,)
+        return ([(f"SELECT {', '.join(columns)} FROM shop_inventory_count{where} ORDER BY ItemName", params)],
+                f"SELECT COUNT(*) FROM shop_inventory_count{where}", params)
+
+    conditions, params = [], []
+    if start is not None:
+        conditions.append("change_date >= %s")
+        params.append(start)
+    if end is not None:
+        conditions.append("change_date < %s")
+        params.append(end + timedelta(days = 1))
+    if item_name:
+        conditions.append("item_name = %s")
+        params.append(item_name)
+    if emp_id is not None:
+        conditions.append("emp_id = %s")
+        params.append(emp_id)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    # The archive only holds months older than anything left in changes_log, so reading it
+    # first keeps the export in date order. Each table is read along its change_date index
+    # (which ends in the primary key id) instead of sorting a UNION of both on the server.
+    tables = ["changes_log_archive", "changes_log"] if include_archive else ["changes_log"]
+    queries = [(f"SELECT {', '.join(columns)} FROM {table}{where} ORDER BY change_date, id", tuple(params)) for table in tables]
+    counts = [f"SELECT COUNT(*) FROM {table}{where}" for table in tables]
+    count_query = "SELECT " + " + ".join(f"({count})" for count in counts)
+    return queries, count_query, tuple(params) * len(tables)
+
+
+class CsvExportWriter:
+    def __init__(self, path, kind):
+        self.file = open(path, "w", newline = "")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(EXPORT_KINDS[kind][0])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetExportWriter:
+    # One row group per fetched chunk, so memory stays at a chunk's worth of rows.
+    # pyarrow is only needed for Parquet exports.
+    def __init__(self, path, kind):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+        self.pa = pa
+        columns, kinds = EXPORT_KINDS[kind]
+        types = {"str": pa.string(), "float": pa.float64(), "int": pa.int64(), "date": pa.date32(), "datetime": pa.timestamp("us")}
+        converters = {"str": str, "float": float, "int": int}
+        self.schema = pa.schema([(column, types[column_kind]) for column, column_kind in zip(columns, kinds)])
+        self.converters = [converters.get(column_kind) for column_kind in kinds]
+        self.writer = pq.ParquetWriter(path, self.schema, compression = "snappy")
+
+    def write(self, rows):
+        arrays = []
+        for index, (field, convert) in enumerate(zip(self.schema, self.converters)):
+            values = [row[index] for row in rows]
+            if convert is not None:
+                # Decimal quantities, numeric random_ids etc. are normalised to the column type
+                values = [None if value is None else convert(value) for value in values]
+            arrays.append(self.pa.array(values, type = field.type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema = self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def export_data(kind, path, export_format = None, start = None, end = None, item_name = None, emp_id = None,
+                include_archive = False, progress = None, cancel_event = None, fetch_size = EXPORT_FETCH_SIZE):
+    # Stream an export to CSV or Parquet with unbuffered cursors: rows come off the socket
+    # fetch_size at a time and go straight to the file, so memory does not grow with the
+    # export. progress(rows_written, total_rows) is called after every chunk. The file is
+    # written under a temporary name and only renamed into place once complete. The export
+    # has a connection of its own, so a cancel or an error just closes it mid-result.
+    # Returns the number of rows written, or None if cancel_event was set.
+    export_format = export_format or ("parquet" if path.lower().endswith(".parquet") else "csv")
+    queries, count_query, count_params = build_export_query(kind, start, end, item_name, emp_id, include_archive)
+    writer_class = ParquetExportWriter if export_format == "parquet" else CsvExportWriter
+    partial_path = path + ".partial"
+    written = 0
+    completed = False
+
+    with unpooled_db_connection("export") as db:
+        cursor = db.cursor()
+        cursor.execute(count_query, count_params)
+        total = cursor.fetchone()[0]
+        cursor.close()
+
+        writer = writer_class(partial_path, kind)
+        try:
+            for query, params in queries:
+                cursor = db.cursor(buffered = False)
+                cursor.execute(query, params)
+                while True:
+                    if cancel_event is not None and cancel_event.is_set():
+                        break
+                    rows = cursor.fetchmany(fetch_size)
+                    if not rows:
+                        break
+                    writer.write(rows)
+                    written += len(rows)
+                    if progress is not None:
+                        progress(written, total)
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                cursor.close()
+            else:
+                writer.close()
+                completed = True
+        finally:
+            if not completed:
+                # Cancelled or failed: close the file and drop it before anything else can
+                # raise over the real error. Rows still unread go away with the connection;
+                # closing the cursor would try to read them.
+                try:
+                    writer.close()
+                except Exception as e:
+                    print("Could not close the partial export file:", e)
+                if os.path.exists(partial_path):
+                    os.remove(partial_path)
+
+    if not completed:
+        return None
+    os.replace(partial_path, path)
+    return written
+
+
 def main_app():
+    # Pillow is only needed for the main window images
+    from PIL import Image, ImageTk
+
     # GUI window
     window = tk.Tk()
     window.title("Shop Inventory")
@@ -45,21 +2759,34 @@ def main_app():
     window.configure(background = 'light grey')
 
 
-    # Callback function to close the database connection and exit
+    # Callback function to flush the change log, close the database connections and exit
     def on_closing():
-        db.close()
+        graph_executor.shutdown(wait = False, cancel_futures = True)
+        if inventory_sync is not None:
+            inventory_sync.stop()
+        change_log_writer.stop()
+        if outbox_replayer is not None:
+            outbox_replayer.stop()
+        if inventory_service is not None:
+            inventory_service.close()
+        close_db_pool()
+        if local_mirror is not None:
+            local_mirror.close()
+        if LATENCY_EXPORT:
+            latency_stats.export_json(LATENCY_EXPORT)
+        handler_profiler.dump()
         window.destroy()
 
     # Set the callback function to be executed when the window is closed
     window.protocol("WM_DELETE_WINDOW", on_closing)
 
 
-    # Initialize the changes dictionary to track item quantity changes
+    # Initialize the changes dictionary to track item quantity changes (store row -> change)
     changes = {}
-    # inventory dictionary to store inventory data from the database
-    inventory = {}
-    # Dictionary for searching
-    search_inventory = {}
+    # Columnar inventory loaded from the database, with exact lookups by random_id / ItemName
+    inventory_store = InventoryStore()
+    # Trigram / prefix index behind the item dropdown
+    search_index = SearchIndex(inventory_store)
         
 
     def is_valid_quantity(input_str):
@@ -70,14 +2797,13 @@ def main_app():
             return False
         
 
+    @tk_handler("add_quantity")
     def add_quantity():
-        selection = item_combobox.get()
-        item_name = selection.split(" - ")[1] if " - " in selection else selection
+        # Resolve the combobox selection through the inventory store
+        row = inventory_store.resolve(item_combobox.get())
 
-        # Check if item_name is in the format stored in the inventory dictionary
-        if any(item_name in key for key in inventory):
-            # Find the full key for item_name
-            full_key = next(key for key in inventory if item_name in key)
+        if row is not None:
+            random_id, item_name = inventory_store.item(row)
             
             quantity_str = quantity_change_entry.get()
 
@@ -92,40 +2818,39 @@ def main_app():
                     return
 
             # Update the changes dictionary with the quantity change
-            if full_key in changes:
-                changes[full_key] += quantity_change
+            if row in changes:
+                changes[row] += quantity_change
             else:
-                changes[full_key] = quantity_change
+                changes[row] = quantity_change
 
             # Retrieve the original quantity before updating the inventory
-            current_quantity = inventory[full_key]["Quantity"]
+            current_quantity = inventory_store.quantity(row)
             new_quantity = current_quantity + quantity_change
 
             # Update the quantity displayed in the GUI
             quantity_label.config(text=f"Quantity: {new_quantity}")
 
             # Update the listbox before updating the inventory dictionary
-            update_change_listbox(full_key, current_quantity, quantity_change)
+            update_change_listbox(inventory_store.label(row), current_quantity, quantity_change)
 
-            # Now update the inventory dictionary with the new quantity
-            inventory[full_key]["Quantity"] = new_quantity
+            # Now update the inventory store with the new quantity
+            inventory_store.set_quantity(row, new_quantity)
         
             quantity_label.config(text=f"Quantity: {new_quantity}")
-            update_original_and_new_quantity(full_key, current_quantity, new_quantity)
-            # update_change_listbox(full_key, quantity_change)
+            update_original_and_new_quantity(item_name, current_quantity, new_quantity)
+
+            # Log the change to the database (written in the background)
+            log_change_to_db(item_name, current_quantity, new_quantity, current_user_id, random_id)
         else:
             tkinter.messagebox.showwarning("Invalid Item", "The specified item was not found in the inventory.")
 
-        log_change_to_db(item_name, current_quantity, new_quantity, current_user_id, random_id)
-
+    @tk_handler("remove_quantity")
     def remove_quantity():
-        selection = item_combobox.get()
-        item_name = selection.split(" - ")[1] if " - " in selection else selection
+        # Resolve the combobox selection through the inventory store
+        row = inventory_store.resolve(item_combobox.get())
 
-        # Check if item_name is in the format stored in the inventory dictionary
-        if any(item_name in key for key in inventory):
-            # Find the full key for item_name
-            full_key = next(key for key in inventory if item_name in key)
+        if row is not None:
+            random_id, item_name = inventory_store.item(row)
 
             quantity_str = quantity_change_entry.get()
 
@@ -140,7 +2865,7 @@ def main_app():
                     return
 
             # Capture the original quantity before making any changes
-            original_quantity = inventory[full_key]["Quantity"]
+            original_quantity = inventory_store.quantity(row)
 
             # Calculate the new quantity after subtracting the change
             new_quantity = original_quantity - quantity_change
@@ -151,23 +2876,23 @@ def main_app():
                 return
 
             # Update the changes dictionary with the quantity change
-            if full_key in changes:
-                changes[full_key] -= quantity_change
+            if row in changes:
+                changes[row] -= quantity_change
             else:
-                changes[full_key] = -quantity_change
+                changes[row] = -quantity_change
 
-            # Update the inventory with the new quantity
-            inventory[full_key]["Quantity"] = new_quantity
+            # Update the inventory store with the new quantity
+            inventory_store.set_quantity(row, new_quantity)
 
             # Update the GUI to reflect the new quantity
             quantity_label.config(text=f"Quantity: {new_quantity}")
-            update_original_and_new_quantity(full_key, original_quantity, new_quantity)
-            
-            # Log the change to the database
-            log_change_to_db(item_name, original_quantity, new_quantity, current_user_id, random_id)
+            update_original_and_new_quantity(item_name, original_quantity, new_quantity)
 
             # Update the recent changes listbox. Pass the original quantity (unchanged) and the negative quantity change
-            update_change_listbox(full_key, original_quantity, -quantity_change)
+            update_change_listbox(inventory_store.label(row), original_quantity, -quantity_change)
+
+            # Log the change to the database (written in the background)
+            log_change_to_db(item_name, original_quantity, new_quantity, current_user_id, random_id)
         else:
             tkinter.messagebox.showwarning("Invalid Item", "The specified item was not found in the inventory.")
 
@@ -176,15 +2901,23 @@ def main_app():
     def reset_quantity():
         quantity_change_entry.delete(0, tk.END)
 
+    # Pending debounced dropdown refresh
+    dropdown_job = None
+
+    @tk_handler("update_dropdown")
     def update_dropdown(*args):
-        typed = search_var.get().lower()
-        if typed:
-            # Filter and update the dropdown list to show only matching items
-            data = [f"{random_id} - {item}" for item, (random_id, _) in search_inventory.items() if typed in item.lower() or typed in random_id]
-        else:
-            # If no input, show all items
-            data = list(inventory.keys())
-        item_combobox['values'] = data
+        # Called on every keystroke; only refresh once typing pauses
+        nonlocal dropdown_job
+        if dropdown_job is not None:
+            window.after_cancel(dropdown_job)
+        dropdown_job = window.after(SEARCH_DEBOUNCE_MS, refresh_dropdown)
+
+    @tk_handler("refresh_dropdown")
+    def refresh_dropdown():
+        nonlocal dropdown_job
+        dropdown_job = None
+        # Ranked, capped matches from the search index (all items, capped, when nothing is typed)
+        item_combobox['values'] = search_index.search(search_var.get(), SEARCH_RESULT_LIMIT)
 
     search_var = tk.StringVar(window)
     search_var.trace('w', update_dropdown)
@@ -196,11 +2929,15 @@ def main_app():
 
     # Create frames for each tab
     daily_frame = ttk.Frame(toc_notebook)
-    # weekly_frame = ttk.Frame(toc_notebook)
-    # monthly_frame = ttk.Frame(toc_notebook)
+    weekly_frame = ttk.Frame(toc_notebook)
+    monthly_frame = ttk.Frame(toc_notebook)
     toc_notebook.add(daily_frame, text = 'Daily Usage')
-    # toc_notebook.add(weekly_frame, text = 'Weekly Usage')
-    # toc_notebook.add(monthly_frame, text='Monthly Usage')
+    toc_notebook.add(weekly_frame, text = 'Weekly Usage')
+    toc_notebook.add(monthly_frame, text='Monthly Usage')
+    compare_frame = ttk.Frame(toc_notebook)
+    toc_notebook.add(compare_frame, text = 'Compare')
+    low_stock_frame = ttk.Frame(toc_notebook)
+    toc_notebook.add(low_stock_frame, text = 'Low Stock')
 
     # Dropdown for month selection
     months = ['All Months'] + [datetime(2000, m, 1).strftime('%B') for m in range(1, 13)]  # List of months with 'All Months' as the first option
@@ -211,148 +2948,342 @@ def main_app():
 
     toc_frames = {
         "Daily Usage": daily_frame,
+        "Weekly Usage": weekly_frame,
+        "Monthly Usage": monthly_frame,
     }
 
     
+    # Graph data is loaded on worker threads and handed back to the Tk thread via window.after
+    graph_executor = ThreadPoolExecutor(max_workers = 2, thread_name_prefix = "graph-loader")
+    graph_results = queue.Queue()
+    graph_request_id = 0     # id of the newest graph request, older results are dropped
+    compare_request_id = 0   # same for the Compare tab
+    graph_future = None
+    # One reusable graph per tab, created the first time the tab draws
+    usage_graphs = {}
+
+
+    def get_usage_graph(time_period):
+        if time_period not in usage_graphs:
+            usage_graphs[time_period] = UsageGraph(toc_frames[time_period])
+        return usage_graphs[time_period]
+
+
+    def show_graph_placeholder(time_period, text):
+        get_usage_graph(time_period).show_message(text)
+
+
+    def selected_quantity(item_name):
+        # Current in-memory quantity of an item, used as the end point of the stock line
+        row = inventory_store.resolve(item_name)
+        return inventory_store.quantity(row) if row is not None else None
+
+
+    @tk_handler("draw_graph")
     def draw_graph(item_name, time_period, selected_month = None):
-        global graph_canvas
-        
+        nonlocal graph_request_id, graph_future
+
         # If no item is selected, do nothing
         if not item_name:
             return
 
-        # Clear previous graph if it exists
-        if graph_canvas:
-            graph_canvas.get_tk_widget().destroy()
+        # Newer selections replace older ones; a request that has not started yet is cancelled
+        graph_request_id += 1
+        if graph_future is not None:
+            graph_future.cancel()
 
-        # Connect to the database
-        db = mysql.connector.connect(
-            host='localhost',
-            user='root',
-            password='peter',
-            database='shop_inventory'
-        )
-        cursor = db.cursor()
+        current_quantity = selected_quantity(item_name)
+        if graph_cache.get((item_name, "daily series")) is not None:
+            # The item's series is already in memory: switching tabs or months is only a resample
+            render_graph(time_period, *prepare_graph_data(item_name, time_period, selected_month, current_quantity))
+            return
 
-        # SQL query to filter data based on the selected month
-        month_condition = ""
-        if selected_month and selected_month != 'All Months':
-            month_number = datetime.strptime(selected_month, '%B').month
-            month_condition = f" AND MONTH(change_date) = {month_number}"
-
-        # base query with GROUP BY clause
-        base_query = """
-            SELECT DATE(change_date) as date, SUM(quantity_change) as total_change 
-            FROM changes_log 
-            WHERE item_name = %s
-            """
-
-        # Append month condition if necessary
-        if selected_month and selected_month != 'All Months':
-            month_number = datetime.strptime(selected_month, '%B').month
-            base_query += f" AND MONTH(change_date) = {month_number}"
-
-        # Define group and order clauses based on the time period
-        if time_period == "Daily Usage":
-            base_query += " GROUP BY DATE(change_date) ORDER BY DATE(change_date)"
-        else:  # Weekly Usage
-            base_query += " GROUP BY YEARWEEK(change_date) ORDER BY YEARWEEK(change_date)"
-
-        # Execute the query
-        cursor.execute(base_query, (item_name,))
-
-        # Fetch the data
-        data = cursor.fetchall()
-        
-        # Process the data to create a list of dates, but only include valid date strings
-        dates = []
-        for x in data:
-            if x[0] is not None:
+        show_graph_placeholder(time_period, "Loading graph...")
+        request_id = graph_request_id
+        graph_future = graph_executor.submit(prepare_graph_data, item_name, time_period, selected_month, current_quantity)
+        graph_future.add_done_callback(lambda future: graph_results.put((request_id, time_period, future)))
+
+
+    def poll_graph_results():
+        # Runs on the Tk thread, picks up finished graph loads
+        try:
+            while True:
+                request_id, time_period, future = graph_results.get_nowait()
+                if time_period == "Compare":
+                    if request_id == compare_request_id and not future.cancelled():
+                        render_comparison(future)
+                    continue
+                if time_period == "Low Stock":
+                    if request_id == low_stock_request_id and not future.cancelled():
+                        render_low_stock(future)
+                    continue
+                if request_id != graph_request_id or future.cancelled():
+                    continue  # stale request, the user already picked something else
                 try:
-                    date = datetime.strptime(str(x[0]), "%Y-%m-%d")
-                    dates.append(date)
-                except ValueError:
-                    # If the date string is in the wrong format, skip it
+                    dates, quantities, stock = future.result()
+                except Exception as e:
+                    print("Failed to load graph data:", e)
+                    show_graph_placeholder(time_period, "Could not load graph data.")
                     continue
+                render_graph(time_period, dates, quantities, stock)
+        except queue.Empty:
+            pass
+        window.after(50, poll_graph_results)
 
-        quantities = [x[1] for x in data if x[0] is not None]
-
-        fig, ax = plt.subplots(figsize=(8, 4))  # Adjust the size of plots
 
+    @tk_handler("render_graph")
+    def render_graph(time_period, dates, quantities, stock):
         # Check if dates list is empty
         if not dates:
             # empty list case here
             print("No data available for the selected item and time period.")
+            show_graph_placeholder(time_period, "No data available for the selected item and time period.")
             return  # Skip drawing the graph
 
-        ax.plot(dates, quantities, marker='o')  # Add markers for each data point
-        plt.subplots_adjust(bottom=0.2)
-
-        # if tab selected is Daily usage
-        if time_period == "Daily Usage":
-            first_date = dates[0].replace(day=1)  # First day of the month
-            last_day = calendar.monthrange(dates[0].year, dates[0].month)[1]  # Get the last day of the month
-            last_date = dates[0].replace(day=last_day)  # Last day of the month
-            dates_range = mdates.drange(first_date, last_date + timedelta(days=1), timedelta(days=1))
-            ax.set_xticks(dates_range)
-            ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-            plt.xticks(rotation=90, fontsize=6)
-        elif time_period == "Weekly Usage":
-            start_dates = [datetime.strptime(f'{date}-1', "%Y%W-%w") for date in dates]
-            # Add one more week
-            last_week = start_dates[-1] + timedelta(weeks=1)
-            start_dates.append(last_week)
-            ax.set_xticks(range(len(start_dates)))  # Set x-ticks to be the start dates of weeks
-            ax.set_xticklabels([date.strftime('%Y-%W') for date in start_dates], rotation=45)  # Year-Week format
-
-
-        # Check if the data list is empty or has only one data point
-        if not data or len(data) == 1:
-            # Handle the empty or single data point case
-            if not data:
-                print("No data available for the selected item and time period.")
-                # You might want to clear the previous plot or display a message on the plot
-            else:
-                # If there's only one point, plot it with additional settings
-                single_date = datetime.strptime(str(data[0][0]), "%Y-%m-%d")
-                single_quantity = data[0][1]
-                ax.plot(single_date, single_quantity, 'o')  # Plot the single point
+        # Update the tab's existing figure in place
+        get_usage_graph(time_period).show(time_period, dates, quantities, stock)
 
-                # Set a reasonable range around the single date for x-axis
-                start_date = single_date - timedelta(days=10)
-                end_date = single_date + timedelta(days=15)
-                ax.set_xlim(start_date, end_date)
 
-                # Formatting the date on the x-axis
-                ax.xaxis.set_major_locator(mdates.DayLocator(interval=5))  # Show every 5 days
-                ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
-                plt.xticks(rotation=90, fontsize=6)
+    # Compare tab: several items (or a whole category) from one grouped query
+    compare_items = []
+    comparison_graph = None
+    compare_controls = ttk.Frame(compare_frame)
+    compare_controls.pack(side = tk.TOP, fill = tk.X, padx = 5, pady = 5)
+    compare_item_var = tk.StringVar(window)
+    compare_item_combobox = ttk.Combobox(compare_controls, textvariable = compare_item_var, width = 28)
+    compare_category_var = tk.StringVar(window)
+    compare_category_combobox = ttk.Combobox(compare_controls, textvariable = compare_category_var, state = "readonly", width = 16)
+    compare_period_var = tk.StringVar(window, value = "Daily Usage")
+    compare_period_combobox = ttk.Combobox(compare_controls, textvariable = compare_period_var, values = list(TAB_GRANULARITY), state = "readonly", width = 14)
+    compare_stacked_var = tk.BooleanVar(window, value = False)
+    compare_listbox = tk.Listbox(compare_frame, height = 3, selectmode = tk.EXTENDED)
 
-        # Embedding the figure in the Tkinter window
-        graph_canvas = FigureCanvasTkAgg(fig, master=toc_frames[time_period])
-        graph_canvas.draw()
-        graph_widget = graph_canvas.get_tk_widget()
-        graph_widget.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
-        # Close the database connection
-        cursor.close()
-        db.close()
+    def refresh_compare_list():
+        compare_listbox.delete(0, tk.END)
+        for item_name in compare_items:
+            compare_listbox.insert(tk.END, item_name)
+
+
+    def add_compare_rows(rows):
+        for row in rows:
+            item_name = inventory_store.name(row)
+            if item_name not in compare_items and len(compare_items) < COMPARE_MAX_ITEMS:
+                compare_items.append(item_name)
+        refresh_compare_list()
+
+
+    def add_compare_item():
+        row = inventory_store.resolve(compare_item_var.get())
+        if row is None:
+            tkinter.messagebox.showwarning("Invalid Item", "The specified item was not found in the inventory.")
+            return
+        add_compare_rows([row])
+
+
+    def add_compare_category():
+        add_compare_rows(inventory_store.rows_in_category(compare_category_var.get()))
+
+
+    def remove_compare_items():
+        for position in reversed(compare_listbox.curselection()):
+            del compare_items[position]
+        refresh_compare_list()
+
+
+    @tk_handler("draw_comparison")
+    def draw_comparison():
+        nonlocal compare_request_id, comparison_graph
+        if not compare_items:
+            return
+        if comparison_graph is None:
+            comparison_graph = ComparisonGraph(compare_frame)
+        comparison_graph.show_message("Loading graph...")
+
+        start = end = None
+        if month_var.get() != 'All Months':
+            start, end = month_date_range(month_var.get())
+        compare_request_id += 1
+        request_id = compare_request_id
+        future = graph_executor.submit(fetch_comparison_series, list(compare_items), TAB_GRANULARITY[compare_period_var.get()], start, end)
+        future.add_done_callback(lambda future: graph_results.put((request_id, "Compare", future)))
+
+
+    # Pending debounced refresh of the Compare item dropdown
+    compare_dropdown_job = None
+
+    @tk_handler("update_compare_dropdown")
+    def update_compare_dropdown(event = None):
+        # Called on every keystroke; only search once typing pauses, like the main item box
+        nonlocal compare_dropdown_job
+        if compare_dropdown_job is not None:
+            window.after_cancel(compare_dropdown_job)
+        compare_dropdown_job = window.after(SEARCH_DEBOUNCE_MS, refresh_compare_dropdown)
+
+    @tk_handler("refresh_compare_dropdown")
+    def refresh_compare_dropdown():
+        nonlocal compare_dropdown_job
+        compare_dropdown_job = None
+        compare_item_combobox.configure(values = search_index.search(compare_item_var.get(), SEARCH_RESULT_LIMIT))
+
+
+    def render_comparison(future):
+        try:
+            item_names, periods, matrix = future.result()
+        except Exception as e:
+            print("Failed to load comparison data:", e)
+            comparison_graph.show_message("Could not load graph data.")
+            return
+        if not len(periods):
+            comparison_graph.show_message("No data available for the selected items and time period.")
+            return
+        comparison_graph.show(item_names, periods, matrix, stacked = compare_stacked_var.get())
+
+
+    compare_item_combobox.bind("<KeyRelease>", update_compare_dropdown)
+    compare_item_combobox.pack(side = tk.LEFT)
+    ttk.Button(compare_controls, text = "Add Item", command = add_compare_item).pack(side = tk.LEFT, padx = 2)
+    compare_category_combobox.pack(side = tk.LEFT, padx = (8, 0))
+    ttk.Button(compare_controls, text = "Add Category", command = add_compare_category).pack(side = tk.LEFT, padx = 2)
+    compare_period_combobox.pack(side = tk.LEFT, padx = (8, 0))
+    ttk.Checkbutton(compare_controls, text = "Stacked", variable = compare_stacked_var).pack(side = tk.LEFT, padx = 4)
+    ttk.Button(compare_controls, text = "Remove", command = remove_compare_items).pack(side = tk.LEFT, padx = 2)
+    ttk.Button(compare_controls, text = "Compare", command = draw_comparison).pack(side = tk.LEFT, padx = 2)
+    compare_listbox.pack(side = tk.TOP, fill = tk.X, padx = 5)
+
+
+    # Low Stock tab: whole-catalog forecast computed on a worker, sorted on the arrays
+    low_stock_columns = [
+        ("item", "Item", 220),
+        ("quantity", "Qty", 60),
+        ("burn_rate", "Used / day", 80),
+        ("recent_rate", f"Last {FORECAST_RECENT_DAYS} days / day", 110),
+        ("days_left", "Days left", 70),
+        ("reorder_point", "Reorder at", 80),
+    ]
+    low_stock_forecast = None            # arrays from forecast_low_stock
+    low_stock_sort = ("days_left", False)
+    low_stock_request_id = 0
+    low_stock_computed_at = None
+    low_stock_controls = ttk.Frame(low_stock_frame)
+    low_stock_controls.pack(side = tk.TOP, fill = tk.X, padx = 5, pady = 5)
+    low_stock_only_var = tk.BooleanVar(window, value = True)
+    low_stock_status_label = ttk.Label(low_stock_controls, text = "")
+    low_stock_tree = ttk.Treeview(low_stock_frame, columns = [column for column, _, _ in low_stock_columns], show = "headings", height = 12)
+    for column, title, width in low_stock_columns:
+        low_stock_tree.heading(column, text = title, command = lambda column = column: sort_low_stock(column))
+        low_stock_tree.column(column, width = width, anchor = 'w' if column == "item" else 'e')
+    low_stock_scrollbar = ttk.Scrollbar(low_stock_frame, orient = tk.VERTICAL, command = low_stock_tree.yview)
+    low_stock_tree.configure(yscrollcommand = low_stock_scrollbar.set)
+
+
+    def refresh_low_stock():
+        nonlocal low_stock_request_id
+        low_stock_status_label.config(text = "Calculating...")
+        low_stock_request_id += 1
+        request_id = low_stock_request_id
+        # Snapshot on the Tk thread; the worker must not read arrays the sync may resize
+        quantities = inventory_store.quantities[:]
+        names = inventory_store.names[:]
+
+        def compute():
+            started = time.perf_counter()
+            usage_rows = fetch_daily_consumption()
+            fetched = time.perf_counter()
+            with latency_stats.timer("forecast.compute"):
+                # Temporary name index for this run only
+                row_for_name = {item_name: row for row, item_name in enumerate(names)}
+                forecast = forecast_low_stock(quantities, row_for_name, usage_rows)
+            return forecast, (fetched - started) * 1000, (time.perf_counter() - fetched) * 1000
+
+        future = graph_executor.submit(compute)
+        future.add_done_callback(lambda future: graph_results.put((request_id, "Low Stock", future)))
+
+
+    def render_low_stock(future):
+        nonlocal low_stock_forecast, low_stock_computed_at
+        try:
+            low_stock_forecast, query_ms, compute_ms = future.result()
+        except Exception as e:
+            print("Failed to compute the low stock forecast:", e)
+            low_stock_status_label.config(text = "Could not calculate the forecast.")
+            return
+        low_stock_computed_at = time.monotonic()
+        below = int(low_stock_forecast["below_reorder"].sum())
+        low_stock_status_label.config(text = f"{below} items at or below their reorder point "
+                                             f"(query {query_ms:.0f} ms, forecast {compute_ms:.0f} ms)")
+        show_low_stock()
+
+
+    def show_low_stock():
+        if low_stock_forecast is None:
+            return
+        column, descending = low_stock_sort
+        rows = np.flatnonzero(low_stock_forecast["below_reorder"]) if low_stock_only_var.get() else np.arange(len(low_stock_forecast["quantity"]))
+        if column == "item":
+            order = sorted(rows.tolist(), key = lambda row: inventory_store.name(row).casefold(), reverse = descending)
+        else:
+            keys = low_stock_forecast[column][rows]
+            order = rows[np.argsort(-keys if descending else keys, kind = "stable")].tolist()
+
+        low_stock_tree.delete(*low_stock_tree.get_children())
+        for row in order[:LOW_STOCK_DISPLAY_LIMIT]:
+            days_left = low_stock_forecast["days_left"][row]
+            low_stock_tree.insert("", tk.END, iid = str(row), values = (
+                inventory_store.label(row),
+                f"{low_stock_forecast['quantity'][row]:g}",
+                f"{low_stock_forecast['burn_rate'][row]:.2f}",
+                f"{low_stock_forecast['recent_rate'][row]:.2f}",
+                "-" if np.isinf(days_left) else f"{days_left:.1f}",
+                f"{low_stock_forecast['reorder_point'][row]:.1f}",
+            ))
+
+
+    def sort_low_stock(column):
+        nonlocal low_stock_sort
+        current_column, descending = low_stock_sort
+        low_stock_sort = (column, not descending if column == current_column else False)
+        show_low_stock()
+
+
+    def open_low_stock_item(event):
+        # Double-click an item to select it in the main window
+        selection = low_stock_tree.selection()
+        if selection:
+            item_combobox.set(inventory_store.label(int(selection[0])))
+            item_selected(None)
+
+
+    ttk.Button(low_stock_controls, text = "Refresh", command = refresh_low_stock).pack(side = tk.LEFT, padx = 2)
+    ttk.Checkbutton(low_stock_controls, text = "Only at or below reorder point", variable = low_stock_only_var, command = show_low_stock).pack(side = tk.LEFT, padx = 4)
+    low_stock_status_label.pack(side = tk.LEFT, padx = 8)
+    low_stock_tree.bind("<Double-1>", open_low_stock_item)
+    low_stock_scrollbar.pack(side = tk.RIGHT, fill = tk.Y, padx = (0, 5))
+    low_stock_tree.pack(side = tk.TOP, fill = tk.BOTH, expand = True, padx = (5, 0), pady = (0, 5))
+
+
+    def current_tab_name():
+        return toc_notebook.tab(toc_notebook.index("current"), "text")
 
 
     def on_tab_selected(event):
-        selected_tab = event.widget.tab(event.widget.index("current"), "text")
-        selected_item = item_combobox.get().split(" - ")[1] if " - " in item_combobox.get() else None
-        if selected_item:
-            if selected_tab in ["Daily Usage", "Weekly Usage"]:  # Remove "Monthly Usage" from the condition
-                draw_graph(selected_item, selected_tab)
+        selected_tab = current_tab_name()
+        if selected_tab == "Low Stock":
+            # Recalculate when first opened and when the last forecast is over a minute old
+            if low_stock_computed_at is None or time.monotonic() - low_stock_computed_at > 60:
+                refresh_low_stock()
+            return
+        selected_item = item_combobox.get().split(" - ", 1)[1] if " - " in item_combobox.get() else None
+        if selected_item and selected_tab in TAB_GRANULARITY:
+            draw_graph(selected_item, selected_tab, month_var.get())
 
 
     # Function to update the graph when a new month is selected
     def update_graph_for_month(event):
         selected_month = month_var.get()
-        selected_item = item_combobox.get().split(" - ")[1] if " - " in item_combobox.get() else None
-        selected_tab = toc_notebook.tab(toc_notebook.index("current"), "text")
-        if selected_item:
+        selected_item = item_combobox.get().split(" - ", 1)[1] if " - " in item_combobox.get() else None
+        selected_tab = current_tab_name()
+        if selected_item and selected_tab in TAB_GRANULARITY:
             draw_graph(selected_item, selected_tab, selected_month)
 
 
@@ -361,19 +3292,8 @@ def main_app():
         # Calculate the new quantity
         new_quantity = original_quantity + quantity_change if quantity_change >= 0 else original_quantity - abs(quantity_change)
 
-        # Determine the operation symbol and format the change appropriately
-        operation = "+" if quantity_change >= 0 else "-"
-        adjusted_quantity_change = abs(quantity_change)
-
-        # Format the change text correctly for display in the listbox
-        change_text = f"{item_key}: {original_quantity} {operation} {adjusted_quantity_change} = {new_quantity}"
-
-        # Insert the formatted change text into the listbox
-        changes_listbox.insert(tk.END, change_text)
-
-        # Split item_key to get just the item name for logging to the database
-        item_name = item_key.split(" ")[1]
-        log_change_to_db(item_name, original_quantity, new_quantity, current_user_id, random_id)
+        # Add the change to the bounded Recent Changes list (newest first)
+        recent_changes.add(ChangeRecord(item_key, original_quantity, quantity_change, new_quantity, datetime.now()))
 
 
     def update_original_and_new_quantity(item_name, original_quantity, new_quantity):
@@ -381,162 +3301,507 @@ def main_app():
         new_label.config(text = f"New Quantity: {new_quantity}")
 
 
-    def item_selected(event):
-        # Extract the item name from the selection
-        selection = item_combobox.get()
-        item_name = selection.split(" - ")[1] if " - " in selection else selection
-        original_quantity = inventory.get(selection, {}).get("Quantity", "N/A")
-        update_original_and_new_quantity(item_name, original_quantity, original_quantity)
-        current_tab = toc_notebook.tab(toc_notebook.index("current"), "text").lower()
-        draw_graph(item_name, current_tab)
-
-
+    @tk_handler("item_selected")
     def item_selected(event):
         selection = item_combobox.get()
-        item_name = selection.split(" - ")[1] if " - " in selection else selection
-        original_quantity = inventory.get(selection, {}).get("Quantity", "N/A")
+        row = inventory_store.resolve(selection)
+        if row is not None:
+            item_name = inventory_store.name(row)
+            original_quantity = inventory_store.quantity(row)
+        else:
+            item_name = selection.split(" - ", 1)[1] if " - " in selection else selection
+            original_quantity = "N/A"
         update_original_and_new_quantity(item_name, original_quantity, original_quantity)
-        current_tab = toc_notebook.tab(toc_notebook.index("current"), "text")
-        if item_name:
-            draw_graph(item_name, current_tab)
+        current_tab = current_tab_name()
+        if item_name and current_tab in TAB_GRANULARITY:
+            draw_graph(item_name, current_tab, month_var.get())
     
 
     def confirm_large_change(quantity_change):
         return tkinter.messagebox.askyesno("Confirm Large Change", f"Are you sure you want to change the quantity by {quantity_change}?")
 
 
+    @tk_handler("save_changes")
     def save_changes():
         # Display a confirmation dialog
         confirmation = tkinter.messagebox.askyesno("Confirm Changes", "Are you sure you want to save the changes?")
 
         if confirmation:
-            # Connect to the MySQL database
-            db = mysql.connector.connect(
-                host='localhost',
-                database='shop_inventory',
-                user='root',
-                password='peter'
-            )
-            cursor = db.cursor()
+            # Combine the pending changes per ItemName
+            deltas = {}
+            for row, quantity_change in changes.items():
+                item_name = inventory_store.name(row)
+                deltas[item_name] = deltas.get(item_name, 0) + quantity_change
+
+            # Apply all of them in one transaction; the key makes a resend of this save a no-op
+            save_key = uuid.uuid4().hex
+            try:
+                results = apply_inventory_deltas(deltas, save_key)
+            except Exception as e:
+                if local_mirror is None or not is_connection_error(e):
+                    tkinter.messagebox.showerror("Save Failed", f"No changes were saved, the database rolled back.\n\n{e}")
+                    return
+                # Server unreachable: keep the save in the outbox, it is sent when the server is back
+                try:
+                    local_mirror.enqueue("delta", [(save_key, deltas)])
+                    local_mirror.add_quantities(deltas)
+                except Exception as local_error:
+                    tkinter.messagebox.showerror("Save Failed", f"The server is unreachable and the changes could not be queued locally.\n\n{local_error}")
+                    return
+                changes.clear()
+                tkinter.messagebox.showinfo("Saved Offline", "The database server could not be reached. The changes were saved on this station and will be sent automatically once the server is back.")
+                on_closing()
+                return
 
-            # Apply the changes to the database
-            for key, quantity_change in changes.items():
-                item_name = key.split(" - ")[1]  # Extract the actual ItemName
-                update_query = f"UPDATE shop_inventory_count SET Quantity = Quantity + {quantity_change} WHERE ItemName = '{item_name}'"
-                cursor.execute(update_query)
+            # Saved quantities now come from the server, nothing is pending any more
+            changes.clear()
 
-            # Commit the changes and close the database connection
-            db.commit()
-            db.close()
+            # Report items that did not match a row in shop_inventory_count
+            missing = [item_name for item_name, _, new_quantity in results if new_quantity is None]
+            if missing:
+                tkinter.messagebox.showwarning("Items Not Found", "These items were not found and were not updated:\n" + "\n".join(missing))
+            for item_name, delta, new_quantity in results:
+                if new_quantity is not None:
+                    print(f"Saved {item_name}: {delta:+} -> {new_quantity}")
 
-            # Close the GUI window
-            window.destroy()
+            # Flush the change log and close the GUI window
+            on_closing()
 
 
     def get_item_data_from_db(random_id):
-        db = mysql.connector.connect(
-            host = 'localhost',
-            user = 'root',
-            password = 'peter',
-            database = 'shop_inventory'
-        )
-        cursor = db.cursor()
-
         # Query to find an item by its random_id
         query = "SELECT category, ItemName, quantity, random_id FROM shop_inventory_count WHERE random_id = %s"
-        print("Executing query:", query)  # Debugging line
-        print("With random_id:", random_id)  # Debugging line
 
         try:
-            cursor.execute(query, (random_id,))
-            item_data = cursor.fetchone()
-            print("Query result:", item_data)  # Debugging line
+            if inventory_service is not None:
+                item_data = inventory_service.call("lookup", random_id = random_id)
+                item_data = tuple(item_data) if item_data else None
+            else:
+                with db_connection("scan_lookup") as db:
+                    cursor = db.cursor()
+                    cursor.execute(query, (random_id,))
+                    item_data = cursor.fetchone()
+                    cursor.close()
         except Exception as e:
             print("An error occurred while executing the query:", e)
             item_data = None
 
-        cursor.close()
-        db.close()
-
         return item_data
 
+    # Only one scanner window at a time; results reach the Tk thread through scan_results
+    active_scanner = None
+    scan_results = queue.Queue()
+
     def scan_code():
+        nonlocal active_scanner
         print("scan_code called")
-        scanner_thread = threading.Thread(target = run_scanner)
+        if active_scanner is not None:
+            return
+        active_scanner = ScannerPipeline(handle_scanned_code)
+        scanner_thread = threading.Thread(target = run_scanner, args = (active_scanner,), daemon = True)
         scanner_thread.start()
 
-    def run_scanner():
+    def handle_scanned_code(qr_data, captured_at):
+        # Runs on a decoder thread
+        print("Scanned Code:", qr_data)
+        random_id = scanned_random_id(qr_data)
+        if random_id is None:
+            return
+
+        # Look the code up in the in-memory store first, only ask the database for unknown ids
+        with latency_stats.timer("scanner.lookup"):
+            row = inventory_store.row_for_id(random_id)
+            if row is not None:
+                item_data = (inventory_store.category(row), inventory_store.name(row), inventory_store.quantity(row), random_id)
+            else:
+                item_data = get_item_data_from_db(random_id)
+
+        if item_data:
+            category, ItemName, quantity, _ = item_data
+            print(f"Item found: {ItemName}, Category: {category}, Quantity: {quantity}")
+            latency_stats.record("scanner.scan_to_result", (time.monotonic() - captured_at) * 1000)
+            scan_results.put((row, item_data))
+            # One successful lookup closes the scanner
+            scanner = active_scanner
+            if scanner is not None:
+                scanner.stop()
+        else:
+            print("Item not found in database")
+
+    def poll_scan_results():
+        # Runs on the Tk thread, shows the scanned item in the main window
+        try:
+            while True:
+                row, item_data = scan_results.get_nowait()
+                if row is not None:
+                    item_combobox.set(inventory_store.label(row))
+                    item_selected(None)
+                else:
+                    category, ItemName, quantity, random_id = item_data
+                    tkinter.messagebox.showinfo("Scanned Item", f"{random_id} - {ItemName}\nCategory: {category}\nQuantity: {quantity}")
+        except queue.Empty:
+            pass
+        window.after(50, poll_scan_results)
+
+    def run_scanner(scanner):
+        nonlocal active_scanner
         print("run_scanner started")
         try:
-            # start camera
-            cap = cv2.VideoCapture(0)
-            if not cap.isOpened():
-                print("Unable to access the camera")
+            scanner.run()
+        except Exception as e:
+            print("An error occurred in run_scanner:", e)
+        finally:
+            active_scanner = None
+            print("Scanner stopped")
+
+
+    # Cycle count: continuous scanning tallied in memory, reconciled with one transaction at the end
+    cycle_count_window = None
+
+    def open_cycle_count():
+        nonlocal cycle_count_window
+        if cycle_count_window is not None:
+            cycle_count_window.lift()
+            return
+
+        counts = {}  # random_id -> units counted, only touched on the Tk thread
+        count_scans = queue.Queue()
+        count_scanner = None
+
+        count_window = tk.Toplevel(window)
+        count_window.title("Cycle Count")
+        cycle_count_window = count_window
+
+        count_tree = ttk.Treeview(count_window, columns = ("item", "counted", "on_hand"), show = "headings", height = 15)
+        count_tree.heading("item", text = "Item")
+        count_tree.heading("counted", text = "Counted")
+        count_tree.heading("on_hand", text = "On Hand")
+        count_tree.column("item", width = 280)
+        count_tree.column("counted", width = 80, anchor = 'e')
+        count_tree.column("on_hand", width = 80, anchor = 'e')
+        count_scrollbar = ttk.Scrollbar(count_window, orient = tk.VERTICAL, command = count_tree.yview)
+        count_tree.configure(yscrollcommand = count_scrollbar.set)
+        count_status_label = tk.Label(count_window, text = "Start scanning to count items", anchor = 'w')
+
+        def handle_count_scan(qr_data, captured_at):
+            # Runs on a decoder thread; no lookups here, the tally happens on the Tk thread
+            random_id = scanned_random_id(qr_data)
+            if random_id is not None:
+                count_scans.put(random_id)
+
+        def show_status():
+            count_status_label.config(text = f"{len(counts)} items, {sum(counts.values()):g} units counted")
+
+        def show_count(random_id):
+            row = inventory_store.row_for_id(random_id)
+            if row is not None:
+                values = (inventory_store.label(row), counts[random_id], inventory_store.quantity(row))
+            else:
+                values = (f"{random_id} - (not in inventory)", counts[random_id], "")
+            if count_tree.exists(random_id):
+                count_tree.item(random_id, values = values)
+            else:
+                count_tree.insert("", 0, iid = random_id, values = values)
+            count_tree.selection_set(random_id)
+            count_tree.see(random_id)
+
+        def poll_count_scans():
+            if cycle_count_window is not count_window:
+                return
+            scanned = False
+            try:
+                while True:
+                    random_id = count_scans.get_nowait()
+                    counts[random_id] = counts.get(random_id, 0) + 1
+                    show_count(random_id)
+                    scanned = True
+            except queue.Empty:
+                pass
+            if scanned:
+                show_status()
+            count_window.after(50, poll_count_scans)
+
+        def start_scanning():
+            nonlocal active_scanner, count_scanner
+            if active_scanner is not None:
+                tkinter.messagebox.showwarning("Scanner Busy", "The scanner is already open.", parent = count_window)
+                return
+            count_scanner = ScannerPipeline(handle_count_scan, repeat_window = SCANNER_COUNT_REPEAT_WINDOW, rearm_on_sight = True)
+            active_scanner = count_scanner
+            threading.Thread(target = run_scanner, args = (count_scanner,), daemon = True).start()
+
+        def stop_scanning():
+            if count_scanner is not None:
+                count_scanner.stop()
+
+        def adjust_selected(step):
+            for random_id in count_tree.selection():
+                counts[random_id] = max(0, counts[random_id] + step)
+                show_count(random_id)
+            show_status()
+
+        def remove_selected():
+            for random_id in count_tree.selection():
+                counts.pop(random_id, None)
+                count_tree.delete(random_id)
+            show_status()
+
+        def reconcile():
+            if not counts:
+                tkinter.messagebox.showinfo("Cycle Count", "Nothing has been counted yet.", parent = count_window)
+                return
+            stop_scanning()
+            if not tkinter.messagebox.askyesno("Reconcile Count", f"Set the {len(counts)} counted items to their counted quantities?\nDifferences are written to the change log.", parent = count_window):
                 return
 
-            cap.set(3, 640)  # Set width
-            cap.set(4, 480)  # Set height
-            camera = True    # camera is on
+            try:
+                differences, missing = reconcile_cycle_count(dict(counts), current_user_id)
+            except Exception as e:
+                tkinter.messagebox.showerror("Reconcile Failed", f"Nothing was changed, the database rolled back.\n\n{e}", parent = count_window)
+                return
 
-            while camera:
-                success, frame = cap.read()
-                if not success:
-                    print("Failed to grab frame") # camera did not open
-                    break
-                
-                # scan code in front of camera
-                decoded_objects = decode(frame)
-                if decoded_objects:
-                    for code in decoded_objects:
-                        qr_data = code.data.decode('utf-8')
-                        print("Scanned Code:", qr_data)
+            graph_cache.invalidate_items({item_name for _, item_name, _, _ in differences})
+            selected_row = inventory_store.resolve(item_combobox.get())
+            for random_id, item_name, system_quantity, counted in differences:
+                row = inventory_store.row_for_id(random_id)
+                if row is None:
+                    continue
+                # Unsaved changes made on this station stay on top of the counted quantity
+                local_quantity = counted + changes.get(row, 0)
+                inventory_store.set_quantity(row, local_quantity)
+                update_change_listbox(inventory_store.label(row), system_quantity, counted - system_quantity)
+                if row == selected_row:
+                    quantity_label.config(text = f"Quantity: {local_quantity}")
+                    update_original_and_new_quantity(item_name, counted, local_quantity)
+
+            summary = f"{len(counts)} items counted, {len(differences)} adjusted."
+            if missing:
+                summary += "\n\nThese codes are not in the inventory and were skipped:\n" + "\n".join(missing)
+            counts.clear()
+            count_tree.delete(*count_tree.get_children())
+            show_status()
+            tkinter.messagebox.showinfo("Cycle Count Saved", summary, parent = count_window)
+
+        def close_count():
+            nonlocal cycle_count_window
+            if counts and not tkinter.messagebox.askyesno("Discard Count", "Close without reconciling? The count will be lost.", parent = count_window):
+                return
+            stop_scanning()
+            cycle_count_window = None
+            count_window.destroy()
+
+        count_buttons = tk.Frame(count_window)
+        tk.Button(count_buttons, text = "Start Scanning", command = start_scanning, font = ("Calibri", 9)).pack(side = tk.LEFT, padx = 2)
+        tk.Button(count_buttons, text = "Stop Scanning", command = stop_scanning, font = ("Calibri", 9)).pack(side = tk.LEFT, padx = 2)
+        tk.Button(count_buttons, text = "+1", command = lambda: adjust_selected(1), font = ("Calibri", 9)).pack(side = tk.LEFT, padx = 2)
+        tk.Button(count_buttons, text = "-1", command = lambda: adjust_selected(-1), font = ("Calibri", 9)).pack(side = tk.LEFT, padx = 2)
+        tk.Button(count_buttons, text = "Remove", command = remove_selected, font = ("Calibri", 9)).pack(side = tk.LEFT, padx = 2)
+        tk.Button(count_buttons, text = "Reconcile", command = reconcile, font = ("Calibri", 9)).pack(side = tk.RIGHT, padx = 2)
+
+        count_tree.grid(row = 0, column = 0, padx = (10, 0), pady = 10, sticky = 'nsew')
+        count_scrollbar.grid(row = 0, column = 1, padx = (0, 10), pady = 10, sticky = 'ns')
+        count_status_label.grid(row = 1, column = 0, columnspan = 2, padx = 10, sticky = 'we')
+        count_buttons.grid(row = 2, column = 0, columnspan = 2, padx = 10, pady = 10, sticky = 'we')
+        count_window.columnconfigure(0, weight = 1)
+        count_window.rowconfigure(0, weight = 1)
+        count_window.protocol("WM_DELETE_WINDOW", close_count)
+        count_window.after(50, poll_count_scans)
+
+
+    # Export dialog; the export itself runs on a worker thread and reports through a queue
+    export_window = None
+
+    def open_export_dialog():
+        nonlocal export_window
+        if export_window is not None:
+            export_window.lift()
+            return
 
-                        try:
-                            qr_data_json = json.loads(qr_data)
-                            random_id = qr_data_json.get("random_id")
-                            if random_id:
-                                item_data = get_item_data_from_db(random_id)
-                                if item_data:
-                                    category, ItemName, quantity, _ = item_data
-                                    print(f"Item found: {ItemName}, Category: {category}, Quantity: {quantity}")
-                                    ################ Update GUI and handle the data as here ######################
-                                    # 
-                                    #
-                                    #
-                                    #
-                                    camera = False
-                                else:
-                                    print("Item not found in database")
-                            else:
-                                print("Random ID not found in QR data")
-                        except json.JSONDecodeError:
-                            print("Invalid QR code format")
-
-                        # Sleep to prevent immediate re-scanning
-                        time.sleep(5)
-
-                cv2.imshow("Scanner Window", frame)
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
+        dialog = tk.Toplevel(window)
+        dialog.title("Export Data")
+        export_window = dialog
+        export_progress = queue.Queue()
+        cancel_event = threading.Event()
+        running = False
+
+        kind_var = tk.StringVar(dialog, value = "changes")
+        format_var = tk.StringVar(dialog, value = "CSV")
+        archive_var = tk.BooleanVar(dialog, value = False)
+        selected_row = inventory_store.resolve(item_combobox.get())
+
+        tk.Radiobutton(dialog, text = "Change history", variable = kind_var, value = "changes").grid(row = 0, column = 0, padx = 10, pady = (10, 0), sticky = 'w')
+        tk.Radiobutton(dialog, text = "Inventory snapshot", variable = kind_var, value = "inventory").grid(row = 0, column = 1, padx = 10, pady = (10, 0), sticky = 'w')
+        fields = {}
+        for row_number, (label, initial) in enumerate([
+                ("From (YYYY-MM-DD)", ""),
+                ("To (YYYY-MM-DD)", ""),
+                ("Item name", inventory_store.name(selected_row) if selected_row is not None else ""),
+                ("Employee ID", "")], start = 1):
+            tk.Label(dialog, text = label).grid(row = row_number, column = 0, padx = 10, pady = 2, sticky = 'w')
+            entry = tk.Entry(dialog, width = 30)
+            entry.insert(0, initial)
+            entry.grid(row = row_number, column = 1, padx = 10, pady = 2, sticky = 'w')
+            fields[label] = entry
+        tk.Checkbutton(dialog, text = "Include archived months", variable = archive_var).grid(row = 5, column = 1, padx = 10, sticky = 'w')
+        tk.Label(dialog, text = "Format").grid(row = 6, column = 0, padx = 10, pady = 2, sticky = 'w')
+        ttk.Combobox(dialog, textvariable = format_var, values = ["CSV", "Parquet"], state = "readonly", width = 10).grid(row = 6, column = 1, padx = 10, pady = 2, sticky = 'w')
+        progress_bar = ttk.Progressbar(dialog, length = 300, mode = "determinate")
+        progress_bar.grid(row = 7, column = 0, columnspan = 2, padx = 10, pady = (10, 0))
+        status_label = tk.Label(dialog, text = "", anchor = 'w')
+        status_label.grid(row = 8, column = 0, columnspan = 2, padx = 10, sticky = 'we')
+
+        def run_export(options):
+            try:
+                written = export_data(progress = lambda done, total: export_progress.put(("progress", done, total)),
+                                      cancel_event = cancel_event, **options)
+                export_progress.put(("done", written, options["path"]))
+            except Exception as e:
+                export_progress.put(("error", e, None))
+
+        def poll_export():
+            nonlocal running
+            if export_window is not dialog:
+                return
+            message = None
+            try:
+                while True:
+                    message = export_progress.get_nowait()
+                    if message[0] != "progress":
+                        break
+            except queue.Empty:
+                pass
+            if message is None or message[0] == "progress":
+                if message is not None:
+                    _, done, total = message
+                    progress_bar.config(maximum = max(total, 1), value = done)
+                    status_label.config(text = f"{done:,} of {total:,} rows")
+                dialog.after(100, poll_export)
+                return
 
-        except Exception as e:
-            print("An error occurred in run_scanner:", e)
-        finally:
-            if 'cap' in locals() and cap.isOpened():
-                cap.release()
-            cv2.destroyAllWindows()
-            print("Scanner stopped")
+            running = False
+            export_button.config(state = tk.NORMAL)
+            kind, result, path = message
+            if kind == "error":
+                status_label.config(text = "Export failed")
+                tkinter.messagebox.showerror("Export Failed", str(result), parent = dialog)
+            elif result is None:
+                status_label.config(text = "Export cancelled")
+            else:
+                status_label.config(text = f"Wrote {result:,} rows to {os.path.basename(path)}")
+
+        def start_export():
+            nonlocal running
+            if running:
+                return
+            try:
+                start = fields["From (YYYY-MM-DD)"].get().strip()
+                end = fields["To (YYYY-MM-DD)"].get().strip()
+                emp_id = fields["Employee ID"].get().strip()
+                options = {
+                    "kind": kind_var.get(),
+                    "start": export_date(start) if start else None,
+                    "end": export_date(end) if end else None,
+                    "item_name": fields["Item name"].get().strip() or None,
+                    "emp_id": int(emp_id) if emp_id else None,
+                    "include_archive": archive_var.get(),
+                    "export_format": format_var.get().lower(),
+                }
+            except ValueError:
+                tkinter.messagebox.showerror("Invalid Filter", "Dates must be YYYY-MM-DD and the employee ID a number.", parent = dialog)
+                return
+
+            from tkinter import filedialog
+            extension = ".parquet" if options["export_format"] == "parquet" else ".csv"
+            path = filedialog.asksaveasfilename(parent = dialog, defaultextension = extension,
+                                                filetypes = [(format_var.get(), "*" + extension)],
+                                                initialfile = f"{options['kind']}_export{extension}")
+            if not path:
+                return
+            options["path"] = path
+            running = True
+            cancel_event.clear()
+            export_button.config(state = tk.DISABLED)
+            progress_bar.config(value = 0)
+            status_label.config(text = "Counting rows...")
+            threading.Thread(target = run_export, args = (options,), name = "export", daemon = True).start()
+            dialog.after(100, poll_export)
+
+        def close_export():
+            nonlocal export_window
+            cancel_event.set()
+            export_window = None
+            dialog.destroy()
+
+        export_buttons = tk.Frame(dialog)
+        export_buttons.grid(row = 9, column = 0, columnspan = 2, padx = 10, pady = 10, sticky = 'we')
+        export_button = tk.Button(export_buttons, text = "Export...", command = start_export, font = ("Calibri", 9))
+        export_button.pack(side = tk.LEFT, padx = 2)
+        tk.Button(export_buttons, text = "Cancel", command = cancel_event.set, font = ("Calibri", 9)).pack(side = tk.LEFT, padx = 2)
+        tk.Button(export_buttons, text = "Close", command = close_export, font = ("Calibri", 9)).pack(side = tk.RIGHT, padx = 2)
+        dialog.protocol("WM_DELETE_WINDOW", close_export)
+
+
+    # Latency stats window, refreshed once a second while it is open
+    latency_window = None
+
+    def open_latency_stats(event = None):
+        nonlocal latency_window
+        if latency_window is not None:
+            latency_window.lift()
+            return
+
+        stats_window = tk.Toplevel(window)
+        stats_window.title("Latency Stats")
+        latency_window = stats_window
+
+        columns = ("calls", "p50_ms", "p95_ms", "p99_ms", "max_ms")
+        stats_tree = ttk.Treeview(stats_window, columns = columns, height = 20)
+        stats_tree.heading("#0", text = "Operation")
+        stats_tree.column("#0", width = 220)
+        for column, title in zip(columns, ("Calls", "p50 ms", "p95 ms", "p99 ms", "Max ms")):
+            stats_tree.heading(column, text = title)
+            stats_tree.column(column, width = 80, anchor = 'e')
+
+        def refresh_stats():
+            if latency_window is not stats_window:
+                return
+            stats_tree.delete(*stats_tree.get_children())
+            for row in latency_stats.summary():
+                stats_tree.insert("", tk.END, text = row["operation"], values = (
+                    row["calls"], *(f"{row[column]:.1f}" for column in columns[1:])))
+            stats_window.after(1000, refresh_stats)
+
+        def export_stats(extension):
+            from tkinter import filedialog
+            path = filedialog.asksaveasfilename(parent = stats_window, defaultextension = extension,
+                                                filetypes = [(extension[1:].upper(), "*" + extension)],
+                                                initialfile = "inventory_latency" + extension)
+            if not path:
+                return
+            try:
+                if extension == ".json":
+                    latency_stats.export_json(path)
+                else:
+                    latency_stats.export_csv(path)
+            except OSError as e:
+                tkinter.messagebox.showerror("Export Failed", str(e), parent = stats_window)
+
+        def close_stats():
+            nonlocal latency_window
+            latency_window = None
+            stats_window.destroy()
+
+        stats_buttons = tk.Frame(stats_window)
+        tk.Button(stats_buttons, text = "Export JSON", command = lambda: export_stats(".json"), font = ("Calibri", 9)).pack(side = tk.LEFT, padx = 2)
+        tk.Button(stats_buttons, text = "Export CSV", command = lambda: export_stats(".csv"), font = ("Calibri", 9)).pack(side = tk.LEFT, padx = 2)
+        tk.Button(stats_buttons, text = "Reset", command = latency_stats.reset, font = ("Calibri", 9)).pack(side = tk.RIGHT, padx = 2)
+        stats_tree.pack(side = tk.TOP, fill = tk.BOTH, expand = True, padx = 10, pady = 10)
+        stats_buttons.pack(side = tk.TOP, fill = tk.X, padx = 10, pady = (0, 10))
+        stats_window.protocol("WM_DELETE_WINDOW", close_stats)
+        refresh_stats()
 
           
     def log_change_to_db(item_name, original_quantity, new_quantity, current_user_id, random_id):
-        db = mysql.connector.connect(
-            host='localhost',
-            database='shop_inventory',
-            user='root',
-            password='peter'
-        )
-        cursor = db.cursor()
-
         # Calculate the quantity change
         quantity_change = new_quantity - original_quantity
 
@@ -544,29 +3809,89 @@ def main_app():
         change_time = datetime.now()
         change_date = change_time.date()  # Extracts just the date part of the datetime
 
-        # Insert the change record into changes_log
-        insert_query = "INSERT INTO changes_log(item_name, original_quantity, new_quantity, quantity_change, change_date, change_time, emp_id, random_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-        cursor.execute(insert_query, 
-                    (item_name, original_quantity, new_quantity, quantity_change, change_date, change_time, current_user_id, random_id))
-
-        db.commit()
-        db.close()
+        # Cached graphs of this item are out of date now
+        graph_cache.invalidate_items({item_name})
+
+        # Queue the change record for changes_log, the write-behind logger batches the INSERTs.
+        # The last column is the row's idempotency key.
+        change_log_writer.submit((item_name, original_quantity, new_quantity, quantity_change, change_date, change_time,
+                                  current_user_id, random_id, uuid.uuid4().hex))
+
+
+    # Local SQLite mirror of the inventory and outbox of writes for the server
+    local_mirror = open_local_mirror()
+    outbox_replayer = OutboxReplayer(local_mirror) if local_mirror is not None else None
+    offline_since = None
+
+    # Fetch data from the MySQL database and populate the inventory store
+    try:
+        sync_watermark = load_inventory(inventory_store, search_index, local_mirror)
+    except Exception as e:
+        if local_mirror is None or not is_connection_error(e):
+            raise
+        # Work from the local mirror until the server is back; start over in case the load got partway
+        print("Database server unreachable, loading the local inventory mirror:", e)
+        inventory_store = InventoryStore()
+        search_index = SearchIndex(inventory_store)
+        local_mirror.load_inventory(inventory_store, search_index.add)
+        # The service sends every row again when asked for changes since version 0. A mirror
+        # without a cursor (written in remote mode or before migration 3) syncs from the start,
+        # which reads the whole table again in batches once the server is back.
+        if inventory_service is not None:
+            sync_watermark = 0
+            offline_since = "an unknown time"
+        else:
+            mirror_watermark = local_mirror.watermark()
+            sync_watermark = mirror_watermark or INVENTORY_SYNC_START
+            offline_since = mirror_watermark[0] if mirror_watermark else "an unknown time"
 
+    # Keep quantities current with changes saved on other stations
+    inventory_sync = InventorySync(sync_watermark, mirror = local_mirror) if sync_watermark is not None else None
 
-    # Fetch data from the MySQL database and populate the inventory dictionary
-    db = mysql.connector.connect(
-        host = "localhost",
-        user = "root",
-        password = "peter",
-        database = "shop_inventory"
-    )
-    cursor = db.cursor()
-    # Modify the SQL query to include random_id
-    cursor.execute("SELECT ItemName, random_id, Quantity FROM shop_inventory_count")
-    for (item_name, random_id, quantity) in cursor:
-        inventory_key = f"{random_id} - {item_name}"
-        inventory[inventory_key] = {"Quantity": quantity}
-        search_inventory[item_name] = (random_id, quantity)  # Store for searching
+    def poll_inventory_sync():
+        # Runs on the Tk thread: patch the store and the labels with rows changed elsewhere
+        try:
+            while True:
+                rows = inventory_sync.updates.get_nowait()
+                selected_row = inventory_store.resolve(item_combobox.get())
+                for item_name, random_id, quantity, category, _ in rows:
+                    row, is_new = inventory_store.upsert(random_id, item_name, quantity, category)
+                    if is_new:
+                        search_index.add(row)
+                        continue
+                    # Unsaved changes made on this station stay on top of the server quantity
+                    local_quantity = inventory_store.quantity(row) + changes.get(row, 0)
+                    inventory_store.set_quantity(row, local_quantity)
+                    if row == selected_row:
+                        quantity_label.config(text = f"Quantity: {local_quantity}")
+                        update_original_and_new_quantity(item_name, float(quantity or 0), local_quantity)
+        except queue.Empty:
+            pass
+        window.after(1000, poll_inventory_sync)
+
+    if inventory_sync is not None:
+        inventory_sync.start()
+        window.after(1000, poll_inventory_sync)
+
+    def poll_outbox_status():
+        # Runs on the Tk thread: show why queued saves or change log rows are not reaching the server
+        problems = []
+        if outbox_replayer is not None and outbox_replayer.error:
+            problems.append(outbox_replayer.error)
+        if change_log_writer.error:
+            problems.append(f"Change log rows could not be written: {change_log_writer.error}")
+        outbox_status_label.config(text = "\n".join(problems))
+        window.after(2000, poll_outbox_status)
+
+
+    # Start the background change log writer; rows not yet on the server are kept in the outbox
+    change_log_writer.outbox = local_mirror
+    change_log_writer.start()
+    if outbox_replayer is not None:
+        outbox_replayer.start()
+
+    # Categories for the Compare tab
+    compare_category_combobox['values'] = sorted(inventory_store.by_category, key = str)
 
 
     # Load and display the company logo image
@@ -611,6 +3936,7 @@ def main_app():
     save_button_frame = tk.Frame(window, highlightbackground = 'black', highlightthickness = 1)
     reset_button_frame = tk.Frame(window, highlightbackground = 'black', highlightthickness = 1)
     scan_button_frame = tk.Frame(window, highlightbackground = 'black', highlightthickness = 1)
+    export_button_frame = tk.Frame(window, highlightbackground = 'black', highlightthickness = 1)
 
 
     # Load and resize the background image for the 'Add Quantity' button
@@ -658,6 +3984,11 @@ def main_app():
     save_button = tk.Button(save_button_frame, text = "Save Changes", command = save_changes, font = ("Calibri", 9), image = save_button_photo, compound = "center")
     reset_button = tk.Button(reset_button_frame, text = "Reset", command = reset_quantity, font = ("Calibri", 9), image = reset_button_photo, compound = "center")
     scan_button = tk.Button(scan_button_frame, text = " Search by code scan", command = scan_code, font = ("Calibri", 9), compound = "center")
+    export_button = tk.Button(export_button_frame, text = "Export data", command = open_export_dialog, font = ("Calibri", 9), width = 14)
+    cycle_count_button = tk.Button(scan_button_frame, text = "Cycle count", command = open_cycle_count, font = ("Calibri", 9), compound = "center")
+    if inventory_service is not None:
+        # Exports stream straight from MySQL; in remote mode use 'python inven_control.py export' on the server
+        export_button.config(state = tk.DISABLED)
 
 
     # Bind the item selection event to the item_selected function
@@ -667,6 +3998,12 @@ def main_app():
     # Bind the month_combobox to update the graph when the selection changes
     month_combobox.bind("<<ComboboxSelected>>", update_graph_for_month)
 
+    # Redraw from the in-memory series when another usage tab is opened
+    toc_notebook.bind("<<NotebookTabChanged>>", on_tab_selected)
+
+    # Hidden latency stats window (Ctrl+Shift+L)
+    window.bind("<Control-L>", open_latency_stats)
+
 
     # GUI components in the window using grid
     item_combobox.grid(row = 1, column = 0, padx = 10, pady = 5, sticky = 'w')
@@ -689,9 +4026,14 @@ def main_app():
     changes_title_label.grid(row = 6, column = 1, padx = 10, pady = (10, 0), sticky = 'w')  # Adjust row, column, padx, pady as needed
 
 
+    # Problems sending queued saves and change log rows to the server
+    outbox_status_label = tk.Label(window, text = "", fg = 'red', anchor = 'w', justify = tk.LEFT, wraplength = 320)
+    outbox_status_label.grid(row = 9, column = 0, padx = 10, pady = 5, sticky = 'w')
+
+
     # Listbox to display the changes
-    changes_listbox = tk.Listbox(window, width = 40, borderwidth = 0, highlightthickness = 0,)
-    changes_listbox.grid(row = 7, column = 1, rowspan = 6, padx = 10, pady = 10, sticky = 'ns')
+    recent_changes = RecentChangesView(window, current_user_id)
+    recent_changes.frame.grid(row = 7, column = 1, rowspan = 6, padx = 10, pady = 10, sticky = 'ns')
 
 
 
@@ -701,56 +4043,71 @@ def main_app():
     save_button.pack()
     reset_button.pack()
     scan_button.pack()
+    cycle_count_button.pack(fill = tk.X)
+    export_button.pack()
 
     # Grid the frames in the main window
     add_button_frame.grid(row = 4, column = 0, pady = 5)
     remove_button_frame.grid(row = 5, column = 0, pady = 5, sticky = 's')
     save_button_frame.grid(row = 7, column = 0, columnspan = 2, padx = 10, pady = 5, sticky = 'w')
+    export_button_frame.grid(row = 8, column = 0, padx = 10, pady = 5, sticky = 'w')
     reset_button_frame.grid(row = 5, column = 1, pady = 5, padx = 10, sticky = 'w')
     scan_button_frame.grid(row = 1, column = 0, padx = (50, 0), pady = 5)  # Adjust grid position as needed
 
 
 
     # Bind the hover events for each frame
-    for frame in [add_button_frame, remove_button_frame, save_button_frame, reset_button_frame]:
+    for frame in [add_button_frame, remove_button_frame, save_button_frame, reset_button_frame, export_button_frame]:
         frame.bind("<Enter>", lambda e, f=frame: on_enter(e, f))
         frame.bind("<Leave>", lambda e, f=frame: on_leave(e, f))
 
 
+    if STARTUP_TIMING:
+        window.after_idle(startup_mark, "main window ready")
+
+    if offline_since is not None:
+        window.after_idle(lambda: tkinter.messagebox.showwarning(
+            "Working Offline",
+            f"The database server could not be reached. Quantities come from the local copy last updated {offline_since}.\n\n"
+            "Changes and saves are kept on this station and sent automatically once the server is back."))
+
+    # Start handing finished graph loads and scanner results to the GUI
+    window.after(50, poll_graph_results)
+    window.after(50, poll_scan_results)
+    window.after(2000, poll_outbox_status)
+
     # Start the GUI application
     window.mainloop()
     
 
 
-# Tkinter window for the login page
-login_window = tk.Tk()
-login_window.title("Employee Login")
-login_window.geometry("250x250")
-
 #### Login and validation checking. ####
+login_window = None
+emp_id_entry = None
+last_name_entry = None
+
+
+def check_login(emp_id, last_name):
+    if inventory_service is not None:
+        return inventory_service.call("login", emp_id = emp_id, last_name = last_name)
+
+    # Query to check if employee ID and last name exist in the database
+    query = "SELECT * FROM emp_login WHERE id = %s AND last_name = %s"
+    with db_connection("login") as db:
+        cursor = db.cursor()
+        cursor.execute(query, (emp_id, last_name))
+        result = cursor.fetchone()
+        # Close the cursor, the connection goes back to the pool
+        cursor.close()
+    return result is not None
+
+
 def validate_login():
     global current_user_id
     emp_id = emp_id_entry.get()
     last_name = last_name_entry.get()
-    
-    # Connect to the MySQL database
-    db = mysql.connector.connect(
-        host='localhost',
-        user='root',
-        password='peter',  # Replace with your MySQL password
-        database='shop_inventory'
-    )
-    cursor = db.cursor()
-    # Query to check if employee ID and last name exist in the database
-    query = "SELECT * FROM emp_login WHERE id = %s AND last_name = %s"
-    cursor.execute(query, (emp_id, last_name))
-    result = cursor.fetchone()
 
-    # Close the database connection
-    cursor.close()
-    db.close()
-
-    if result:
+    if check_login(emp_id, last_name):
         # keep the user_id saved
         current_user_id = emp_id
         # If the employee ID and last name are valid, close the login window and open the main application window
@@ -760,20 +4117,145 @@ def validate_login():
         # Show an error message if the login is invalid
         tkinter.messagebox.showerror("Login Failed", "Invalid Employee ID or Last Name")
 
-# Create and place the widgets
-tk.Label(login_window, text="Employee ID").pack()
-emp_id_entry = tk.Entry(login_window)
-emp_id_entry.pack()
-tk.Label(login_window, text="Last Name").pack()
-last_name_entry = tk.Entry(login_window)
-last_name_entry.pack()
-login_button = tk.Button(login_window, text="Login", command=validate_login)
-login_button.pack()
+
+def ensure_upcoming_partitions():
+    # Runs on a background thread after login; archiving is left to 'maintain-partitions'
+    try:
+        maintain_partitions(archive = False)
+    except Exception as e:
+        print("Could not create upcoming changes_log partitions:", e)
 
 
 def open_main_window():
+    if WARM_IMPORTS:
+        threading.Thread(target = warm_heavy_modules, name = "warm-imports", daemon = True).start()
+    # In remote mode the service host looks after the partitions
+    if inventory_service is None:
+        threading.Thread(target = ensure_upcoming_partitions, name = "partitions", daemon = True).start()
     main_app()
 
-# Start the Tkinter event loop
 
-login_window.mainloop()
+def main(argv = None):
+    global STARTUP_TIMING, login_window, emp_id_entry, last_name_entry, inventory_service
+    import argparse
+
+    parser = argparse.ArgumentParser(description = "Shop inventory control")
+    parser.add_argument("--startup-timing", action = "store_true",
+                        help = "print startup timings and exit once the login window is ready")
+    parser.add_argument("--service", default = SERVICE_ADDRESS,
+                        help = "host:port of an inventory_service.py to use instead of connecting to MySQL")
+    commands = parser.add_subparsers(dest = "command")
+    commands.add_parser("migrate", help = "apply pending schema migrations and exit")
+    backfill_parser = commands.add_parser("backfill-rollup", help = "rebuild changes_daily_rollup from changes_log and exit")
+    backfill_parser.add_argument("--chunk-days", type = int, default = ROLLUP_BACKFILL_CHUNK_DAYS,
+                                 help = "days of history rebuilt per transaction")
+    explain_parser = commands.add_parser("check-indexes", help = "EXPLAIN the graph queries and report the indexes they use")
+    explain_parser.add_argument("--item", help = "item name to EXPLAIN with (defaults to any logged item)")
+    partitions_parser = commands.add_parser("maintain-partitions", help = "create upcoming changes_log partitions, archive expired ones and exit")
+    partitions_parser.add_argument("--ahead", type = int, default = PARTITION_AHEAD_MONTHS,
+                                   help = "months of partitions to create ahead of the current month")
+    partitions_parser.add_argument("--retention-months", type = int, default = CHANGES_LOG_RETENTION_MONTHS,
+                                   help = "months kept in changes_log before archiving (0 = never archive)")
+    export_parser = commands.add_parser("export", help = "stream changes_log or an inventory snapshot to CSV/Parquet and exit")
+    export_parser.add_argument("kind", choices = sorted(EXPORT_KINDS), help = "changes (changes_log) or inventory (current quantities)")
+    export_parser.add_argument("--output", required = True, help = "file to write (.csv or .parquet)")
+    export_parser.add_argument("--format", choices = ["csv", "parquet"], help = "output format (default: from the file extension)")
+    export_parser.add_argument("--start", type = export_date, help = "first change_date to include (YYYY-MM-DD)")
+    export_parser.add_argument("--end", type = export_date, help = "last change_date to include (YYYY-MM-DD)")
+    export_parser.add_argument("--item", help = "only this ItemName")
+    export_parser.add_argument("--emp-id", type = int, help = "only changes made by this employee")
+    export_parser.add_argument("--include-archive", action = "store_true", help = "also export months moved to changes_log_archive")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        applied = run_migrations()
+        print(f"Applied {len(applied)} migration(s)" if applied else "Schema is up to date")
+        close_db_pool()
+        return 0
+    if args.command == "backfill-rollup":
+        chunks = backfill_daily_rollup(args.chunk_days)
+        print(f"Rebuilt {chunks} chunk(s) of changes_daily_rollup")
+        close_db_pool()
+        return 0
+    if args.command == "check-indexes":
+        report = explain_graph_queries(args.item)
+        for label, key, rows, uses_index in report:
+            print(f"{label:<20} key={key or '-':<28} rows={rows}  {'OK' if uses_index else 'FULL SCAN / WRONG INDEX'}")
+        close_db_pool()
+        return 0 if all(uses_index for *_, uses_index in report) else 1
+    if args.command == "export":
+        def print_progress(written, total):
+            print(f"\rExported {written:,} of {total:,} rows", end = "", file = sys.stderr, flush = True)
+
+        written = export_data(args.kind, args.output, args.format, args.start, args.end, args.item, args.emp_id,
+                              args.include_archive, progress = print_progress)
+        print(f"\nWrote {written:,} rows to {args.output}", file = sys.stderr)
+        close_db_pool()
+        return 0
+    if args.command == "maintain-partitions":
+        created, archived = maintain_partitions(args.ahead, args.retention_months)
+        print(f"Created partitions: {', '.join(created) or 'none'}")
+        print(f"Archived partitions: {', '.join(archived) or 'none'}")
+        print(f"Forgot {prune_applied_deltas()} old save keys")
+        close_db_pool()
+        return 0
+
+    if args.startup_timing:
+        STARTUP_TIMING = True
+    startup_mark("imports done")
+
+    if args.service:
+        # Remote mode: every data call goes through the shared service, which checks the schema itself
+        inventory_service = InventoryServiceClient(args.service)
+        pending = []
+    else:
+        # Saves, change logging and the graphs need the tables and columns added by the migrations
+        try:
+            pending = pending_migrations()
+        except Exception as e:
+            pending = []
+            print("Could not check schema migrations:", e)
+
+    # Tkinter window for the login page
+    login_window = tk.Tk()
+    login_window.title("Employee Login")
+    login_window.geometry("250x250")
+
+    if pending:
+        # Saves and change logging write to the tables and columns the migrations add, so the
+        # main window is not opened until they are applied. Some rebuild changes_log, which
+        # should not happen from whichever station starts first while others are working.
+        login_window.withdraw()
+        tkinter.messagebox.showerror(
+            "Database Upgrade Needed",
+            f"Schema migrations {pending} have not been applied to this database, so saving and logging changes would fail.\n\n"
+            "Run 'python inven_control.py migrate' once, with the other stations closed, then start the application again.",
+            parent = login_window)
+        login_window.destroy()
+        close_db_pool()
+        return 1
+
+    # Create and place the widgets
+    tk.Label(login_window, text="Employee ID").pack()
+    emp_id_entry = tk.Entry(login_window)
+    emp_id_entry.pack()
+    tk.Label(login_window, text="Last Name").pack()
+    last_name_entry = tk.Entry(login_window)
+    last_name_entry.pack()
+    login_button = tk.Button(login_window, text="Login", command=validate_login)
+    login_button.pack()
+
+    def login_ready():
+        startup_mark("login window ready")
+        if args.startup_timing:
+            login_window.destroy()
+
+    if STARTUP_TIMING:
+        login_window.after_idle(login_ready)
+
+    # Start the Tkinter event loop
+    login_window.mainloop()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,413 @@
+"""
+Shop Inventory Application - inventory service
+Description: Headless asyncio service that the stations share instead of each one connecting
+to MySQL. It holds the one connection pool, one in-memory copy of the inventory (kept current
+by a single delta sync) and one graph cache. Identical reads that are in flight at the same
+time are answered by one query, and saves, change-log rows and scan lookups that arrive
+within a few milliseconds of each other are sent to MySQL as one transaction / one query.
+
+Stations use it by starting inven_control.py with --service host:port (or INVENTORY_SERVICE).
+
+Protocol: one JSON object per line over TCP. Requests are {"id", "op", "args", "token"},
+replies {"id", "result"} or {"id", "error", "unavailable"}. Replies can come back out of
+order, so a station can have several requests in flight on one connection.
+
+Usage:
+    python inventory_service.py --host 0.0.0.0 --port 8765
+"""
+
+import argparse
+import asyncio
+import hmac
+import ipaddress
+import json
+import os
+import queue
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+
+import inven_control as app
+
+
+SERVICE_HOST = os.environ.get("INVENTORY_SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.environ.get("INVENTORY_SERVICE_PORT", "8765"))
+# Longest request line accepted (a large save or change-log batch)
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+# Requests arriving this long after the first one of a batch still join it (seconds)
+BATCH_DELAY = float(os.environ.get("INVENTORY_SERVICE_BATCH_DELAY", "0.005"))
+# Most requests combined into one transaction / query
+BATCH_MAX_SIZE = 200
+# Inventory changes remembered for changes_since; stations further behind reload everything
+CHANGE_HISTORY = 50000
+# Seconds between moving synced rows into the shared store
+SYNC_APPLY_INTERVAL = 0.5
+
+
+def encode_value(value):
+    # DECIMAL columns come back from MySQL as Decimal
+    if isinstance(value, Decimal):
+        return float(value)
+    return app.encode_json_value(value)
+
+
+class RequestBatcher:
+    # Collects requests that arrive within max_delay of the first one (up to max_size) and
+    # runs handler once with the whole list on the DB threads. handler returns one result
+    # per request; if it raises, every request in the batch gets the error.
+    def __init__(self, service, handler, max_delay = BATCH_DELAY, max_size = BATCH_MAX_SIZE):
+        self.service = service
+        self.handler = handler
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.pending = []  # (request, future)
+        self.timer = None
+
+    async def submit(self, request):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((request, future))
+        if len(self.pending) >= self.max_size:
+            self._flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch):
+        try:
+            results = await self.service.run_blocking(self.handler, [request for request, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+
+class InventoryService:
+    # The shared store and search index are only touched on the event loop thread; MySQL
+    # work runs on a thread pool the size of the connection pool.
+    def __init__(self, token = app.SERVICE_TOKEN):
+        self.token = token
+        self.store = app.InventoryStore()
+        self.search_index = app.SearchIndex(self.store)
+        self.executor = ThreadPoolExecutor(max_workers = app.DB_POOL_SIZE, thread_name_prefix = "service-db")
+        self.version = 0
+        self.history = deque()  # (version, store row) of every inventory change
+        self.history_floor = 0  # oldest version changes_since can still answer from
+        self.inflight = {}  # single-flight key -> future of the running read
+        self.sync = None
+        self.lookups = RequestBatcher(self, self._lookup_ids)
+        self.saves = RequestBatcher(self, self._save_batches)
+        self.change_logs = RequestBatcher(self, self._write_change_logs)
+        self.operations = {
+            "inventory": self.op_inventory,
+            "changes_since": self.op_changes_since,
+            "search": self.op_search,
+            "lookup": self.op_lookup,
+            "log_changes": self.op_log_changes,
+            "save": self.op_save,
+            "daily_series": self.op_daily_series,
+            "comparison_rows": self.op_comparison_rows,
+            "daily_consumption": self.op_daily_consumption,
+            "change_rows": self.op_change_rows,
+            "cycle_count": self.op_cycle_count,
+            "login": self.op_login,
+            "stats": self.op_stats,
+        }
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def shared(self, key, func, *args):
+        # Concurrent calls with the same key wait on the one that is already running
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.run_blocking(func, *args))
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    # Shared inventory
+    async def start(self):
+        # Returns False without serving anything if the database needs migrations: change-log
+        # rows and saves would fail on every request and pile up in the stations' outboxes
+        pending = await self.run_blocking(app.pending_migrations)
+        if pending:
+            print(f"Schema migrations {pending} have not been applied, run 'python inven_control.py migrate' first")
+            return False
+        watermark = await self.run_blocking(app.load_inventory, self.store, self.search_index)
+        print(f"Loaded {len(self.store)} inventory rows")
+        if watermark is not None:
+            self.sync = app.InventorySync(watermark)
+            self.sync.start()
+            asyncio.ensure_future(self._apply_synced_rows())
+        return True
+
+    async def _apply_synced_rows(self):
+        while True:
+            await asyncio.sleep(SYNC_APPLY_INTERVAL)
+            while True:
+                try:
+                    rows = self.sync.updates.get_nowait()
+                except queue.Empty:
+                    break
+                for item_name, random_id, quantity, category, _ in rows:
+                    row, is_new = self.store.upsert(random_id, item_name, quantity, category)
+                    if is_new:
+                        self.search_index.add(row)
+                    self._record_change(row)
+
+    def _record_change(self, row):
+        self.version += 1
+        self.history.append((self.version, row))
+        while len(self.history) > CHANGE_HISTORY:
+            self.history_floor = self.history.popleft()[0]
+
+    def _store_row(self, row):
+        return [self.store.name(row), self.store.ids[row], self.store.quantity(row), self.store.category(row)]
+
+    async def op_inventory(self):
+        rows = [self._store_row(row) for row in range(len(self.store))]
+        return {"version": self.version, "rows": rows}
+
+    async def op_changes_since(self, version):
+        if version < self.history_floor:
+            return {"version": self.version, "reload": True}
+        # Newest version per row only
+        changed = {}
+        for change_version, row in reversed(self.history):
+            if change_version <= version:
+                break
+            changed.setdefault(row, change_version)
+        rows = [self._store_row(row) + [change_version] for row, change_version in reversed(changed.items())]
+        return {"version": self.version, "rows": rows}
+
+    async def op_search(self, query, limit = app.SEARCH_RESULT_LIMIT):
+        return self.search_index.search(query, limit)
+
+    # Scan lookups
+    async def op_lookup(self, random_id):
+        row = self.store.row_for_id(random_id)
+        if row is not None:
+            return [self.store.category(row), self.store.name(row), self.store.quantity(row), random_id]
+        return await self.lookups.submit(random_id)
+
+    def _lookup_ids(self, random_ids):
+        # Ids the shared store does not know, all in one SELECT ... IN
+        unique_ids = list(dict.fromkeys(random_ids))
+        with app.db_connection("scan_lookup") as db:
+            cursor = db.cursor()
+            cursor.execute(
+                "SELECT category, ItemName, quantity, random_id FROM shop_inventory_count "
+                f"WHERE random_id IN ({', '.join(['%s'] * len(unique_ids))})",
+                unique_ids
+            )
+            found = {str(row[3]): list(row) for row in cursor.fetchall()}
+            cursor.close()
+        return [found.get(random_id) for random_id in random_ids]
+
+    # Writes
+    async def op_log_changes(self, rows):
+        rows = [app.decode_change_row(row) for row in rows]
+        written = await self.change_logs.submit(rows)
+        app.graph_cache.invalidate_items({row[0] for row in rows})
+        return written
+
+    def _write_change_logs(self, row_lists):
+        # Every station's batch in one transaction; the idempotency keys drop resent rows
+        with app.db_connection("changes_log_flush") as db:
+            cursor = db.cursor()
+            try:
+                db.start_transaction()
+                app._write_change_rows(cursor, [row for rows in row_lists for row in rows])
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                cursor.close()
+        return [len(rows) for rows in row_lists]
+
+    async def op_save(self, batches):
+        results = await self.saves.submit([(key, deltas) for key, deltas in batches])
+        # Patch the shared store now instead of waiting for the next sync. The UPDATE joins on
+        # the name case-insensitively, so every row matching it moved by the delta; the new
+        # quantity returned is only known to be that row's when there is one.
+        for item_name, delta, new_quantity in results:
+            if new_quantity is None:
+                continue
+            rows = self.store.rows_for_folded_name(item_name)
+            for row in rows:
+                self.store.set_quantity(row, new_quantity if len(rows) == 1 else self.store.quantity(row) + delta)
+                self._record_change(row)
+        return results
+
+    def _save_batches(self, requests):
+        # All the stations' saves in one transaction. Each station gets back its own deltas
+        # with the new quantities; batches whose key was applied before get nothing back,
+        # like apply_inventory_deltas with a key.
+        applied = set()
+        with app.db_connection("save_deltas") as db:
+            cursor = db.cursor()
+            try:
+                db.start_transaction()
+                merged = app._apply_delta_batches(cursor, [batch for batches in requests for batch in batches], applied)
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                cursor.close()
+
+        new_quantities = {item_name: new_quantity for item_name, _, new_quantity in merged}
+        replies = []
+        for batches in requests:
+            results = []
+            for key, deltas in batches:
+                if key in applied:
+                    applied.discard(key)
+                    results.extend((item_name, delta, new_quantities.get(item_name)) for item_name, delta in deltas.items())
+            replies.append(results)
+        return replies
+
+    async def op_cycle_count(self, counts, emp_id):
+        differences, missing = await self.run_blocking(app.reconcile_cycle_count, counts, emp_id)
+        for random_id, _, _, counted in differences:
+            row = self.store.row_for_id(random_id)
+            if row is not None:
+                self.store.set_quantity(row, counted)
+                self._record_change(row)
+        app.graph_cache.invalidate_items({item_name for _, item_name, _, _ in differences})
+        return {"differences": differences, "missing": missing}
+
+    # Graph and report reads
+    async def op_daily_series(self, item_name):
+        days, totals = await self.shared(("daily_series", item_name), app.fetch_daily_series, item_name)
+        return list(zip(days.astype(str).tolist(), totals.tolist()))
+
+    async def op_comparison_rows(self, item_names, start = None, end = None):
+        key = ("comparison_rows", tuple(item_names), start, end)
+        return await self.shared(key, app.fetch_comparison_rows, item_names, start, end)
+
+    async def op_daily_consumption(self, window_days, today):
+        today = datetime.strptime(today, "%Y-%m-%d").date()
+        return await self.shared(("daily_consumption", window_days, today), app.fetch_daily_consumption, window_days, today)
+
+    async def op_change_rows(self, emp_id, before, limit, before_id = None):
+        return await self.run_blocking(app.fetch_change_rows, emp_id, datetime.fromisoformat(before), limit, before_id)
+
+    async def op_login(self, emp_id, last_name):
+        return await self.run_blocking(app.check_login, emp_id, last_name)
+
+    async def op_stats(self):
+        return app.latency_stats.summary()
+
+    # Connections
+    async def handle_connection(self, reader, writer):
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except (ConnectionError, ValueError) as e:
+                    print("Dropping station connection:", e)
+                    break
+                if not line:
+                    break
+                task = asyncio.ensure_future(self.handle_request(line, writer, write_lock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def handle_request(self, line, writer, write_lock):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            # Constant-time comparison, so response timing does not give the token away
+            if self.token and not hmac.compare_digest(str(request.get("token") or "").encode(), self.token.encode()):
+                raise PermissionError("invalid service token")
+            op = request.get("op")
+            handler = self.operations.get(op)
+            if handler is None:
+                raise ValueError(f"unknown operation {op!r}")
+            with app.latency_stats.timer("service." + op):
+                reply = {"id": request_id, "result": await handler(**request.get("args", {}))}
+        except Exception as e:
+            reply = {"id": request_id, "error": str(e) or type(e).__name__}
+            if app.is_connection_error(e):
+                reply["unavailable"] = True
+        data = (json.dumps(reply, default = encode_value) + "\n").encode()
+        async with write_lock:
+            try:
+                writer.write(data)
+                await writer.drain()
+            except ConnectionError:
+                pass
+
+    def close(self):
+        if self.sync is not None:
+            self.sync.stop()
+        self.executor.shutdown(wait = True)
+        app.close_db_pool()
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+async def serve(host, port, token = app.SERVICE_TOKEN):
+    service = InventoryService(token)
+    if not await service.start():
+        service.close()
+        return 1
+    server = await asyncio.start_server(service.handle_connection, host, port, limit = MAX_REQUEST_BYTES)
+    print(f"Inventory service listening on {host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Shared inventory service for the stations")
+    parser.add_argument("--host", default = SERVICE_HOST, help = "address to listen on")
+    parser.add_argument("--port", type = int, default = SERVICE_PORT, help = "TCP port to listen on")
+    parser.add_argument("--token", default = app.SERVICE_TOKEN,
+                        help = "shared secret the stations must send (default INVENTORY_SERVICE_TOKEN); required unless listening on loopback")
+    args = parser.parse_args(argv)
+    if not args.token and not is_loopback(args.host):
+        print(f"Refusing to listen on {args.host} without a token: anyone who can reach it could change the inventory. "
+              "Set INVENTORY_SERVICE_TOKEN or pass --token.")
+        return 1
+    try:
+        return asyncio.run(serve(args.host, args.port, args.token)) or 0
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())